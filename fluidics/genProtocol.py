@@ -22,6 +22,7 @@ import sys
 import xml.etree.ElementTree as elementTree
 import warnings
 from kilroy import Kilroy
+from kilroyConfiguration import loadConfiguration
 
 __version__ = "1.1.0"
 
@@ -35,7 +36,8 @@ class genProtocol():
     
     def __init__(self,
                  num_hybes = 10,
-                 hybelist = None):
+                 hybelist = None,
+                 configuration = None):
 
         self.default = "default_config.xml"
         self.num_hybes = num_hybes
@@ -44,36 +46,21 @@ class genProtocol():
             self.hybelist = [i+1 for i in range(self.num_hybes)]
         else: self.hybelist = hybelist
 
-        try:
-            self.defaultConfig = elementTree.parse(self.default)
-            self.kilroy_configuration = self.defaultConfig.getroot()
-        except:
-            raise FileNotFoundError("Can't find Default configuration file")
-        
-        self.protocols = dict()
-        self.protocol_names = list()
-        self.protocol_commands = list()
-        self.protocol_durations = list()
-        self.num_protocols = 0
-
-        for kilroy_protocols in self.kilroy_configuration.findall("kilroy_protocols"):
-            protocol_list = kilroy_protocols.findall("protocol")
-            for protocol in protocol_list:
-                self.protocol_names.append(protocol.get("name"))
-                new_protocol_commands = []
-                new_protocol_durations = []
-                for command in protocol: # Get all children
-                    new_protocol_durations.append(int(command.get("duration")))
-                    new_protocol_commands.append([command.tag,command.text]) # [Instrument Type, Command Name]
-                    if (not (command.tag == "pump")) and (not (command.tag == "valve")):
-                        print("Unknown command tag: " + command.tag)
-                self.protocol_commands.append(new_protocol_commands)
-                self.protocol_durations.append(new_protocol_durations)
+        if configuration is None:
+            configuration = loadConfiguration(self.default)
+            if configuration is None:
+                raise FileNotFoundError("Can't find Default configuration file")
+        self.configuration = configuration
 
+        self.protocol_names = configuration.protocols.names
+        self.protocol_commands = configuration.protocols.commands
+        self.protocol_durations = configuration.protocols.durations
         self.num_protocols = len(self.protocol_names)
 
-        for ind, name in enumerate(self.protocol_names):
-            self.protocols[name] = (self.protocol_commands[ind],self.protocol_durations[ind])
+    def getProtocol(self, name):
+        # protocol templates are expanded on use, only for the requested hybes
+        ind = self.protocol_names.index(name)
+        return self.protocol_commands[ind], self.protocol_durations[ind]
 
     def generateXML(self,name = 'new_protocol.xml', imagingtime = 0):
         assert type(imagingtime) == int
@@ -97,12 +84,12 @@ class genProtocol():
         new_protocol_commands = list()
         new_protocol_durations = list()
 
-        root = self.kilroy_configuration
+        root = self.configuration.copyXMLRoot() # the shared configuration is not modified
         kilroy_protocols = elementTree.Element('kilroy_protocols')
         kilroy_protocol = elementTree.Element('protocol',name=f'{new_protocol_name}')
         
         for hybe in self.hybelist:
-            commands, durations = self.protocols[f'Hybridize {hybe}']
+            commands, durations = self.getProtocol(f'Hybridize {hybe}')
             
             for ind, command in enumerate(commands):
                 kilroy_command = elementTree.Element(f'{command[0]}',duration=f'{durations[ind]}')
@@ -143,7 +130,7 @@ class genProtocol():
     def calFluidicTime(self):
         totalTime = list()
         for hybe in self.hybelist:
-            commands, durations = self.protocols[f'Hybridize {hybe}']
+            commands, durations = self.getProtocol(f'Hybridize {hybe}')
             
             time = 0
             for ind,command in enumerate(commands):
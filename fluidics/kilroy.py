@@ -19,11 +19,18 @@ imp.load_source("setPath", "../sc_library/setPath.py")
 import sys
 import os
 import time
+
+# Headless mode: run protocols without a GUI (Qt is never imported)
+if (__name__ == "__main__") and ("--headless" in sys.argv):
+    from kilroyHeadless import main
+    sys.exit(main(sys.argv))
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 from valves.valveChain import ValveChain
 from pumps.pumpControl import PumpControl
 from kilroyProtocols import KilroyProtocols
 from kilroyHyperProtocols import KilroyHyperProtocols
+from kilroyCheckpoint import CheckpointJournal
 from sc_library.tcpServer import TCPServer   # get these from storm control
 import sc_library.parameters as params
 
@@ -87,6 +94,11 @@ class Kilroy(QtWidgets.QMainWindow):
             self.plate_layout = parameters.get("plate_layout")
         else:
             self.plate_layout = './valves/XYZ_layout.json'
+
+        if "checkpoint_file" in parameters.parameters:
+            self.checkpoint_file = parameters.get("checkpoint_file")
+        else:
+            self.checkpoint_file = "kilroy_checkpoint.jsonl"
             
         # Define additional internal attributes
         self.received_message = None
@@ -124,6 +136,9 @@ class Kilroy(QtWidgets.QMainWindow):
         self.kilroyHyperProtocols.status_change_signal.connect(self.handleProtocolStatusChange)
         self.kilroyHyperProtocols.completed_protocol_signal.connect(self.handleProtocolComplete)
 
+        # Protocol commands wait for the robot needle moves of the valve commands
+        self.kilroyHyperProtocols.engine.setDurationEstimator(self.estimateCommand)
+
         # Create Kilroy TCP Server and connect signals
         self.tcpServer = TCPServer(port = self.tcp_port,
                                    server_name = "Kilroy",
@@ -131,9 +146,19 @@ class Kilroy(QtWidgets.QMainWindow):
         
         self.tcpServer.messageReceived.connect(self.handleTCPData)
 
+        # Imaging steps wait for "Kilroy Imaging Done" messages while a microscope is connected
+        self.tcpServer.comGotConnection.connect(self.handleTCPConnection)
+        self.tcpServer.comLostConnection.connect(self.handleTCPDisconnection)
+
         # Create GUI
         self.createGUI()
 
+        # Journal running protocols so that an interrupted run can be resumed
+        self.checkpointJournal = CheckpointJournal(file_path = self.checkpoint_file,
+                                                   verbose = self.verbose)
+        self.checkpoint = self.checkpointJournal.loadCheckpoint()
+        self.kilroyHyperProtocols.engine.setJournal(self.checkpointJournal)
+
     # ----------------------------------------------------------------------------------------
     # Close
     # ----------------------------------------------------------------------------------------
@@ -144,6 +169,34 @@ class Kilroy(QtWidgets.QMainWindow):
         self.pumpControl.close()
         print("\nKilroy was here!")
 
+    # ----------------------------------------------------------------------------------------
+    # Return the estimated time (s) the devices need for a command (called by the engine)
+    # ----------------------------------------------------------------------------------------
+    def estimateCommand(self, instrument, command):
+        if instrument == "valve":
+            return self.valveChain.estimateCommand(command)
+        return 0.0
+
+    # ----------------------------------------------------------------------------------------
+    # Offer to resume a run that was interrupted (e.g. by a crash or reboot)
+    # ----------------------------------------------------------------------------------------
+    def offerResume(self, parent = None):
+        if self.checkpoint is None:
+            return
+        text = "Kilroy was interrupted during:\n\n"
+        text += self.checkpointJournal.describeCheckpoint(self.checkpoint)
+        text += "\n\nResume from this command?"
+        reply = QtWidgets.QMessageBox.question(parent,
+                                               "Resume",
+                                               text,
+                                               QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+                                               QtWidgets.QMessageBox.No)
+        if reply == QtWidgets.QMessageBox.Yes:
+            self.kilroyHyperProtocols.resumeCheckpoint(self.checkpoint)
+        else:
+            self.checkpointJournal.finish()
+        self.checkpoint = None
+
     # ----------------------------------------------------------------------------------------
     # Create master GUI
     # ----------------------------------------------------------------------------------------
@@ -174,16 +227,33 @@ class Kilroy(QtWidgets.QMainWindow):
     # ----------------------------------------------------------------------------------------
     def handleProtocolComplete(self, message):
         # If the protocol was sent by TCP pass on the complete signal
-        if (self.received_message is not None) and self.received_message.getID() == message.getID():
+        if (self.received_message is not None) and (message is not None) and self.received_message.getID() == message.getID():
             self.tcpServer.sendMessage(message)
             self.received_message = None # Reset the received_message
 
+    # ----------------------------------------------------------------------------------------
+    # Handle a microscope connection: enable the imaging done handshake
+    # ----------------------------------------------------------------------------------------
+    def handleTCPConnection(self):
+        self.kilroyHyperProtocols.engine.setHandshake(True)
+
+    # ----------------------------------------------------------------------------------------
+    # Handle a lost microscope connection: imaging steps use their fallback duration
+    # ----------------------------------------------------------------------------------------
+    def handleTCPDisconnection(self):
+        self.kilroyHyperProtocols.engine.setHandshake(False)
+
     # ----------------------------------------------------------------------------------------
     # Handle protocol request sent via TCP server
     # ----------------------------------------------------------------------------------------
     def handleTCPData(self, message):        
+        # End a running imaging step when the microscope finished imaging
+        if message.getType() == "Kilroy Imaging Done":
+            if not message.isTest() and not self.kilroyHyperProtocols.engine.imagingDone():
+                message.setError(True, "Kilroy is not waiting for imaging")
+            self.tcpServer.sendMessage(message)
         # Confirm that message is a protocol message
-        if not message.getType() == "Kilroy Protocol":
+        elif not message.getType() == "Kilroy Protocol":
             message.setError(True, "Wrong message type sent to Kilroy: " + message.getType())
             self.tcpServer.sendMessage(message)
         elif not self.kilroyHyperProtocols.kilroyProtocols.isValidProtocol(message.getData("name")):
@@ -280,6 +350,8 @@ class StandAlone(QtWidgets.QMainWindow):
 
 # ----------------------------------------------------------------------------------------
 # Runtime code: Kilroy is meant to be run as a stand alone
+#   python kilroy.py [settings.xml]
+#   python kilroy.py --headless settings.xml [protocol or hyperprotocol name]
 # ----------------------------------------------------------------------------------------                                
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
@@ -306,4 +378,5 @@ if __name__ == "__main__":
 
     # Run main app
     window.show()
+    window.kilroy.offerResume(window)
     sys.exit(app.exec_())
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# An append-only checkpoint journal for running protocols and hyperprotocols. The
+# KilroyEngine appends one json line per issued protocol command (hyperprotocol,
+# protocol, command ID, the time the command was issued and the valve/pump commands in
+# effect) and flushes it to disk, so that after a crash or reboot kilroy can resume from
+# the exact command, for the rest of its duration. The journal is emptied when a run
+# completes or is stopped.
+#
+# Lines that were only partially written when kilroy stopped are ignored.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import json
+import os
+import time
+from kilroyConfiguration import HyperProtocolTable, Registry, getStepDuration, loadStep
+
+# ----------------------------------------------------------------------------------------
+# CheckpointJournal Class Definition
+# ----------------------------------------------------------------------------------------
+class CheckpointJournal(object):
+    def __init__(self,
+                 file_path = "kilroy_checkpoint.jsonl",
+                 verbose = False):
+
+        # Initialize internal attributes
+        self.file_path = file_path
+        self.verbose = verbose
+
+    # ------------------------------------------------------------------------------------
+    # Return a one line description of a checkpoint
+    # ------------------------------------------------------------------------------------
+    def describeCheckpoint(self, checkpoint):
+        text = ""
+        if checkpoint["hyperprotocol"] is not None:
+            text += checkpoint["hyperprotocol"] + ", protocol " + str(checkpoint["hyperprotocol_step"]+1) + ": "
+        text += checkpoint["protocol"] + ", command " + str(checkpoint["command_ID"]+1)
+        text += " (" + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(checkpoint["time"])) + ")"
+        return text
+
+    # ------------------------------------------------------------------------------------
+    # Empty the journal: the run is complete
+    # ------------------------------------------------------------------------------------
+    def finish(self):
+        if os.path.isfile(self.file_path):
+            open(self.file_path, "w").close()
+
+    # ------------------------------------------------------------------------------------
+    # Return the last checkpoint of an unfinished run or None. The protocol list of the
+    # hyperprotocol (if any) is added as "hyperprotocol_protocols".
+    # ------------------------------------------------------------------------------------
+    def loadCheckpoint(self):
+        if not os.path.isfile(self.file_path):
+            return None
+
+        checkpoint = None
+        hyperprotocols = {}
+        with open(self.file_path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # Partially written line
+                    continue
+                if entry.get("event") == "hyperprotocol":
+                    hyperprotocols[entry["name"]] = entry["protocols"]
+                elif entry.get("event") == "command":
+                    checkpoint = entry
+
+        if checkpoint is not None:
+            checkpoint["hyperprotocol_protocols"] = hyperprotocols.get(checkpoint["hyperprotocol"])
+        return checkpoint
+
+    # ------------------------------------------------------------------------------------
+    # Append an entry and flush it to disk
+    # ------------------------------------------------------------------------------------
+    def write(self, entry):
+        try:
+            with open(self.file_path, "a") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        except (IOError, OSError) as exception:
+            print("Could not write checkpoint " + self.file_path + ": " + str(exception))
+
+# ----------------------------------------------------------------------------------------
+# Return a hyperprotocol table that contains the hyperprotocol of a checkpoint, adding
+# it from the protocol list saved in the journal if it is not loaded
+# ----------------------------------------------------------------------------------------
+def addCheckpointHyperProtocol(hyperprotocols, checkpoint, protocols):
+    name = checkpoint["hyperprotocol"]
+    if name is None or name in hyperprotocols.names or checkpoint["hyperprotocol_protocols"] is None:
+        return hyperprotocols
+
+    new_protocols = tuple(loadStep(entry) for entry in checkpoint["hyperprotocol_protocols"])
+    new_durations = tuple(getStepDuration(protocols, step_name) for step_name in new_protocols)
+    if None in new_durations:
+        print("Cannot restore hyperprotocol " + name + ": unknown protocols")
+        return hyperprotocols
+
+    return HyperProtocolTable(Registry(list(hyperprotocols.names) + [name], "hyperprotocol"),
+                              hyperprotocols.protocols + (new_protocols,),
+                              hyperprotocols.durations + (new_durations,))
@@ -0,0 +1,618 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A class to parse a kilroy configuration xml file a single time into immutable
+# tables of valve commands, pump commands and protocols. One instance is shared by
+# ValveCommands, PumpCommands, KilroyProtocols and genProtocol so that loading a
+# configuration costs a single parse.
+#
+# Names are held in a Registry (name -> ID dictionary plus the dense tuple of names)
+# so that command dispatch and protocol lookups by name do not scan lists.
+#
+# The parsed tables are also saved to a binary cache next to the xml file
+# (<file>.cache), keyed by the file path, modification time and content hash, so that
+# later launches skip the parse entirely while the file is unchanged.
+#
+# Protocols and valve commands can be templates: every <parameters> child defines one
+# instance per value, and names, command texts, durations and valve/cnc positions are
+# formatted with the parameters. Values are separated by spaces or commas and a-b or
+# a-b:step are inclusive integer ranges. Parameters of the same element are zipped.
+#
+#   <valve_cmd name="Set Hyb {hyb}">
+#     <parameters hyb="1-12" well="8-96:8" />
+#     <parameters hyb="13-24" well="7-95:8" />
+#     <cnc_pos plate_ID="MultiWell" port_ID="{well}" />
+#   </valve_cmd>
+#
+#   <protocol name="Hybridize {hyb}">
+#     <parameters hyb="1-96" />
+#     <valve duration="20">Set Hyb {hyb}</valve>
+#   </protocol>
+#
+# Inside a protocol, <repeat hyb="1-96"> ... </repeat> repeats its commands once per
+# value. Templates and repeats are expanded lazily: a protocol's commands are only
+# built when the protocol is used, and only the most recently used are kept.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import copy
+import hashlib
+import os
+import pickle
+import re
+import sys
+import time
+import xml.etree.ElementTree as elementTree
+from collections import namedtuple
+
+# ----------------------------------------------------------------------------------------
+# Registry Class Definition: an immutable, ordered set of names indexed by ID
+# ----------------------------------------------------------------------------------------
+class Registry(object):
+    def __init__(self, names = (), kind = "name"):
+        self.names = tuple(names)
+        self.ids = {}
+        self.duplicates = []
+
+        # Keep the first occurrence of a name, matching list.index()
+        for ID, name in enumerate(self.names):
+            if name in self.ids:
+                self.duplicates.append(name)
+                print("Duplicate " + kind + " name: " + str(name) + " (entry " + str(ID+1) + " is ignored)")
+            else:
+                self.ids[name] = ID
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __getitem__(self, ID):
+        return self.names[ID]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    # ------------------------------------------------------------------------------------
+    # Return the ID of a name or -1 if it is not registered
+    # ------------------------------------------------------------------------------------
+    def getID(self, name):
+        return self.ids.get(name, -1)
+
+    # ------------------------------------------------------------------------------------
+    # List compatible lookup: raises ValueError if the name is not registered
+    # ------------------------------------------------------------------------------------
+    def index(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            raise ValueError(str(name) + " is not registered")
+
+# ----------------------------------------------------------------------------------------
+# LazyProtocols Class Definition: the commands and durations of protocols indexed by ID.
+# An entry is either (commands, durations) or a ProtocolBody, which is expanded when it
+# is used. The fields of a ProtocolTable are views over this class.
+# ----------------------------------------------------------------------------------------
+ProtocolBody = namedtuple("ProtocolBody", ["body", "parameters"])
+
+class LazyProtocols(object):
+    def __init__(self, entries = (), cache_size = 16):
+        self.entries = tuple(entries)
+        self.cache_size = cache_size
+        self.expanded = {}          # Protocol ID: (commands, durations)
+        self.total_durations = {}   # Protocol ID: total duration (s)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["expanded"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    # ------------------------------------------------------------------------------------
+    # Return (commands, durations) of a protocol, expanding it if needed
+    # ------------------------------------------------------------------------------------
+    def expand(self, ID):
+        entry = self.entries[ID]
+        if not isinstance(entry, ProtocolBody):
+            return entry
+        expanded = self.expanded.get(ID)
+        if expanded is None:
+            expanded = expandProtocolBody(entry.body, entry.parameters)
+            if len(self.expanded) >= self.cache_size:
+                self.expanded.clear()
+            self.expanded[ID] = expanded
+        return expanded
+
+    # ------------------------------------------------------------------------------------
+    # Return a view of one field: "commands", "durations" or "total_durations"
+    # ------------------------------------------------------------------------------------
+    def getField(self, field):
+        return LazyProtocolField(self, field)
+
+    # ------------------------------------------------------------------------------------
+    # Return the total duration (s) of a protocol
+    # ------------------------------------------------------------------------------------
+    def getTotalDuration(self, ID):
+        total_duration = self.total_durations.get(ID)
+        if total_duration is None:
+            total_duration = sum(self.expand(ID)[1])
+            self.total_durations[ID] = total_duration
+        return total_duration
+
+# ----------------------------------------------------------------------------------------
+# LazyProtocolField Class Definition: a read only sequence over one LazyProtocols field
+# ----------------------------------------------------------------------------------------
+class LazyProtocolField(object):
+    def __init__(self, protocols, field):
+        self.protocols = protocols
+        self.field = field
+
+    def __getitem__(self, ID):
+        if isinstance(ID, slice):
+            return tuple(self[i] for i in range(*ID.indices(len(self))))
+        if ID < 0:
+            ID += len(self)
+        if self.field == "total_durations":
+            return self.protocols.getTotalDuration(ID)
+        return self.protocols.expand(ID)[self.field == "durations"]
+
+    def __iter__(self):
+        for ID in range(len(self)):
+            yield self[ID]
+
+    def __len__(self):
+        return len(self.protocols)
+
+# ----------------------------------------------------------------------------------------
+# Parsed tables: names are a Registry, other fields are dense tuples indexed by ID (or
+# LazyProtocols views for protocols)
+# ----------------------------------------------------------------------------------------
+ValveCommandTable = namedtuple("ValveCommandTable", ["names", "commands", "num_valves", "cnc"])
+PumpCommandTable = namedtuple("PumpCommandTable", ["names", "commands", "num_pumps"])
+ProtocolTable = namedtuple("ProtocolTable", ["names", "commands", "durations", "total_durations"])
+HyperProtocolTable = namedtuple("HyperProtocolTable", ["names", "protocols", "durations"])
+
+# Increment when the layout of the tables changes to invalidate existing caches
+CACHE_VERSION = 3
+
+# ----------------------------------------------------------------------------------------
+# KilroyConfiguration Class Definition
+# ----------------------------------------------------------------------------------------
+class KilroyConfiguration(object):
+    def __init__(self,
+                 xml_file_path = "default_config.xml",
+                 use_cache = True,
+                 verbose = False):
+
+        # Initialize internal attributes
+        self.verbose = verbose
+        self.xml_file_path = xml_file_path
+        self.cache_file_path = xml_file_path + ".cache"
+        self.xml_tree = None
+        self.loaded_from_cache = False
+
+        # Read file: raises if the file is missing
+        with open(self.xml_file_path, "rb") as xml_file:
+            xml_data = xml_file.read()
+        self.cache_key = self.createCacheKey(xml_data)
+
+        # Use the compiled tables if the file is unchanged
+        if use_cache and self.loadCache():
+            return
+
+        # Parse XML: raises if the file is not valid xml
+        print("Parsing configuration: " + self.xml_file_path)
+        self.xml_tree = elementTree.ElementTree(elementTree.fromstring(xml_data))
+        kilroy_configuration = self.xml_tree.getroot()
+
+        # Build tables
+        self.valve_commands = self.parseValveCommands(kilroy_configuration)
+        self.pump_commands = self.parsePumpCommands(kilroy_configuration)
+        self.protocols = self.parseProtocols(kilroy_configuration)
+
+        if use_cache:
+            self.saveCache()
+
+    # ------------------------------------------------------------------------------------
+    # Return a copy of the parsed xml root that callers are free to modify
+    # ------------------------------------------------------------------------------------
+    def copyXMLRoot(self):
+        if self.xml_tree is None: # Loaded from cache
+            self.xml_tree = elementTree.parse(self.xml_file_path)
+        return copy.deepcopy(self.xml_tree.getroot())
+
+    # ------------------------------------------------------------------------------------
+    # Identify the file by absolute path, modification time and content hash
+    # ------------------------------------------------------------------------------------
+    def createCacheKey(self, xml_data):
+        return (CACHE_VERSION,
+                os.path.abspath(self.xml_file_path),
+                os.path.getmtime(self.xml_file_path),
+                hashlib.sha1(xml_data).hexdigest())
+
+    # ------------------------------------------------------------------------------------
+    # Load tables from the cache: returns False if missing, stale or unreadable
+    # ------------------------------------------------------------------------------------
+    def loadCache(self):
+        if not os.path.isfile(self.cache_file_path):
+            return False
+        try:
+            with open(self.cache_file_path, "rb") as cache_file:
+                [cache_key, valve_commands, pump_commands, protocols] = pickle.load(cache_file)
+        except Exception as exception:
+            print("Ignoring unreadable cache " + self.cache_file_path + ": " + str(exception))
+            return False
+
+        if cache_key != self.cache_key:
+            if self.verbose:
+                print("Configuration changed, rebuilding " + self.cache_file_path)
+            return False
+
+        self.valve_commands = ValveCommandTable(Registry(valve_commands[0], "valve command"), *valve_commands[1:])
+        self.pump_commands = PumpCommandTable(Registry(pump_commands[0], "pump command"), *pump_commands[1:])
+        self.protocols = ProtocolTable(Registry(protocols[0], "protocol"), *protocols[1:])
+        self.loaded_from_cache = True
+        if self.verbose:
+            print("Loaded configuration from cache: " + self.cache_file_path)
+        return True
+
+    # ------------------------------------------------------------------------------------
+    # Save tables to the cache: tables are stored as plain tuples
+    # ------------------------------------------------------------------------------------
+    def saveCache(self):
+        cache_data = [self.cache_key]
+        for table in [self.valve_commands, self.pump_commands, self.protocols]:
+            cache_data.append((table.names.names,) + tuple(table[1:]))
+        try:
+            with open(self.cache_file_path, "wb") as cache_file:
+                pickle.dump(cache_data, cache_file, pickle.HIGHEST_PROTOCOL)
+        except Exception as exception:
+            print("Could not write cache " + self.cache_file_path + ": " + str(exception))
+
+    # ------------------------------------------------------------------------------------
+    # Parse the body of a protocol: ("command", tag, duration, text) and ("repeat",
+    # parameter sets, body) items. Returns the body and whether it contains a repeat.
+    # ------------------------------------------------------------------------------------
+    def parseProtocolBody(self, element):
+        body = []
+        has_repeat = False
+        for command in element: # Get all children
+            if command.tag == "parameters":
+                continue
+            elif command.tag == "repeat":
+                repeat_body = self.parseProtocolBody(command)[0]
+                body.append(("repeat", parseParameterSets(command.attrib), repeat_body))
+                has_repeat = True
+            else:
+                body.append(("command", command.tag, command.get("duration"), command.text))
+                if (not (command.tag == "pump")) and (not (command.tag == "valve")):
+                    print("Unknown command tag: " + command.tag)
+        return [tuple(body), has_repeat]
+
+    # ------------------------------------------------------------------------------------
+    # Parse pump commands: [direction, speed]
+    # ------------------------------------------------------------------------------------
+    def parsePumpCommands(self, kilroy_configuration):
+        command_names = []
+        commands = []
+
+        # Load number of pumps
+        num_pumps = int(kilroy_configuration.get("num_pumps", 0))
+        if not (num_pumps > 0):
+            print("Number of pumps not specified")
+
+        # Load commands
+        for pump_command in kilroy_configuration.findall("pump_commands"):
+            for command in pump_command.findall("pump_cmd"):
+                direction = "Stopped"
+                speed = 0.0
+                for pump_config in command.findall("pump_config"):
+                    speed = float(pump_config.get("speed"))
+                    direction = pump_config.get("direction")
+                    if speed < 0.00 or speed > 48.0:
+                        speed = 0.0
+                        direction = "Stopped" # Flag for stopped flow
+                    direction = {"Forward": "Forward", "Reverse": "Reverse"}.get(direction, "Stopped")
+
+                commands.append((direction, speed))
+                command_names.append(command.get("name"))
+
+        return PumpCommandTable(Registry(command_names, "pump command"), tuple(commands), num_pumps)
+
+    # ------------------------------------------------------------------------------------
+    # Parse protocols: commands are (Instrument Type, Command Name)
+    # ------------------------------------------------------------------------------------
+    def parseProtocols(self, kilroy_configuration):
+        protocol_names = []
+        protocol_entries = []
+
+        for kilroy_protocols in kilroy_configuration.findall("kilroy_protocols"):
+            for protocol in kilroy_protocols.findall("protocol"):
+                [body, has_repeat] = self.parseProtocolBody(protocol)
+                parameter_sets = parseTemplateParameters(protocol)
+
+                # Plain protocols are expanded now, templates and repeats when used
+                if parameter_sets is None and not has_repeat:
+                    protocol_names.append(protocol.get("name"))
+                    protocol_entries.append(expandProtocolBody(body, {}))
+                    continue
+
+                # Check the template once with the first instance
+                parameter_sets = parameter_sets or [{}]
+                expandProtocolBody(body, parameter_sets[0])
+                for parameters in parameter_sets:
+                    protocol_names.append(formatTemplate(protocol.get("name"), parameters))
+                    protocol_entries.append(ProtocolBody(body, parameters))
+
+        protocols = LazyProtocols(protocol_entries)
+        return ProtocolTable(Registry(protocol_names, "protocol"),
+                             protocols.getField("commands"),
+                             protocols.getField("durations"),
+                             protocols.getField("total_durations"))
+
+    # ------------------------------------------------------------------------------------
+    # Parse valve commands: one port per valve (-1 = no change), then (plate, well) for
+    # the cnc if present
+    # ------------------------------------------------------------------------------------
+    def parseValveCommands(self, kilroy_configuration):
+        command_names = []
+        commands = []
+
+        # Load number of valves
+        num_valves = int(kilroy_configuration.get("num_valves", 0))
+        if not (num_valves > 0):
+            print("Number of valves not specified")
+
+        cnc = bool(kilroy_configuration.get("cnc", False))
+
+        for valve_command in kilroy_configuration.findall("valve_commands"):
+            for command in valve_command.findall("valve_cmd"):
+                # Valve command templates are small and shown as buttons: expand them now
+                for parameters in parseTemplateParameters(command) or [{}]:
+                    name = formatTemplate(command.get("name"), parameters)
+                    new_command = [-1]*(num_valves + cnc) # initialize config with default
+                    for valve_pos in command.findall("valve_pos"):
+                        valve_ID = int(formatTemplate(valve_pos.get("valve_ID"), parameters)) - 1
+                        port_ID = int(formatTemplate(valve_pos.get("port_ID"), parameters)) - 1
+                        if valve_ID < num_valves:
+                            new_command[valve_ID] = port_ID
+                        else:
+                            print("Valve out of range on command: " + name)
+
+                    for cnc_pos in command.findall("cnc_pos"):
+                        port_ID = int(formatTemplate(cnc_pos.get("port_ID"), parameters)) - 1
+                        plate_ID = formatTemplate(cnc_pos.get("plate_ID"), parameters)
+                        new_command[num_valves] = (plate_ID, port_ID)
+
+                    commands.append(tuple(new_command))
+                    command_names.append(name)
+
+        return ValveCommandTable(Registry(command_names, "valve command"), tuple(commands), num_valves, cnc)
+
+# ----------------------------------------------------------------------------------------
+# Expand a protocol body with parameters into (commands, durations)
+# ----------------------------------------------------------------------------------------
+def expandProtocolBody(body, parameters):
+    commands = []
+    durations = []
+    appendProtocolBody(body, parameters, commands, durations)
+    return (tuple(commands), tuple(durations))
+
+def appendProtocolBody(body, parameters, commands, durations):
+    for item in body:
+        if item[0] == "repeat":
+            for repeat_parameters in item[1]:
+                merged_parameters = dict(parameters)
+                merged_parameters.update(repeat_parameters)
+                appendProtocolBody(item[2], merged_parameters, commands, durations)
+        else:
+            [tag, duration, text] = item[1:]
+            durations.append(int(formatTemplate(duration, parameters)))
+            commands.append((tag, formatTemplate(text, parameters)))
+
+# ----------------------------------------------------------------------------------------
+# Format a template string with parameters: strings without parameters are unchanged
+# ----------------------------------------------------------------------------------------
+def formatTemplate(text, parameters):
+    if not parameters or text is None:
+        return text
+    try:
+        return text.format(**parameters)
+    except (KeyError, IndexError, ValueError) as exception:
+        raise ValueError("Cannot format " + text + " with " + str(parameters) + ": " + str(exception))
+
+# ----------------------------------------------------------------------------------------
+# Parse parameter values: "1 2 5", "1,2,5", "1-12" or "8-96:8" (inclusive ranges)
+# ----------------------------------------------------------------------------------------
+RANGE_PATTERN = re.compile(r"^(\d+)-(\d+)(?::(\d+))?$")
+
+def parseValues(text):
+    values = []
+    for token in text.replace(",", " ").split():
+        match = RANGE_PATTERN.match(token)
+        if match is None:
+            values.append(token)
+            continue
+        [start, stop] = [int(match.group(1)), int(match.group(2))]
+        step = int(match.group(3) or 1) * (1 if stop >= start else -1)
+        values.extend(str(value) for value in range(start, stop + step, step))
+    return values
+
+# ----------------------------------------------------------------------------------------
+# Parse the attributes of a <parameters> or <repeat> element into one dictionary per
+# instance: the values of all attributes are zipped
+# ----------------------------------------------------------------------------------------
+def parseParameterSets(attributes):
+    names = list(attributes.keys())
+    values = [parseValues(attributes[name]) for name in names]
+    if len(set(len(value_list) for value_list in values)) > 1:
+        raise ValueError("Parameters have different numbers of values: " + ", ".join(names))
+    if not values:
+        return []
+    return [dict(zip(names, instance_values)) for instance_values in zip(*values)]
+
+# ----------------------------------------------------------------------------------------
+# Return the parameter sets of a template element or None if it is not a template
+# ----------------------------------------------------------------------------------------
+def parseTemplateParameters(element):
+    parameters_elements = element.findall("parameters")
+    if not parameters_elements:
+        return None
+    parameter_sets = []
+    for parameters in parameters_elements:
+        parameter_sets.extend(parseParameterSets(parameters.attrib))
+    return parameter_sets
+
+# ----------------------------------------------------------------------------------------
+# Load a configuration, returning None (and keeping the caller's previous state) if the
+# file could not be parsed
+# ----------------------------------------------------------------------------------------
+def loadConfiguration(xml_file_path, use_cache = True, verbose = False):
+    try:
+        return KilroyConfiguration(xml_file_path = xml_file_path,
+                                   use_cache = use_cache,
+                                   verbose = verbose)
+    except Exception as exception:
+        print("Valid xml file not loaded: " + str(exception))
+        return None
+
+# ----------------------------------------------------------------------------------------
+# Hyperprotocol steps are typed, so that protocols can have any name:
+#
+#   "protocol"  a protocol of the protocol table (duration from the table)
+#   "wait"      <wait duration="3600"/>: the engine waits for the duration without
+#               running a protocol or issuing commands
+#   "imaging"   <wait_imaging timeout="3600" fallback="1200"/>: the engine waits until the
+#               microscope reports that imaging is done (for at most timeout s). Without a
+#               microscope connection it waits for the fallback duration (duration).
+#
+# The name of a step is displayed and journaled (e.g. "Wait 3600 s"), but never parsed.
+# ----------------------------------------------------------------------------------------
+class HyperProtocolStep(namedtuple("HyperProtocolStep", ["kind", "name", "duration", "timeout"])):
+    __slots__ = ()
+
+    def __str__(self):
+        return str(self.name)
+
+def protocolStep(protocol_name):
+    return HyperProtocolStep("protocol", protocol_name, None, None)
+
+def waitStep(duration):
+    return HyperProtocolStep("wait", "Wait " + str(int(duration)) + " s", int(duration), None)
+
+def imagingStep(timeout, fallback):
+    name = "Wait Imaging (timeout " + str(int(timeout)) + " s, fallback " + str(int(fallback)) + " s)"
+    return HyperProtocolStep("imaging", name, int(fallback), int(timeout))
+
+# ----------------------------------------------------------------------------------------
+# Return a step saved as a list (e.g. in the checkpoint journal); a plain name is a
+# protocol step
+# ----------------------------------------------------------------------------------------
+def loadStep(entry):
+    if isinstance(entry, str):
+        return protocolStep(entry)
+    return HyperProtocolStep._make(entry)
+
+# ----------------------------------------------------------------------------------------
+# Return the duration (s) of a hyperprotocol step (the fallback duration of an imaging
+# step) or None if it is a protocol that is not in the protocol table
+# ----------------------------------------------------------------------------------------
+def getStepDuration(protocols, step):
+    if step.kind != "protocol":
+        return step.duration
+    protocol_ID = protocols.names.getID(step.name)
+    if protocol_ID < 0:
+        return None
+    return protocols.total_durations[protocol_ID]
+
+# ----------------------------------------------------------------------------------------
+# Parse a hyperprotocol xml file: each hyperprotocol is a list of HyperProtocolSteps
+# (protocols, waits or imaging waits) whose durations are taken from the protocol table.
+# Unknown protocols are skipped and empty hyperprotocols are ignored. Returns None if the
+# file could not be parsed.
+# ----------------------------------------------------------------------------------------
+def loadHyperProtocols(xml_file_path, protocols):
+    try:
+        print("Parsing for hyperprotocols: " + xml_file_path)
+        kilroy_configuration = elementTree.parse(xml_file_path).getroot()
+    except Exception:
+        print("Valid xml file not loaded")
+        return None
+
+    hyperprotocol_names = []
+    hyperprotocol_protocols = []
+    hyperprotocol_durations = []
+    for kilroy_hyperprotocols in kilroy_configuration.findall("kilroy_hyperprotocols"):
+        for hyperprotocol in kilroy_hyperprotocols.findall("hyperprotocol"):
+            new_steps = []
+            new_protocol_durations = []
+            for protocol in hyperprotocol:
+                if protocol.tag in ["wait", "wait_imaging"]:
+                    try:
+                        if protocol.tag == "wait":
+                            step = waitStep(protocol.get("duration"))
+                        else:
+                            step = imagingStep(protocol.get("timeout"), protocol.get("fallback"))
+                    except (TypeError, ValueError):
+                        print("Invalid wait duration in hyperprotocol " + str(hyperprotocol.get("name")))
+                        continue
+                else:
+                    step = protocolStep(protocol.get("name"))
+                duration = getStepDuration(protocols, step)
+                if duration is not None:
+                    new_steps.append(step)
+                    new_protocol_durations.append(duration)
+                else:
+                    print("Unknown protocol in hyperprotocol " + str(hyperprotocol.get("name")) + ": " + str(step))
+
+            if new_steps:
+                hyperprotocol_names.append(hyperprotocol.get("name"))
+                hyperprotocol_protocols.append(tuple(new_steps))
+                hyperprotocol_durations.append(tuple(new_protocol_durations))
+
+    return HyperProtocolTable(Registry(hyperprotocol_names, "hyperprotocol"),
+                              tuple(hyperprotocol_protocols),
+                              tuple(hyperprotocol_durations))
+
+# ----------------------------------------------------------------------------------------
+# Benchmark cold (xml parse) versus warm (cache) loading of a configuration
+# ----------------------------------------------------------------------------------------
+def benchmarkLoad(xml_file_path, repeats = 20):
+    cold_times = []
+    warm_times = []
+    KilroyConfiguration(xml_file_path) # Ensure the cache exists
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        KilroyConfiguration(xml_file_path, use_cache = False)
+        cold_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        configuration = KilroyConfiguration(xml_file_path)
+        warm_times.append(time.perf_counter() - start_time)
+        assert configuration.loaded_from_cache
+
+    cold_time = 1000.0*min(cold_times)
+    warm_time = 1000.0*min(warm_times)
+    print("Cold load (xml parse): " + "%0.2f" % cold_time + " ms")
+    print("Warm load (cache):     " + "%0.2f" % warm_time + " ms")
+    print("Speed up:              " + "%0.1f" % (cold_time/warm_time) + "x")
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class: python kilroyConfiguration.py [xml_file] [--benchmark]
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    arguments = [argument for argument in sys.argv[1:] if argument != "--benchmark"]
+    xml_file_path = arguments[0] if arguments else "default_config.xml"
+
+    if "--benchmark" in sys.argv:
+        benchmarkLoad(xml_file_path)
+    else:
+        configuration = loadConfiguration(xml_file_path)
+        if configuration is not None:
+            print(str(len(configuration.valve_commands.names)) + " valve commands")
+            print(str(len(configuration.pump_commands.names)) + " pump commands")
+            print(str(len(configuration.protocols.names)) + " protocols")
@@ -0,0 +1,792 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A pure python engine that owns the protocol and hyperprotocol state machines of
+# kilroy. It does not depend on Qt: the GUI classes (KilroyProtocols and
+# KilroyHyperProtocols) are thin views over an engine, and kilroyHeadless runs an
+# engine without any widgets.
+#
+# Commands are issued on a worker thread against the absolute deadlines computed by a
+# ProtocolScheduler. Every state change is reported to the registered listeners as a
+# KilroyEvent(event_type, time, data):
+#
+#   "command"                 a valve or pump command should be sent to the devices
+#   "status"                  the protocol and/or hyperprotocol status changed
+#   "protocol complete"       a protocol finished (or was stopped)
+#   "hyperprotocol complete"  a hyperprotocol finished (or was stopped)
+#   "imaging done"            an imaging step ended: elapsed and saved time (s)
+#
+# Listeners are called outside of the engine lock, either from the thread that called
+# the engine or from the worker thread, so they are free to call back into the engine.
+#
+# A hyperprotocol step is either a protocol or a wait step ("Wait 3600 s"), during which
+# the engine simply waits for the step duration without issuing commands. An imaging
+# step waits until imagingDone() is called (e.g. when the microscope sends an "imaging
+# done" TCP message) or its timeout expires, if the host enabled the handshake with
+# setHandshake(); otherwise it waits for its fallback duration.
+#
+# With a VirtualClock the worker thread jumps straight to each deadline instead of
+# sleeping, so whole hyperprotocols can be simulated in seconds.
+#
+# A host can set a duration estimator (setDurationEstimator) that gives the time the
+# devices need for a command, e.g. a long robot needle move. A protocol command that
+# takes longer than its configured duration delays the rest of the protocol.
+#
+# If a CheckpointJournal is set, every protocol command is journaled so that a run
+# interrupted by a crash can be resumed from the exact command with resume().
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import threading
+import time
+import traceback
+from collections import namedtuple
+from kilroyConfiguration import HyperProtocolTable, ProtocolTable, Registry, loadStep, protocolStep
+from protocolScheduler import ProtocolScheduler
+
+KilroyEvent = namedtuple("KilroyEvent", ["event_type", "time", "data"])
+
+# ----------------------------------------------------------------------------------------
+# MonotonicClock Class Definition: wall clock time for the engine
+# ----------------------------------------------------------------------------------------
+class MonotonicClock(object):
+
+    # ------------------------------------------------------------------------------------
+    # Return the current time (s)
+    # ------------------------------------------------------------------------------------
+    def now(self):
+        return time.monotonic()
+
+    # ------------------------------------------------------------------------------------
+    # Wait on a (held) condition for at most timeout seconds (None = until notified)
+    # ------------------------------------------------------------------------------------
+    def wait(self, condition, timeout):
+        condition.wait(timeout)
+
+# ----------------------------------------------------------------------------------------
+# VirtualClock Class Definition: simulated time that jumps to the next deadline
+# ----------------------------------------------------------------------------------------
+class VirtualClock(object):
+    def __init__(self, start_time = 0.0):
+        self.time = start_time
+
+    # ------------------------------------------------------------------------------------
+    # Return the current (simulated) time (s)
+    # ------------------------------------------------------------------------------------
+    def now(self):
+        return self.time
+
+    # ------------------------------------------------------------------------------------
+    # Advance time by timeout seconds without waiting (None = wait until notified)
+    # ------------------------------------------------------------------------------------
+    def wait(self, condition, timeout):
+        if timeout is None:
+            condition.wait()
+        else:
+            self.time += max(0.0, timeout)
+
+# ----------------------------------------------------------------------------------------
+# KilroyEngine Class Definition
+# ----------------------------------------------------------------------------------------
+class KilroyEngine(object):
+    def __init__(self,
+                 configuration = None,
+                 clock = None,
+                 verbose = False):
+
+        # Initialize internal attributes
+        self.verbose = verbose
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.scheduler = ProtocolScheduler(clock = self.clock.now, verbose = self.verbose)
+        self.condition = threading.Condition(threading.RLock())
+        self.dispatch_lock = threading.RLock()
+        self.listeners = []
+        self.pending_events = []
+        self.thread = None
+        self.running = False
+
+        self.protocols = ProtocolTable(Registry(kind = "protocol"), (), (), ())
+        self.hyperprotocols = HyperProtocolTable(Registry(kind = "hyperprotocol"), (), ())
+        self.valve_commands = None
+        self.pump_commands = None
+        self.status = [-1, -1]          # Protocol ID, command ID within protocol
+        self.hyper_status = [-1, -1]    # Hyperprotocol ID, protocol ID within hyperprotocol
+        self.wait_step = None           # Running hyperprotocol wait or imaging step
+        self.handshake = False          # Imaging steps wait for imagingDone()
+        self.imaging_fallback = None    # Fallback duration of the running imaging step
+        self.imaging_saved = []         # Time saved (s) by each imaging step of the hyperprotocol
+        self.message = None             # Request that started the protocol (e.g. TCP message)
+        self.issued_command = []
+        self.last_commands = {"valve": None, "pump": None} # Names of the commands in effect
+        self.journal = None
+        self.duration_estimator = None  # (instrument, command): estimated device time (s)
+
+        if configuration is not None:
+            self.setCommands(configuration.valve_commands, configuration.pump_commands)
+            self.setProtocols(configuration.protocols)
+
+    # ------------------------------------------------------------------------------------
+    # Register a listener: called with a KilroyEvent for every engine event
+    # ------------------------------------------------------------------------------------
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    # ------------------------------------------------------------------------------------
+    # Advance the hyperprotocol to the next protocol, chained on the scheduled end of
+    # the previous protocol to avoid drift
+    # ------------------------------------------------------------------------------------
+    def advanceHyperProtocol(self):
+        [hyperprotocol_ID, protocol_ID] = self.hyper_status
+        protocol_ID += 1
+        if protocol_ID < len(self.hyperprotocols.protocols[hyperprotocol_ID]):
+            self.hyper_status = [hyperprotocol_ID, protocol_ID]
+            if not self.beginStep(self.hyperprotocols.protocols[hyperprotocol_ID][protocol_ID],
+                                  start_time = self.scheduler.getEndTime()):
+                self.endHyperProtocol()
+        else:
+            self.endHyperProtocol()
+
+    # ------------------------------------------------------------------------------------
+    # Advance the protocol to the next command and issue it
+    # ------------------------------------------------------------------------------------
+    def advanceProtocol(self):
+        [protocol_ID, command_ID] = self.status
+        command_ID += 1
+        if command_ID < len(self.protocols.commands[protocol_ID]):
+            self.status = [protocol_ID, command_ID]
+            self.issueProtocolCommand()
+        else:
+            self.endProtocol()
+
+    # ------------------------------------------------------------------------------------
+    # Start a hyperprotocol (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def beginHyperProtocol(self, hyperprotocol_ID):
+        if self.isRunningHyperProtocol():
+            self.endHyperProtocol()
+
+        if self.verbose:
+            print("Starting " + self.hyperprotocols.names[hyperprotocol_ID])
+        self.hyper_status = [hyperprotocol_ID, 0]
+        self.imaging_saved = []
+        self.writeHyperProtocolCheckpoint()
+        if not self.beginStep(self.hyperprotocols.protocols[hyperprotocol_ID][0]):
+            self.endHyperProtocol()
+
+    # ------------------------------------------------------------------------------------
+    # Start a protocol by name and issue its first command (engine lock held). A
+    # protocol resumed at command_ID is scheduled as if that command was issued at
+    # start_time (default now).
+    # ------------------------------------------------------------------------------------
+    def beginProtocol(self, protocol_name, message = None, start_time = None, command_ID = 0):
+        protocol_ID = self.protocols.names.getID(protocol_name)
+        if protocol_ID < 0:
+            print(str(protocol_name) + " is not a valid protocol")
+            return False
+
+        if self.isRunningProtocol():
+            if self.verbose:
+                print("Stopped In Progress: " + self.protocols.names[self.status[0]])
+            self.endProtocol(advance_hyperprotocol = False) # Abort protocol in progress
+        self.endWait(advance_hyperprotocol = False)
+
+        if self.verbose:
+            print("Starting " + protocol_name)
+
+        # Schedule all commands of the protocol
+        self.status = [protocol_ID, command_ID]
+        self.message = message
+        self.scheduler.start(self.protocols.durations[protocol_ID], start_time = start_time)
+        if command_ID > 0:
+            self.scheduler.rebase(command_ID, issue_time = start_time)
+        self.emit("status", self.getStatusData())
+
+        self.issueProtocolCommand()
+        return True
+
+    # ------------------------------------------------------------------------------------
+    # Start a hyperprotocol step: a protocol, wait or imaging step (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def beginStep(self, step, start_time = None, command_ID = 0):
+        if step.kind == "wait":
+            return self.beginWait(step, step.duration, start_time)
+        if step.kind == "imaging":
+            if not self.handshake:
+                return self.beginWait(step, step.duration, start_time)
+            return self.beginWait(step, step.timeout, start_time, imaging_fallback = step.duration)
+        return self.beginProtocol(step.name, start_time = start_time, command_ID = command_ID)
+
+    # ------------------------------------------------------------------------------------
+    # Start a wait step: a single scheduled interval without commands (engine lock held).
+    # An imaging step (imaging_fallback is not None) ends early on imagingDone().
+    # ------------------------------------------------------------------------------------
+    def beginWait(self, step, duration, start_time = None, imaging_fallback = None):
+        if self.isRunningProtocol():
+            self.endProtocol(advance_hyperprotocol = False)
+
+        if self.verbose:
+            print("Starting " + str(step))
+        self.wait_step = step
+        self.imaging_fallback = imaging_fallback
+        self.scheduler.start([duration], start_time = start_time)
+        self.emit("status", self.getStatusData())
+        self.writeCheckpoint()
+
+        # Wake the worker thread: the next deadline changed
+        self.condition.notify_all()
+        return True
+
+    # ------------------------------------------------------------------------------------
+    # Stop the engine thread
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # ------------------------------------------------------------------------------------
+    # Send pending events to the listeners (never called with the engine lock held). An
+    # exception raised by a listener is printed and does not stop the engine or keep the
+    # other listeners from the event.
+    # ------------------------------------------------------------------------------------
+    def dispatchEvents(self):
+        with self.dispatch_lock:
+            while True:
+                with self.condition:
+                    if not self.pending_events:
+                        return
+                    event = self.pending_events.pop(0)
+                for listener in self.listeners:
+                    try:
+                        listener(event)
+                    except Exception:
+                        print("Kilroy listener failed on " + event.event_type + " event:")
+                        traceback.print_exc()
+
+    # ------------------------------------------------------------------------------------
+    # Queue an event for the listeners
+    # ------------------------------------------------------------------------------------
+    def emit(self, event_type, data = None):
+        self.pending_events.append(KilroyEvent(event_type, self.clock.now(), data))
+
+    # ------------------------------------------------------------------------------------
+    # Stop a running hyperprotocol (engine lock held). The protocol in progress is not
+    # stopped.
+    # ------------------------------------------------------------------------------------
+    def endHyperProtocol(self):
+        if not self.isRunningHyperProtocol():
+            return
+        hyperprotocol_name = self.hyperprotocols.names[self.hyper_status[0]]
+        if self.verbose: print("Stopped Hyperprotocol")
+
+        self.endWait(advance_hyperprotocol = False)
+        self.hyper_status = [-1, -1]
+        self.emit("status", self.getStatusData())
+        self.emit("hyperprotocol complete", {"name": hyperprotocol_name})
+        self.finishJournal()
+
+    # ------------------------------------------------------------------------------------
+    # End an imaging step and report the time saved relative to its fallback duration
+    # (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def endImaging(self, timed_out = False):
+        elapsed = self.clock.now() - self.scheduler.start_time
+        saved = max(0.0, self.imaging_fallback - elapsed) # Nothing saved on a timeout
+        self.imaging_saved.append(saved)
+        if timed_out:
+            print("No imaging done message after " + "%0.1f" % elapsed + " s")
+        text = "Imaging step " + str(len(self.imaging_saved)) + " took " + "%0.1f" % elapsed + " s, "
+        text += "%0.1f" % saved + " s saved (" + "%0.1f" % sum(self.imaging_saved) + " s in total)"
+        print(text)
+        self.emit("imaging done", {"step": self.hyper_status[1],
+                                   "elapsed": elapsed,
+                                   "saved": saved,
+                                   "total_saved": sum(self.imaging_saved),
+                                   "timed_out": timed_out})
+        self.endWait()
+
+    # ------------------------------------------------------------------------------------
+    # Stop a running protocol either on completion or early (engine lock held). A
+    # running hyperprotocol moves on to its next protocol.
+    # ------------------------------------------------------------------------------------
+    def endProtocol(self, advance_hyperprotocol = True):
+        if not self.isRunningProtocol():
+            return
+        protocol_name = self.protocols.names[self.status[0]]
+        message = self.message
+        if self.verbose: print("Stopped Protocol")
+        print("Protocol timing: " + self.scheduler.getSummary())
+
+        # Reset status
+        self.status = [-1, -1]
+        self.message = None
+        self.emit("status", self.getStatusData())
+        self.emit("protocol complete", {"name": protocol_name, "message": message})
+
+        if advance_hyperprotocol and self.isRunningHyperProtocol():
+            self.advanceHyperProtocol()
+        self.finishJournal()
+
+    # ------------------------------------------------------------------------------------
+    # Stop a running wait step either on completion or early (engine lock held). A
+    # running hyperprotocol moves on to its next step.
+    # ------------------------------------------------------------------------------------
+    def endWait(self, advance_hyperprotocol = True):
+        if not self.isWaiting():
+            return
+        if self.verbose: print("Stopped " + str(self.wait_step))
+
+        self.wait_step = None
+        self.imaging_fallback = None
+        self.emit("status", self.getStatusData())
+
+        if advance_hyperprotocol and self.isRunningHyperProtocol():
+            self.advanceHyperProtocol()
+        self.finishJournal()
+
+    # ------------------------------------------------------------------------------------
+    # Return the estimated device time (s) of a command, 0 without an estimator. An
+    # exception raised by the estimator is printed and does not stop the engine.
+    # ------------------------------------------------------------------------------------
+    def estimateDuration(self, instrument, command):
+        if self.duration_estimator is None:
+            return 0.0
+        try:
+            return self.duration_estimator(instrument, command)
+        except Exception:
+            print("Kilroy duration estimator failed on " + str(command) + ":")
+            traceback.print_exc()
+            return 0.0
+
+    # ------------------------------------------------------------------------------------
+    # Empty the checkpoint journal once nothing is running (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def finishJournal(self):
+        if self.journal is None:
+            return
+        if not (self.isRunningProtocol() or self.isWaiting() or self.isRunningHyperProtocol()):
+            self.journal.finish()
+
+    # ------------------------------------------------------------------------------------
+    # Return current command: [Instrument Type, command]
+    # ------------------------------------------------------------------------------------
+    def getCurrentCommand(self):
+        return self.issued_command
+
+    # ------------------------------------------------------------------------------------
+    # Return hyperprotocol status
+    # ------------------------------------------------------------------------------------
+    def getHyperStatus(self):
+        with self.condition:
+            return list(self.hyper_status) # [hyperprotocol_ID, protocol_ID] -1 = no active hyperprotocol
+
+    # ------------------------------------------------------------------------------------
+    # Return the scheduled end time of the last protocol (engine clock)
+    # ------------------------------------------------------------------------------------
+    def getProtocolEndTime(self):
+        return self.scheduler.getEndTime()
+
+    # ------------------------------------------------------------------------------------
+    # Return protocol status
+    # ------------------------------------------------------------------------------------
+    def getStatus(self):
+        with self.condition:
+            return list(self.status) # [protocol_ID, command_ID] -1 = no active protocol
+
+    # ------------------------------------------------------------------------------------
+    # Return a snapshot of the protocol and hyperprotocol status for events
+    # ------------------------------------------------------------------------------------
+    def getStatusData(self):
+        return {"status": list(self.status),
+                "hyper_status": list(self.hyper_status)}
+
+    # ------------------------------------------------------------------------------------
+    # Return the time (s) until the current command or wait step ends or None if neither
+    # is running
+    # ------------------------------------------------------------------------------------
+    def getTimeRemaining(self):
+        if self.isWaiting():
+            return self.scheduler.getTimeRemaining(0)
+        if not self.isRunningProtocol():
+            return None
+        return self.scheduler.getTimeRemaining(self.status[1])
+
+    # ------------------------------------------------------------------------------------
+    # The microscope finished imaging: end the running imaging step. Returns False if
+    # the engine is not waiting for imaging.
+    # ------------------------------------------------------------------------------------
+    def imagingDone(self):
+        with self.condition:
+            waiting = self.isWaitingForImaging()
+            if waiting:
+                self.endImaging()
+        self.dispatchEvents()
+        return waiting
+
+    # ------------------------------------------------------------------------------------
+    # Check to see if a hyperprotocol is running
+    # ------------------------------------------------------------------------------------
+    def isRunningHyperProtocol(self):
+        return self.hyper_status[0] >= 0
+
+    # ------------------------------------------------------------------------------------
+    # Check to see if a protocol is running
+    # ------------------------------------------------------------------------------------
+    def isRunningProtocol(self):
+        return self.status[0] >= 0
+
+    # ------------------------------------------------------------------------------------
+    # Check to see if protocol name is in the list of protocols
+    # ------------------------------------------------------------------------------------
+    def isValidProtocol(self, protocol_name):
+        return protocol_name in self.protocols.names
+
+    # ------------------------------------------------------------------------------------
+    # Check to see if a hyperprotocol wait step is running
+    # ------------------------------------------------------------------------------------
+    def isWaiting(self):
+        return self.wait_step is not None
+
+    # ------------------------------------------------------------------------------------
+    # Check to see if an imaging step is waiting for imagingDone()
+    # ------------------------------------------------------------------------------------
+    def isWaitingForImaging(self):
+        return self.isWaiting() and self.imaging_fallback is not None
+
+    # ------------------------------------------------------------------------------------
+    # Issue a command outside of a protocol (e.g. from the command widgets)
+    # ------------------------------------------------------------------------------------
+    def issueCommand(self, instrument, command_name):
+        with self.condition:
+            self.queueCommand(instrument, command_name)
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Issue the current command of the running protocol (engine lock held). The next
+    # command waits for the estimated device time if it is longer than the duration.
+    # ------------------------------------------------------------------------------------
+    def issueProtocolCommand(self):
+        [protocol_ID, command_ID] = self.status
+        [instrument, command_name] = self.protocols.commands[protocol_ID][command_ID]
+        duration = self.protocols.durations[protocol_ID][command_ID]
+        self.scheduler.recordIssue(command_ID)
+        command = self.resolveCommand(instrument, command_name)
+        estimate = self.estimateDuration(instrument, command)
+        if self.scheduler.delay(command_ID, self.clock.now() + estimate) > 0:
+            duration = self.scheduler.getDeadline(command_ID) - self.scheduler.getIssueTime(command_ID)
+        self.queueCommand(instrument, command_name, duration, protocol_ID, command_ID, command = command)
+        self.writeCheckpoint()
+
+        # Wake the worker thread: the next deadline changed
+        self.condition.notify_all()
+
+    # ------------------------------------------------------------------------------------
+    # Resolve a command by name (unless given) and queue a command event (engine lock
+    # held)
+    # ------------------------------------------------------------------------------------
+    def queueCommand(self, instrument, command_name, duration = -1, protocol_ID = -1, command_ID = -1, command = None):
+        if command is None:
+            command = self.resolveCommand(instrument, command_name)
+        self.issued_command = [instrument, command]
+        self.last_commands[instrument] = command_name
+        if self.verbose:
+            text = "Issued " + instrument + ": " + command_name
+            if duration > 0:
+                text += ": " + str(duration) + " s"
+            print(text)
+
+        self.emit("command", {"instrument": instrument,
+                              "name": command_name,
+                              "command": command,
+                              "duration": duration,
+                              "protocol_ID": protocol_ID,
+                              "command_ID": command_ID})
+
+    # ------------------------------------------------------------------------------------
+    # Return the total duration (s) of a protocol
+    # ------------------------------------------------------------------------------------
+    def requiredTime(self, protocol_name):
+        protocol_ID = self.protocols.names.index(protocol_name)
+        return float(self.protocols.total_durations[protocol_ID])
+
+    # ------------------------------------------------------------------------------------
+    # Look up a command by name: [valve ports] or (direction, speed). Unknown commands
+    # are replaced by a no change (valve) or stop (pump) command.
+    # ------------------------------------------------------------------------------------
+    def resolveCommand(self, instrument, command_name):
+        if instrument == "valve":
+            table = self.valve_commands
+        elif instrument == "pump":
+            table = self.pump_commands
+        else:
+            print("Unknown command type: " + str(instrument))
+            return None
+
+        if table is None:
+            return None
+        command_ID = table.names.getID(command_name)
+        if command_ID >= 0:
+            return table.commands[command_ID]
+
+        print("Did not find " + str(command_name))
+        if instrument == "valve":
+            return (-1,)*(table.num_valves + table.cnc) # No change command
+        return ("Stopped", 0.0)
+
+    # ------------------------------------------------------------------------------------
+    # Stop the hyperprotocol, protocol or wait step in progress without emptying the
+    # journal (engine lock held): the checkpoint being resumed must survive until the
+    # resumed run is journaled
+    # ------------------------------------------------------------------------------------
+    def resetRun(self):
+        [journal, self.journal] = [self.journal, None]
+        self.endHyperProtocol()
+        self.endProtocol(advance_hyperprotocol = False)
+        self.endWait(advance_hyperprotocol = False)
+        self.journal = journal
+
+    # ------------------------------------------------------------------------------------
+    # Resume a run from a checkpoint: re-issue the valve and pump commands in effect,
+    # then restart the protocol (and hyperprotocol) at the checkpoint command. The
+    # command (or wait step) only runs for what remained of its duration when it was
+    # interrupted: the time since it was journaled is subtracted.
+    # ------------------------------------------------------------------------------------
+    def resume(self, checkpoint):
+        with self.condition:
+            resumed = self.resumeCheckpoint(checkpoint)
+        self.dispatchEvents()
+        return resumed
+
+    # ------------------------------------------------------------------------------------
+    # Resume from a checkpoint (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def resumeCheckpoint(self, checkpoint):
+        step = loadStep(checkpoint.get("step", checkpoint["protocol"]))
+        command_ID = checkpoint["command_ID"]
+        protocol_ID = self.protocols.names.getID(step.name)
+        if step.kind == "protocol" and (protocol_ID < 0 or command_ID >= len(self.protocols.commands[protocol_ID])):
+            print("Cannot resume: " + str(step) + " has changed or is not loaded")
+            return False
+
+        hyperprotocol_ID = -1
+        if checkpoint["hyperprotocol"] is not None:
+            hyperprotocol_ID = self.hyperprotocols.names.getID(checkpoint["hyperprotocol"])
+            step_ID = checkpoint["hyperprotocol_step"]
+            if hyperprotocol_ID < 0 or step_ID >= len(self.hyperprotocols.protocols[hyperprotocol_ID]) or \
+               self.hyperprotocols.protocols[hyperprotocol_ID][step_ID] != step:
+                print("Cannot resume: " + checkpoint["hyperprotocol"] + " has changed or is not loaded")
+                return False
+
+        # Stop anything in progress
+        self.resetRun()
+
+        print("Resuming " + str(step) + " at command " + str(command_ID+1))
+        for instrument in ["valve", "pump"]:
+            if checkpoint[instrument] is not None:
+                self.queueCommand(instrument, checkpoint[instrument])
+
+        if hyperprotocol_ID >= 0:
+            self.hyper_status = [hyperprotocol_ID, checkpoint["hyperprotocol_step"]]
+            self.writeHyperProtocolCheckpoint()
+        elapsed = max(0.0, time.time() - checkpoint["time"])
+        return self.beginStep(step,
+                              start_time = self.clock.now() - elapsed,
+                              command_ID = command_ID)
+
+    # ------------------------------------------------------------------------------------
+    # Worker thread: issue the next command of the running protocol at its deadline
+    # ------------------------------------------------------------------------------------
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                time_remaining = self.getTimeRemaining()
+                if time_remaining is None or time_remaining > 0.001:
+                    self.clock.wait(self.condition, time_remaining)
+                    continue
+                if self.isWaitingForImaging():
+                    self.endImaging(timed_out = True)
+                elif self.isWaiting():
+                    self.endWait()
+                else:
+                    self.advanceProtocol()
+            self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Load valve and pump command tables
+    # ------------------------------------------------------------------------------------
+    def setCommands(self, valve_commands, pump_commands):
+        with self.condition:
+            self.valve_commands = valve_commands
+            self.pump_commands = pump_commands
+
+    # ------------------------------------------------------------------------------------
+    # Set the duration estimator of the devices: a function of (instrument, command)
+    # that returns the time (s) the devices need for the command (None = no estimate)
+    # ------------------------------------------------------------------------------------
+    def setDurationEstimator(self, estimator):
+        with self.condition:
+            self.duration_estimator = estimator
+
+    # ------------------------------------------------------------------------------------
+    # Enable or disable the imaging done handshake (e.g. when the microscope connects or
+    # disconnects). Applies to imaging steps started afterwards.
+    # ------------------------------------------------------------------------------------
+    def setHandshake(self, enabled):
+        with self.condition:
+            self.handshake = enabled
+
+    # ------------------------------------------------------------------------------------
+    # Load a hyperprotocol table (stops a running hyperprotocol)
+    # ------------------------------------------------------------------------------------
+    def setHyperProtocols(self, hyperprotocols):
+        with self.condition:
+            self.endHyperProtocol()
+            self.hyperprotocols = hyperprotocols
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Journal protocol commands to a CheckpointJournal (None = no journal)
+    # ------------------------------------------------------------------------------------
+    def setJournal(self, journal):
+        with self.condition:
+            self.journal = journal
+
+    # ------------------------------------------------------------------------------------
+    # Load a protocol table (stops a running protocol and hyperprotocol: their IDs refer
+    # to the previous table)
+    # ------------------------------------------------------------------------------------
+    def setProtocols(self, protocols):
+        with self.condition:
+            self.endHyperProtocol()
+            self.endProtocol()
+            self.protocols = protocols
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Skip the rest of the current command and issue the next one now
+    # ------------------------------------------------------------------------------------
+    def skipCommand(self):
+        with self.condition:
+            if self.isWaiting():
+                self.endWait()
+            elif self.isRunningProtocol():
+                self.scheduler.rebase(self.status[1] + 1)
+                self.advanceProtocol()
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Start the worker thread
+    # ------------------------------------------------------------------------------------
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target = self.run, name = "KilroyEngine", daemon = True)
+        self.thread.start()
+
+    # ------------------------------------------------------------------------------------
+    # Initialize and start a hyperprotocol
+    # ------------------------------------------------------------------------------------
+    def startHyperProtocol(self, hyperprotocol_ID):
+        with self.condition:
+            self.beginHyperProtocol(hyperprotocol_ID)
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Initialize and start a hyperprotocol specified by name
+    # ------------------------------------------------------------------------------------
+    def startHyperProtocolByName(self, hyperprotocol_name):
+        hyperprotocol_ID = self.hyperprotocols.names.getID(hyperprotocol_name)
+        if hyperprotocol_ID < 0:
+            print(str(hyperprotocol_name) + " is not a valid hyperprotocol")
+            return False
+        self.startHyperProtocol(hyperprotocol_ID)
+        return True
+
+    # ------------------------------------------------------------------------------------
+    # Initialize and start a protocol specified by name: message is returned with the
+    # protocol complete event, start_time anchors the schedule
+    # ------------------------------------------------------------------------------------
+    def startProtocolByName(self, protocol_name, message = None, start_time = None):
+        with self.condition:
+            started = self.beginProtocol(protocol_name, message, start_time)
+        self.dispatchEvents()
+        return started
+
+    # ------------------------------------------------------------------------------------
+    # Stop a running hyperprotocol
+    # ------------------------------------------------------------------------------------
+    def stopHyperProtocol(self):
+        with self.condition:
+            self.endHyperProtocol()
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Stop a running protocol
+    # ------------------------------------------------------------------------------------
+    def stopProtocol(self):
+        with self.condition:
+            self.endProtocol()
+            self.condition.notify_all()
+        self.dispatchEvents()
+
+    # ------------------------------------------------------------------------------------
+    # Journal the current protocol command and the commands in effect (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def writeCheckpoint(self):
+        if self.journal is None:
+            return
+        hyperprotocol_name = None
+        if self.isRunningHyperProtocol():
+            hyperprotocol_name = self.hyperprotocols.names[self.hyper_status[0]]
+        if self.isWaiting():
+            [step, command_ID] = [self.wait_step, 0]
+        else:
+            step = protocolStep(self.protocols.names[self.status[0]])
+            command_ID = self.status[1]
+
+        # The time the command was issued is a wall clock time so that it is meaningful
+        # after a reboot
+        self.journal.write({"event": "command",
+                            "time": time.time() - (self.clock.now() - self.scheduler.getIssueTime(command_ID)),
+                            "hyperprotocol": hyperprotocol_name,
+                            "hyperprotocol_step": self.hyper_status[1],
+                            "protocol": str(step),
+                            "step": list(step),
+                            "command_ID": command_ID,
+                            "valve": self.last_commands["valve"],
+                            "pump": self.last_commands["pump"]})
+
+    # ------------------------------------------------------------------------------------
+    # Journal the protocols of the running hyperprotocol (engine lock held)
+    # ------------------------------------------------------------------------------------
+    def writeHyperProtocolCheckpoint(self):
+        if self.journal is None:
+            return
+        hyperprotocol_ID = self.hyper_status[0]
+        self.journal.write({"event": "hyperprotocol",
+                            "name": self.hyperprotocols.names[hyperprotocol_ID],
+                            "protocols": [list(step) for step in self.hyperprotocols.protocols[hyperprotocol_ID]]})
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    from kilroyConfiguration import loadConfiguration
+
+    def printEvent(event):
+        print("%8.3f" % event.time, event.event_type, event.data)
+
+    engine = KilroyEngine(configuration = loadConfiguration("default_config.xml"))
+    engine.addListener(printEvent)
+    engine.start()
+    engine.startProtocolByName("Wait Microscopy 1")
+    time.sleep(1.5)
+    engine.close()
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# Run kilroy protocols and hyperprotocols without a GUI: the KilroyEngine issues the
+# commands and this class sends them directly to the valve chain, CNC and pump. Qt is
+# never imported, so kilroy starts in a fraction of the time of the GUI.
+#
+#   python kilroy.py --headless settings.xml [protocol or hyperprotocol name]
+#
+# Without a name the engine waits for protocols until interrupted (Ctrl+C). The name
+# may also be a hyperprotocol xml file, whose first hyperprotocol is run. There is no
+# TCP server, so imaging steps wait for their fallback duration.
+#
+# With --simulate the valves, CNC and pump are simulated (HamiltonMVP, MockAutopicker
+# and a simulated Rainin RP1) and the engine runs on a virtual clock, so a whole
+# hyperprotocol, including its imaging wait steps, finishes in seconds. Every
+# issued command is recorded with its (simulated) time; --trace file.txt saves it.
+#
+#   python kilroy.py --headless --simulate settings.xml protocols/hyper.xml --trace trace.txt
+#
+# Unless simulating, running protocols are journaled to the checkpoint file, and
+# --resume continues a run that was interrupted from the exact command.
+#
+#   python kilroy.py --headless --resume settings.xml
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import importlib
+import os
+import sys
+import threading
+import time
+from kilroyCheckpoint import CheckpointJournal, addCheckpointHyperProtocol
+from kilroyConfiguration import loadConfiguration, loadHyperProtocols
+from kilroyEngine import KilroyEngine, VirtualClock
+from valves.valveDevices import ValveDevices
+
+# ----------------------------------------------------------------------------------------
+# Return a parameter or the default value if it is missing
+# ----------------------------------------------------------------------------------------
+def getParameter(parameters, name, default):
+    if not name in parameters.parameters:
+        return default
+    return parameters.get(name)
+
+# ----------------------------------------------------------------------------------------
+# KilroyHeadless Class Definition
+# ----------------------------------------------------------------------------------------
+class KilroyHeadless(object):
+    def __init__(self, parameters, simulate = False):
+
+        # Parse parameters into internal attributes (same defaults as Kilroy)
+        self.verbose = getParameter(parameters, "verbose", False)
+        self.valve_com_port = getParameter(parameters, "valves_com_port", -1)
+        self.num_simulated_valves = getParameter(parameters, "num_simulated_valves", 0)
+        self.valve_type = getParameter(parameters, "valve_type", "Hamilton")
+        self.protocols_file = getParameter(parameters, "protocols_file", "default_config.xml")
+        self.commands_file = getParameter(parameters, "commands_file", "default_config.xml")
+        self.hyperprotocol_path = getParameter(parameters, "hyperprotocol_path", "protocols")
+        self.usb_cnc = getParameter(parameters, "cnc", None)
+        self.checkpoint_file = getParameter(parameters, "checkpoint_file", "kilroy_checkpoint.jsonl")
+        if getParameter(parameters, "simulate_cnc", False):
+            self.usb_cnc = "simulated"
+
+        # Define additional internal attributes
+        self.simulate = simulate
+        self.target_name = None
+        self.finished = threading.Event()
+        self.trace = [] # (time, protocol name, instrument, command name, command)
+
+        # Load configuration
+        self.configuration = loadConfiguration(self.protocols_file, verbose = self.verbose)
+        if self.configuration is None:
+            raise IOError("Could not load protocols: " + self.protocols_file)
+        if self.commands_file == self.protocols_file:
+            command_configuration = self.configuration
+        else:
+            command_configuration = loadConfiguration(self.commands_file, verbose = self.verbose)
+            if command_configuration is None:
+                raise IOError("Could not load commands: " + self.commands_file)
+
+        # Simulate one valve per configured valve, the CNC and the pump
+        if self.simulate:
+            self.valve_type = "Simulated"
+            self.num_simulated_valves = command_configuration.valve_commands.num_valves
+            self.usb_cnc = "simulated" if command_configuration.valve_commands.cnc else None
+            parameters.set("pump_class", "pumps.rainin_rp1")
+            parameters.set("simulate_pump", True)
+
+        # Create devices
+        self.valveDevices = ValveDevices(com_port = self.valve_com_port,
+                                         num_simulated_valves = self.num_simulated_valves,
+                                         usb_cnc = self.usb_cnc,
+                                         valve_type = self.valve_type,
+                                         verbose = self.verbose)
+
+        pump_module = importlib.import_module(getParameter(parameters, "pump_class", "pumps.gilson_mp3"))
+        self.pump = pump_module.APump(parameters = parameters)
+
+        # Create protocol engine
+        self.engine = KilroyEngine(clock = VirtualClock() if self.simulate else None,
+                                   verbose = self.verbose)
+        self.engine.setCommands(command_configuration.valve_commands, command_configuration.pump_commands)
+        self.engine.setProtocols(self.configuration.protocols)
+        if os.path.isfile(self.hyperprotocol_path):
+            hyperprotocols = loadHyperProtocols(self.hyperprotocol_path, self.configuration.protocols)
+            if hyperprotocols is not None:
+                self.engine.setHyperProtocols(hyperprotocols)
+        self.engine.addListener(self.handleEngineEvent)
+        self.engine.setDurationEstimator(self.estimateCommand)
+
+        # Journal running protocols (a simulated run has nothing to resume)
+        self.checkpointJournal = None
+        if not self.simulate:
+            self.checkpointJournal = CheckpointJournal(file_path = self.checkpoint_file,
+                                                       verbose = self.verbose)
+            self.engine.setJournal(self.checkpointJournal)
+
+    # ------------------------------------------------------------------------------------
+    # Close
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        self.engine.stopHyperProtocol()
+        self.engine.stopProtocol()
+        self.engine.close()
+        self.valveDevices.close()
+        self.pump.close()
+        print("\nKilroy was here!")
+
+    # ------------------------------------------------------------------------------------
+    # Return the estimated time (s) the devices need for a command: the CNC moves of a
+    # valve command
+    # ------------------------------------------------------------------------------------
+    def estimateCommand(self, instrument, command):
+        if instrument == "valve":
+            return self.valveDevices.estimateCommand(command)
+        return 0.0
+
+    # ------------------------------------------------------------------------------------
+    # Handle engine events: send commands to the devices and detect completion
+    # ------------------------------------------------------------------------------------
+    def handleEngineEvent(self, event):
+        if event.event_type == "command":
+            self.recordCommand(event)
+            self.sendCommand(event.data["instrument"], event.data["command"])
+        elif event.event_type == "protocol complete":
+            if event.data["name"] == self.target_name and not self.engine.isRunningHyperProtocol():
+                self.finished.set()
+        elif event.event_type == "hyperprotocol complete":
+            if event.data["name"] == self.target_name:
+                self.finished.set()
+
+    # ------------------------------------------------------------------------------------
+    # Load the hyperprotocols of an xml file and return the name of the first one
+    # ------------------------------------------------------------------------------------
+    def loadHyperProtocolFile(self, xml_file_path):
+        hyperprotocols = loadHyperProtocols(xml_file_path, self.engine.protocols)
+        if hyperprotocols is None or len(hyperprotocols.names) == 0:
+            return None
+        self.engine.setHyperProtocols(hyperprotocols)
+        return hyperprotocols.names[0]
+
+    # ------------------------------------------------------------------------------------
+    # Display the recorded command trace
+    # ------------------------------------------------------------------------------------
+    def printTrace(self):
+        for line in self.traceLines():
+            print(line)
+
+    # ------------------------------------------------------------------------------------
+    # Record an issued command with the engine time
+    # ------------------------------------------------------------------------------------
+    def recordCommand(self, event):
+        protocol_ID = event.data["protocol_ID"]
+        protocol_name = self.engine.protocols.names[protocol_ID] if protocol_ID >= 0 else ""
+        self.trace.append((event.time,
+                           protocol_name,
+                           event.data["instrument"],
+                           event.data["name"],
+                           event.data["command"]))
+
+    # ------------------------------------------------------------------------------------
+    # Resume an interrupted run from the checkpoint journal and wait until it is complete
+    # ------------------------------------------------------------------------------------
+    def resume(self):
+        checkpoint = None
+        if self.checkpointJournal is not None:
+            checkpoint = self.checkpointJournal.loadCheckpoint()
+        if checkpoint is None:
+            print("No interrupted run to resume")
+            return False
+        print("Resuming " + self.checkpointJournal.describeCheckpoint(checkpoint))
+
+        self.engine.setHyperProtocols(addCheckpointHyperProtocol(self.engine.hyperprotocols,
+                                                                 checkpoint,
+                                                                 self.engine.protocols))
+        if checkpoint["hyperprotocol"] is not None:
+            self.target_name = checkpoint["hyperprotocol"]
+        else:
+            self.target_name = checkpoint["protocol"]
+        self.finished.clear()
+        self.engine.start()
+        if not self.engine.resume(checkpoint):
+            return False
+        return self.waitUntilFinished()
+
+    # ------------------------------------------------------------------------------------
+    # Run a protocol or hyperprotocol by name and wait until it is complete. Without a
+    # name, wait until interrupted.
+    # ------------------------------------------------------------------------------------
+    def run(self, name = None):
+        if name is not None and name.endswith(".xml") and os.path.isfile(name):
+            name = self.loadHyperProtocolFile(name)
+            if name is None:
+                return False
+
+        self.target_name = name
+        self.finished.clear()
+        self.engine.start()
+
+        if name is None:
+            print("Kilroy is running headless (Ctrl+C to quit)")
+            if self.checkpointJournal is not None and self.checkpointJournal.loadCheckpoint() is not None:
+                print("An interrupted run can be resumed with --resume")
+        elif name in self.engine.hyperprotocols.names:
+            self.engine.startHyperProtocolByName(name)
+        elif self.engine.isValidProtocol(name):
+            self.engine.startProtocolByName(name)
+        else:
+            print(str(name) + " is not a valid protocol or hyperprotocol")
+            return False
+
+        return self.waitUntilFinished()
+
+    # ------------------------------------------------------------------------------------
+    # Redirect commands to valves or pump
+    # ------------------------------------------------------------------------------------
+    def sendCommand(self, instrument, command):
+        if instrument == "valve":
+            self.valveDevices.receiveCommand(command)
+        elif instrument == "pump":
+            # [direction, speed]: the same handling as PumpControl
+            [direction, speed] = command
+            if speed < 0.01:
+                self.pump.stopFlow()
+            else:
+                self.pump.startFlow(speed, direction)
+        else:
+            print("Received command of unknown type: " + str(instrument))
+
+    # ------------------------------------------------------------------------------------
+    # Format the command trace: time (s), protocol, instrument: command name, command
+    # ------------------------------------------------------------------------------------
+    def traceLines(self):
+        if not self.trace:
+            return []
+        start_time = self.trace[0][0]
+        lines = []
+        for [command_time, protocol_name, instrument, command_name, command] in self.trace:
+            text = "%10.1f" % (command_time - start_time) + "\t" + protocol_name
+            text += "\t" + instrument + ": " + command_name + "\t" + str(command)
+            lines.append(text)
+        return lines
+
+    # ------------------------------------------------------------------------------------
+    # Wait until the target protocol or hyperprotocol is complete (or until interrupted
+    # if there is none)
+    # ------------------------------------------------------------------------------------
+    def waitUntilFinished(self):
+        try:
+            while not self.finished.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            print("Interrupted")
+            return self.target_name is None
+        return True
+
+    # ------------------------------------------------------------------------------------
+    # Save the command trace to a text file
+    # ------------------------------------------------------------------------------------
+    def writeTrace(self, file_path):
+        with open(file_path, "w") as trace_file:
+            for line in self.traceLines():
+                trace_file.write(line + "\n")
+        print("Wrote command trace: " + file_path)
+
+# ----------------------------------------------------------------------------------------
+# Runtime code: [--headless] [--simulate | --resume] settings.xml [name] [--trace file.txt]
+# ----------------------------------------------------------------------------------------
+def main(argv):
+    import sc_library.parameters as params
+
+    start_time = time.perf_counter()
+    arguments = [argument for argument in argv[1:] if argument != "--headless"]
+    simulate = "--simulate" in arguments
+    resume = "--resume" in arguments and not simulate
+    trace_file_path = None
+    if "--trace" in arguments and arguments.index("--trace") + 1 < len(arguments):
+        trace_file_path = arguments.pop(arguments.index("--trace") + 1)
+    arguments = [argument for argument in arguments if not argument.startswith("--")]
+
+    if len(arguments) > 0:
+        parameters = params.parameters(arguments[0])
+    else:
+        parameters = params.parameters("kilroy_settings_default.xml")
+
+    kilroy = KilroyHeadless(parameters, simulate = simulate)
+    print("Kilroy started in " + "%0.2f" % (time.perf_counter() - start_time) + " s")
+
+    try:
+        run_time = time.perf_counter()
+        if resume:
+            completed = kilroy.resume()
+        else:
+            completed = kilroy.run(arguments[1] if len(arguments) > 1 else None)
+        if simulate and kilroy.trace:
+            kilroy.printTrace()
+            simulated_time = kilroy.engine.clock.now() - kilroy.trace[0][0]
+            text = "Simulated " + "%0.1f" % simulated_time + " s (" + str(len(kilroy.trace)) + " commands)"
+            text += " in " + "%0.2f" % (time.perf_counter() - run_time) + " s"
+            print(text)
+        if trace_file_path is not None:
+            kilroy.writeTrace(trace_file_path)
+    finally:
+        kilroy.close()
+    return 0 if completed else 1
+
+if __name__ == "__main__":
+    import imp
+    imp.load_source("setPath", "../sc_library/setPath.py")
+    sys.exit(main(sys.argv))
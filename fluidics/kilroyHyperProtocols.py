@@ -12,6 +12,12 @@ To synchronize with Nikon Inverted Microscope we use, Hyperprotocol follows thes
 
  During fluidic part, Nikon waits until fluidics ends.
 
+Hyperprotocols are run by the KilroyEngine of kilroyProtocols; this class is the view
+over the engine's hyperprotocol state. The imaging part is a single wait step,
+<wait duration="300"/>, so no Wait Microscopy protocols are needed. If the microscope
+sends "Kilroy Imaging Done" messages, the imaging part can instead be an imaging step,
+<wait_imaging timeout="600" fallback="300"/>, that ends as soon as imaging is done.
+
 Code written by : Han, manhyuk (manhyukhan@kaist.ac.kr) 12/23/2021
 """
 # ----------------------------------------------------------------------------------------
@@ -25,6 +31,8 @@ import numpy as np
 import xml.etree.cElementTree as elementTree
 from PyQt5 import QtCore, QtGui, QtWidgets
 from kilroyProtocols import KilroyProtocols
+from kilroyCheckpoint import addCheckpointHyperProtocol
+from kilroyConfiguration import HyperProtocolTable, Registry, imagingStep, loadHyperProtocols, protocolStep, waitStep
 
 __standAlone = False
 
@@ -39,6 +47,7 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
     completed_protocol_signal = QtCore.pyqtSignal(object)
     completed_hyperprotocol_signal = QtCore.pyqtSignal(object)
     change_protocol_signal = QtCore.pyqtSignal()
+    engine_event_signal = QtCore.pyqtSignal(object)
     
     def __init__(self,
                  hyperprotocol_path = 'protocols',
@@ -50,16 +59,14 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         # Initialize internal attributes
         self.verbose = verbose
         self.hyperprotocol_path = hyperprotocol_path
-        self.hyperprotocol_names = list()
+        self.hyperprotocol_names = Registry()
         self.hyperprotocol_protocols = list()
         self.hyperprotocol_durations = list()
-        self.status = [-1, -1]  # Hyperprotocol ID, protocol ID
         self.num_hyperprotocols = 0
         self.issued_protocol = list()
         # Basis protocol information
         self.protocol_durations = list()
-        self.protocol_names = list()
-        self.received_message = None
+        self.protocol_names = Registry()
         
         print('----------------------------------------------------------------------')
 
@@ -71,9 +78,14 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         self.kilroyProtocols.status_change_signal.connect(self.transferStatus)
         self.kilroyProtocols.completed_protocol_signal.connect(self.transferComplete)
 
+        # Hyperprotocols are run by the protocol engine
+        self.engine = self.kilroyProtocols.engine
+        self.engine_event_signal.connect(self.handleEngineEvent)
+        self.engine.addListener(self.engine_event_signal.emit)
+
         # extract protocol information form kilroyProtocol
         self.protocol_names = self.kilroyProtocols.protocol_names
-        self.protocol_durations = [sum(durations) for durations in self.kilroyProtocols.protocol_durations]
+        self.protocol_durations = self.kilroyProtocols.protocol_total_durations
         
         if self.verbose:
             print(len(self.protocol_names), len(self.protocol_durations))
@@ -82,35 +94,11 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
 
         self.loadHyperProtocols(self.hyperprotocol_path)
 
-        self.hyperprotocol_timer = QtCore.QTimer()
-        #self.hyperprotocol_timer.setSingleShot(True)
-        #self.hyperprotocol_timer.timeout.connect(self.advanceHyperProtocol)
-
         self.hyper_elapsed_timer = QtCore.QElapsedTimer()
         self.hyper_poll_elapsed_time_timer = QtCore.QTimer()
         self.hyper_poll_elapsed_time_timer.setInterval(1000)
         self.hyper_poll_elapsed_time_timer.timeout.connect(self.updateElapsedTime)
         
-    # ----------------------------------------------------------------------------------------
-    # Advance the hyperprotocol to the next protocol and issue it
-    # ----------------------------------------------------------------------------------------
-    def advanceHyperProtocol(self):
-        status = self.status
-        hyperprotocol_ID = self.status[0]
-        protocol_ID = self.status[1] + 1
-
-        if protocol_ID < len(self.hyperprotocol_protocols[hyperprotocol_ID]):
-            protocol_name = self.hyperprotocol_protocols[hyperprotocol_ID][protocol_ID]
-            protocol_duration = self.hyperprotocol_durations[hyperprotocol_ID][protocol_ID]
-            self.status = [hyperprotocol_ID,protocol_ID]
-            #self.hyper_elapsed_timer.start()
-
-            self.hyperprotocolDetailsListWidget.setCurrentRow(protocol_ID)
-
-            self.issueProtocol(protocol_name, protocol_duration)            
-        else:
-            self.stopHyperProtocol()
-
     # ----------------------------------------------------------------------------------------
     # Close
     # ----------------------------------------------------------------------------------------
@@ -161,6 +149,14 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         self.hyperprotocolName.textChanged.connect(self.updateHyperProtocolName)
         self.imagingTime = QtWidgets.QLineEdit()
         self.imagingTime.textChanged.connect(self.updateImagingTime)
+        self.imagingHandshake = QtWidgets.QCheckBox("Wait for imaging done message")
+        self.imagingHandshake.stateChanged.connect(self.updateImagingTime)
+        self.imagingTimeoutLabel = QtWidgets.QLabel()
+        self.imagingTimeoutLabel.setText("Imaging Timeout (default 2 x duration) : ")
+        self.imagingTimeout = QtWidgets.QLineEdit()
+        self.imagingTimeout.textChanged.connect(self.updateImagingTime)
+        self.imagingSavedLabel = QtWidgets.QLabel()
+        self.imagingSavedLabel.setText("")
 
         self.generateHyperProtocolButton = QtWidgets.QPushButton("Generate HyperProtocol")
         self.generateHyperProtocolButton.clicked.connect(self.generateHyperProtocol)
@@ -172,6 +168,7 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         self.mainWidgetLayout.addWidget(self.leftWidget, 0, 0, 1, 2)
         self.mainWidgetLayout.addWidget(self.rightWidget, 0, 2, 1, 2)
         self.leftWidgetLayout.addWidget(self.elapsedTimeLabel)
+        self.leftWidgetLayout.addWidget(self.imagingSavedLabel)
         self.leftWidgetLayout.addWidget(self.fileLabel)
         self.leftWidgetLayout.addWidget(self.hyperprotocolListWidget)
         self.leftWidgetLayout.addWidget(self.hyperprotocolDetailsListWidget)
@@ -181,6 +178,9 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         self.rightWidgetLayout.addWidget(self.ignoreHybeList)
         self.rightWidgetLayout.addWidget(self.imagingTimeLabel)
         self.rightWidgetLayout.addWidget(self.imagingTime)
+        self.rightWidgetLayout.addWidget(self.imagingHandshake)
+        self.rightWidgetLayout.addWidget(self.imagingTimeoutLabel)
+        self.rightWidgetLayout.addWidget(self.imagingTimeout)
         self.rightWidgetLayout.addWidget(self.hyperprotocolNameLabel)
         self.rightWidgetLayout.addWidget(self.hyperprotocolName)
         self.rightWidgetLayout.addWidget(self.generateHyperProtocolButton)
@@ -197,6 +197,9 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         # Disable buttons
         self.stopHyperProtocolButton.setEnabled(False)
 
+        # Default imaging duration and timeout
+        self.updateImagingTime()
+
     # ----------------------------------------------------------------------------------------
     # generate hyperprotocol
     # ----------------------------------------------------------------------------------------
@@ -221,27 +224,24 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         new_durations = list()
         for hybe in self.hybelist:
             hybename = 'Hybridize ' + str(hybe)
-            new_protocols.append(hybename)
-            try:
-                new_durations.append(self.protocol_durations[self.protocol_names.index(hybename)])
-            except ValueError:
+            new_protocols.append(protocolStep(hybename))
+            protocol_ID = self.protocol_names.getID(hybename)
+            if protocol_ID < 0:
                 warnings.warn('Not Valid protocol')
                 return
+            new_durations.append(self.protocol_durations[protocol_ID])
             protocol = elementTree.SubElement(kilroy_hyperprotocol,'protocol',{'name':hybename})
-            
-            imagingDuration = str(self.imagingDuration).rjust(4,'0')
-            thou, hund, tens, ones = imagingDuration[:-3], imagingDuration[-3], imagingDuration[-2], imagingDuration[-1]
-            
-            def __appendWait(count, deci):
-                for i in range(int(count)):
-                    elementTree.SubElement(kilroy_hyperprotocol,'protocol',{'name':'Wait Microscopy ' + str(deci)})
-                    new_protocols.append(f"Wait Microscopy {deci}")
-                    new_durations.append(deci)
-            
-            __appendWait(thou,1000)
-            __appendWait(hund,100)
-            __appendWait(tens,10)
-            __appendWait(ones,1)
+
+            # A single wait step for imaging, ended by the microscope if requested
+            if self.imagingHandshake.isChecked():
+                elementTree.SubElement(kilroy_hyperprotocol,'wait_imaging',{'timeout':str(int(self.imagingTimeoutDuration)),
+                                                                            'fallback':str(int(self.imagingDuration))})
+                new_protocols.append(imagingStep(self.imagingTimeoutDuration, self.imagingDuration))
+                new_durations.append(int(self.imagingDuration))
+            elif self.imagingDuration > 0:
+                elementTree.SubElement(kilroy_hyperprotocol,'wait',{'duration':str(int(self.imagingDuration))})
+                new_protocols.append(waitStep(self.imagingDuration))
+                new_durations.append(int(self.imagingDuration))
 
         def _indent(elem, level=0):
             i = '\n\n' + level*"  "
@@ -268,9 +268,9 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
 
         elementTree.ElementTree(xml_tree).write(self.hyperprotocol_xml_path)
 
-        self.hyperprotocol_names.append(name)
-        self.hyperprotocol_protocols.append(new_protocols)
-        self.hyperprotocol_durations.append(new_durations)
+        self.setHyperProtocols(HyperProtocolTable(Registry(list(self.hyperprotocol_names) + [name], "hyperprotocol"),
+                                                  tuple(self.hyperprotocol_protocols) + (tuple(new_protocols),),
+                                                  tuple(self.hyperprotocol_durations) + (tuple(new_durations),)))
         self.updateGUI()
 
         #self.loadHyperProtocols(self.hyperprotocol_xml_path)
@@ -282,51 +282,37 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         return self.num_hyperprotocols
     
     def getStatus(self):
-        return self.status
+        return self.engine.getHyperStatus() # [hyperprotocol_ID, protocol_ID] -1 = no active hyperprotocol
 
     def getHyperProtocolNames(self):
         return self.hyperprotocol_names
 
-    def handleProtocolComplete(self):
-        pass
-
     # ----------------------------------------------------------------------------------------
-    # Issue a protocol: load current protocol, send protol ready sig
+    # Handle an engine event in the GUI thread
     # ----------------------------------------------------------------------------------------
-    def issueProtocol(self, protocol_data, protocol_duration = -1):
-        if "Wait Microscopy" in protocol_data:
-            self.issued_protocol = protocol_data
-        elif "Hybridize" in protocol_data:
-            self.issued_protocol = protocol_data
-        else:
-            print("not valid protocol")
-            return
-        
-        if self.verbose:
-            text = "Issued protocol : " + self.issued_protocol
-            if protocol_duration > 0:
-                text += ": " + str(protocol_duration) + " s"
-            print(text)
-         
-        if protocol_duration >= 0:
-            self.hyperprotocol_timer.start(protocol_duration*1000)
-
-        self.kilroyProtocols.startProtocolByName(protocol_name=self.issued_protocol)
+    def handleEngineEvent(self, event):
+        if event.event_type == "status":
+            self.updateStatus(event.data["hyper_status"])
+        elif event.event_type == "hyperprotocol complete":
+            self.completed_hyperprotocol_signal.emit(None)
+        elif event.event_type == "imaging done":
+            text_string = "Last imaging : " + "%0.0f" % event.data["elapsed"] + " s, "
+            text_string += "saved " + "%0.0f" % event.data["saved"] + " s "
+            text_string += "(total " + "%0.0f" % event.data["total_saved"] + " s)"
+            self.imagingSavedLabel.setText(text_string)
 
     # ----------------------------------------------------------------------------------------
     # Check to see if hyperprotocol name is in the list of hyperprotocols
     # ----------------------------------------------------------------------------------------
     def isValidHyperProtocol(self, hyperprotocol_name):
-        try:
-            self.hyperprotocol_names.index(hyperprotocol_name)
+        if hyperprotocol_name in self.hyperprotocol_names:
             return True
-        except ValueError:
-            if self.verbose:
-                print(hyperprotocol_name + " is not a valid protocol")
-            return False
+        if self.verbose:
+            print(hyperprotocol_name + " is not a valid protocol")
+        return False
 
     def isRunningHyperProtocol(self):
-        return self.status[0] >= 0
+        return self.engine.isRunningHyperProtocol()
     
     # ----------------------------------------------------------------------------------------
     # Load a protocol xml file
@@ -350,39 +336,10 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
     # Parse loaded xml file: load hyperprotocols
     # ----------------------------------------------------------------------------------------
     def parseHyperProtocolXML(self):
-        try:
-            print("Parsing for hyperprotocols: " + self.hyperprotocol_xml_path)
-            self.xml_tree = elementTree.parse(self.hyperprotocol_xml_path)
-            self.kilroy_configuration = self.xml_tree.getroot()
-        except:
-            print("Valid xml file not loaded")
+        hyperprotocols = loadHyperProtocols(self.hyperprotocol_xml_path, self.engine.protocols)
+        if hyperprotocols is None:
             return
-        
-        # Clear previous commands
-        self.hyerprotocol_names = list()
-        self.hyperprotocol_commands = list()
-        self.num_hyperprotocols = 0
-
-        # Load protocols
-        for kilroy_hyperprotocols in self.kilroy_configuration.findall('kilroy_hyperprotocols'):
-
-            for hyperprotocol in kilroy_hyperprotocols.findall('hyperprotocol'):
-                self.hyerprotocol_names.append(hyperprotocol.get("name"))
-                new_protocol_durations= list()
-                new_protocol_names = list()
-
-                for protocol in hyperprotocol:
-                    name = protocol.get("name")
-
-                    if name in self.protocol_names:
-                        new_protocol_names.append(name)
-                        new_protocol_durations.append(self.protocol_durations[self.protocol_names.index(name)])
-                
-                if new_protocol_durations:
-                    self.hyperprotocol_durations.append(new_protocol_durations)
-                    self.hyperprotocol_protocols.append(new_protocol_names)
-            
-        self.num_hyperprotocols = len(self.hyperprotocol_names)
+        self.setHyperProtocols(hyperprotocols)
         print(len(self.hyperprotocol_names),len(self.hyperprotocol_durations),self.num_hyperprotocols)
 
     # ----------------------------------------------------------------------------------------
@@ -395,7 +352,7 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
             print(self.hyperprotocol_names[hyperprotocol_ID])
             
             for protocol_ID, protocol in enumerate(self.hyperprotocol_protocols[hyperprotocol_ID]):
-                textString = "    " + protocol[0] + ": "
+                textString = "    " + str(protocol) + ": "
                 textString += str(self.hyperprotocol_durations[protocol_ID]) + " s"
                 print(textString)
 
@@ -408,84 +365,50 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         return total_time
 
     # ----------------------------------------------------------------------------------------
-    # Initialize and start a hyperprotocol
+    # Resume an interrupted run from a checkpoint, restoring its hyperprotocol if needed
     # ----------------------------------------------------------------------------------------
-    def startHyperProtocol(self):
-        hyperprotocol_ID = self.hyperprotocolListWidget.currentRow()
-
-        # Get first protocol in hyperprotocol
-        protocol_data = self.hyperprotocol_protocols[hyperprotocol_ID][0]
-        protocol_duration = self.hyperprotocol_durations[hyperprotocol_ID][0]
+    def resumeCheckpoint(self, checkpoint):
+        hyperprotocols = addCheckpointHyperProtocol(self.engine.hyperprotocols,
+                                                    checkpoint,
+                                                    self.engine.protocols)
+        if hyperprotocols is not self.engine.hyperprotocols:
+            self.setHyperProtocols(hyperprotocols)
+            self.updateGUI()
+        return self.engine.resume(checkpoint)
 
-        # Set hyperprotocol status : [hyperprotocol ID, protocol ID]
-        self.status = [hyperprotocol_ID, 0]
-        self.status_change_signal.emit()
-
-        if self.verbose:
-            print("Starting " + self.hyperprotocol_names[hyperprotocol_ID])
-
-        # Start elapsed timer
-        self.hyper_elapsed_timer.start()
-        self.hyper_poll_elapsed_time_timer.start()
-
-        # Change enable status of GUI items
-        self.generateHyperProtocolButton.setEnabled(False)
-        self.startHyperProtocolButton.setEnabled(False)
-        self.hyperprotocolListWidget.setEnabled(False)
-        self.hyperprotocolDetailsListWidget.setCurrentRow(0)
-        self.stopHyperProtocolButton.setEnabled(True)
+    # ----------------------------------------------------------------------------------------
+    # Load a hyperprotocol table into the view and the engine
+    # ----------------------------------------------------------------------------------------
+    def setHyperProtocols(self, hyperprotocols):
+        self.hyperprotocol_names = hyperprotocols.names
+        self.hyperprotocol_protocols = hyperprotocols.protocols
+        self.hyperprotocol_durations = hyperprotocols.durations
+        self.num_hyperprotocols = len(self.hyperprotocol_names)
+        self.engine.setHyperProtocols(hyperprotocols)
 
-        # Issue
-        self.issueProtocol(protocol_data,protocol_duration)
-        
-        # Start the protocol
-        #self.kilroyProtocols.startProtocolByName(protocol_data)
+    # ----------------------------------------------------------------------------------------
+    # Initialize and start the selected hyperprotocol
+    # ----------------------------------------------------------------------------------------
+    def startHyperProtocol(self):
+        hyperprotocol_ID = self.hyperprotocolListWidget.currentRow()
+        if hyperprotocol_ID >= 0:
+            self.engine.startHyperProtocol(hyperprotocol_ID)
 
     def startHyperProtocolLocally(self):
         self.startHyperProtocol()
         
     # ----------------------------------------------------------------------------------------
-    # Stop a running hyperprotocol either or completion or early
+    # Stop a running hyperprotocol early
     # ----------------------------------------------------------------------------------------
     def stopHyperProtocol(self):
-        # Get name of current hyperprotocol
-        if self.status[0] >= 0:
-            if self.verbose: print("Stopped Hyperprotocol")
-            self.completed_hyperprotocol_signal.emit(self.received_message)
-
-        # Reset status and emit status change signal
-        self.status = [-1, -1]
-        self.status_change_signal.emit()
-        self.received_message = None
-
-        # Stop timer
-        self.hyperprotocol_timer.stop()
-
-        # Re-enable GUI
-        self.startHyperProtocolButton.setEnabled(True)
-        self.generateHyperProtocolButton.setEnabled(True)
-        self.hyperprotocolListWidget.setEnabled(True)
-        self.stopHyperProtocolButton.setEnabled(False)
-
-        # Unselect all
-        self.hyperprotocolDetailsListWidget.setCurrentRow(0)
-        try:
-            self.hyperprotocolDetailsListWidget.item(0).setSelected(False)
-        except:
-            print('unselect all failed')
-
-        # Stop timers
-        self.hyper_poll_elapsed_time_timer.stop()
-        self.elapsedTimeLabel.setText("Hyperprotocol Elapsed Time: ")
+        self.engine.stopHyperProtocol()
 
     def transferCommand(self):
         self.command_ready_signal.emit()
 
-    def transferComplete(self):
-        if self.status[0] < 0:
-            self.completed_protocol_signal.emit(None)
-        else:
-            self.advanceHyperProtocol()
+    def transferComplete(self, message):
+        # the engine advances a running hyperprotocol itself
+        self.completed_protocol_signal.emit(message)
     
     def transferStatus(self):
         # transfer stautus change signal when hyperprotocol not running
@@ -514,6 +437,44 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         self.fileLabel.setText(file_name)
         self.fileLabel.setToolTip(self.hyperprotocol_xml_path)
 
+    # ----------------------------------------------------------------------------------------
+    # Update the GUI for a hyperprotocol status change: [hyperprotocol_ID, protocol_ID]
+    # ----------------------------------------------------------------------------------------
+    def updateStatus(self, hyper_status):
+        if hyper_status[0] >= 0:
+            self.issued_protocol = self.hyperprotocol_protocols[hyper_status[0]][hyper_status[1]]
+
+            # Display the running hyperprotocol and start elapsed timer
+            if not self.hyper_poll_elapsed_time_timer.isActive():
+                self.hyperprotocolListWidget.setCurrentRow(hyper_status[0])
+                self.hyper_elapsed_timer.start()
+                self.hyper_poll_elapsed_time_timer.start()
+
+            # Change enable status of GUI items
+            self.generateHyperProtocolButton.setEnabled(False)
+            self.startHyperProtocolButton.setEnabled(False)
+            self.hyperprotocolListWidget.setEnabled(False)
+            self.hyperprotocolDetailsListWidget.setCurrentRow(hyper_status[1])
+            self.stopHyperProtocolButton.setEnabled(True)
+
+        elif self.hyper_poll_elapsed_time_timer.isActive():
+            # Re-enable GUI
+            self.startHyperProtocolButton.setEnabled(True)
+            self.generateHyperProtocolButton.setEnabled(True)
+            self.hyperprotocolListWidget.setEnabled(True)
+            self.stopHyperProtocolButton.setEnabled(False)
+
+            # Unselect all
+            self.hyperprotocolDetailsListWidget.setCurrentRow(0)
+            try:
+                self.hyperprotocolDetailsListWidget.item(0).setSelected(False)
+            except:
+                print('unselect all failed')
+
+            # Stop timers
+            self.hyper_poll_elapsed_time_timer.stop()
+            self.elapsedTimeLabel.setText("Hyperprotocol Elapsed Time: ")
+
     def updateHybeList(self):
         """
         update hybe list
@@ -571,7 +532,7 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         self.hyperprotocolDetailsListWidget.clear()
         
         for ID in range(len(current_hyperprotocol_protocols)):
-            text_string = current_hyperprotocol_protocols[ID]
+            text_string = str(current_hyperprotocol_protocols[ID])
             text_string += ": "
             text_string += str(current_hyperprotocol_durations[ID]) + " s"
 
@@ -593,11 +554,15 @@ class KilroyHyperProtocols(QtWidgets.QMainWindow):
         try:
             tmp = int(imagingTimeString)
         except ValueError:
-            self.imagingDuration = 300
-            return
-        
+            tmp = 300
+
         self.imagingDuration = tmp
 
+        try:
+            self.imagingTimeoutDuration = int(self.imagingTimeout.text())
+        except ValueError:
+            self.imagingTimeoutDuration = 2*self.imagingDuration
+
 
 if __name__ == '__main__':
     __standAlone = True
@@ -4,6 +4,9 @@
 # collections of predefined valve or pump configurations and a defined
 # duration to wait before setting the next configuration. This class also
 # provides a basic I/O GUI to interface with protocols. 
+#
+# Protocols are run by a KilroyEngine (no Qt dependency); this class relays the engine
+# events to the GUI thread and its signals.
 # ----------------------------------------------------------------------------------------
 # Jeff Moffitt
 # 2/15/14
@@ -15,8 +18,9 @@
 # ----------------------------------------------------------------------------------------
 import sys
 import os
-import xml.etree.ElementTree as elementTree
 from PyQt5 import QtCore, QtGui, QtWidgets
+from kilroyConfiguration import loadConfiguration, Registry
+from kilroyEngine import KilroyEngine
 from valves.valveCommands import ValveCommands  # storm_control.fluidics.
 from pumps.pumpCommands import PumpCommands  #  storm_control.fluidics.
 
@@ -30,6 +34,7 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     status_change_signal = QtCore.pyqtSignal() # A protocol status change occured
     completed_protocol_signal = QtCore.pyqtSignal(object) # Name of completed protocol
     change_protocol_signal = QtCore.pyqtSignal()
+    engine_event_signal = QtCore.pyqtSignal(object) # Engine events, queued to the GUI thread
 
     def __init__(self,
                  protocol_xml_path = "default_config.xml",
@@ -41,20 +46,28 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.verbose = verbose
         self.protocol_xml_path = protocol_xml_path
         self.command_xml_path = command_xml_path
-        self.protocol_names = []
+        self.protocol_names = Registry()
         self.protocol_commands = [] # [Instrument Type, command_info]
         self.protocol_durations = []
+        self.protocol_total_durations = []
         self.num_protocols = 0
-        self.status = [-1, -1] # Protocol ID, command ID within protocol
         self.issued_command = []
-        self.received_message = None
         self.totalDuration = 0
 
         print("----------------------------------------------------------------------")
+
+        # Parse the configuration once and share it when commands and protocols
+        # are defined in the same file
+        self.configuration = loadConfiguration(self.protocol_xml_path, verbose = self.verbose)
+        if self.command_xml_path == self.protocol_xml_path:
+            command_configuration = self.configuration
+        else:
+            command_configuration = loadConfiguration(self.command_xml_path, verbose = self.verbose)
         
         # Create instance of ValveCommands class
         print('creating valveCommands')
         self.valveCommands = ValveCommands(xml_file_path = self.command_xml_path,
+                                           configuration = command_configuration,
                                            verbose = self.verbose)
 
         # Connect valve command issue signal
@@ -63,21 +76,25 @@ class KilroyProtocols(QtWidgets.QMainWindow):
 
         # Create instance of PumpCommands class
         self.pumpCommands = PumpCommands(xml_file_path = self.command_xml_path,
+                                         configuration = command_configuration,
                                          verbose = self.verbose)
 
         # Connect pump commands issue signal
         self.pumpCommands.change_command_signal.connect(self.issuePumpCommand)
+
+        # Create protocol engine--runs protocols and issues commands at their deadlines
+        self.engine = KilroyEngine(verbose = self.verbose)
+        if command_configuration is not None: # loadConfiguration() printed the error
+            self.engine.setCommands(command_configuration.valve_commands, command_configuration.pump_commands)
+        self.engine_event_signal.connect(self.handleEngineEvent)
+        self.engine.addListener(self.engine_event_signal.emit)
         
         # Create GUI
         self.createGUI()
 
         # Load configurations
-        self.loadProtocols(xml_file_path = self.protocol_xml_path)
-
-        # Create protocol timer--controls when commands are issued
-        self.protocol_timer = QtCore.QTimer()
-        self.protocol_timer.setSingleShot(True)
-        self.protocol_timer.timeout.connect(self.advanceProtocol)
+        self.loadProtocols(xml_file_path = self.protocol_xml_path,
+                           configuration = self.configuration)
 
         # Create elapsed time timer--determines time between command calls
         self.elapsed_timer = QtCore.QElapsedTimer()
@@ -85,32 +102,15 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.poll_elapsed_time_timer.setInterval(1000)
         self.poll_elapsed_time_timer.timeout.connect(self.updateElapsedTime)
 
-    # ------------------------------------------------------------------------------------
-    # Advance the protocol to the next command and issue it
-    # ------------------------------------------------------------------------------------       
-    def advanceProtocol(self):
-        status = self.status
-        protocol_ID = self.status[0]
-        command_ID = self.status[1] + 1
-        if command_ID < len(self.protocol_commands[protocol_ID]):
-            command_name = self.protocol_commands[protocol_ID][command_ID]
-            command_duration = self.protocol_durations[protocol_ID][command_ID]
-            self.status = [protocol_ID, command_ID]
-            self.elapsed_timer.start()
-
-            self.issueCommand(command_name, command_duration)
-
-            #self.elapsed_timer.start()
-
-            self.protocolDetailsList.setCurrentRow(command_ID)
-        else:
-            self.stopProtocol()
+        # Start issuing protocol commands
+        self.engine.start()
 
     # ------------------------------------------------------------------------------------
     # Close
     # ------------------------------------------------------------------------------------                                                
     def close(self):
         self.stopProtocol()
+        self.engine.close()
         if self.verbose: print("Closing valve protocols")
         self.valveCommands.close()
         
@@ -191,18 +191,16 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     # Return protocol status
     # ------------------------------------------------------------------------------------                                        
     def getStatus(self):
-        return self.status # [protocol_ID, command_ID] -1 = no active protocol
+        return self.engine.getStatus() # [protocol_ID, command_ID] -1 = no active protocol
 
     # ------------------------------------------------------------------------------------
     # Return a protocol index by name
     # ------------------------------------------------------------------------------------                                        
-    def getProtocolByName(self, command_name):
-        try:
-            command_ID = self.protocol_names.index(command_name)
-            return self.commands[command_ID]
-        except:
-            print("Did not find " + command_name)
-            return [-1]*self.num_valves # Return no change command
+    def getProtocolByName(self, protocol_name):
+        protocol_ID = self.protocol_names.getID(protocol_name)
+        if protocol_ID < 0:
+            print("Did not find " + protocol_name)
+        return protocol_ID
 
     # ------------------------------------------------------------------------------------
     # Return loaded protocol names
@@ -211,21 +209,30 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         return self.protocol_names
 
     # ------------------------------------------------------------------------------------
-    # Issue a command: load current command, send command ready signal
+    # Handle an engine event in the GUI thread: update the GUI and relay signals
     # ------------------------------------------------------------------------------------                       
-    def issueCommand(self, command_data, command_duration=-1):
-        if command_data[0] == "pump":
-            self.issued_command = ["pump", self.pumpCommands.getCommandByName(command_data[1])]
-        elif command_data[0] == "valve":
-            self.issued_command = ["valve", self.valveCommands.getCommandByName(command_data[1])]
-        if self.verbose:
-            text = "Issued " + command_data[0] + ": " + command_data[1]
-            if command_duration > 0:
-                text += ": " + str(command_duration) + " s"
-            print(text)
-            
-        if command_duration >= 0:
-            self.protocol_timer.start(command_duration*1000)        
+    def handleEngineEvent(self, event):
+        if event.event_type == "command":
+            self.issueCommand(event.data)
+        elif event.event_type == "status":
+            self.updateStatus(event.data["status"])
+        elif event.event_type == "protocol complete":
+            self.completed_protocol_signal.emit(event.data["message"])
+
+    # ------------------------------------------------------------------------------------
+    # Issue a command: load current command, send command ready signal. Commands are
+    # looked up in the command widgets, which may have loaded a new command file.
+    # ------------------------------------------------------------------------------------                       
+    def issueCommand(self, command_data):
+        if command_data["instrument"] == "pump":
+            self.issued_command = ["pump", self.pumpCommands.getCommandByName(command_data["name"])]
+        elif command_data["instrument"] == "valve":
+            self.issued_command = ["valve", self.valveCommands.getCommandByName(command_data["name"])]
+
+        # Protocol commands: display progress
+        if command_data["command_ID"] >= 0:
+            self.elapsed_timer.start()
+            self.protocolDetailsList.setCurrentRow(command_data["command_ID"])
 
         self.command_ready_signal.emit()
 
@@ -233,36 +240,34 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     # Handle Issue Command Request from Pump Commands
     # ------------------------------------------------------------------------------------                       
     def issuePumpCommand(self, command_name):
-        self.issueCommand(["pump", command_name])
+        self.engine.issueCommand("pump", command_name)
 
     # ------------------------------------------------------------------------------------
     # Handle Issue Command Request from Valve Commands
     # ------------------------------------------------------------------------------------                       
     def issueValveCommand(self, command_name):
-        self.issueCommand(["valve", command_name])
+        self.engine.issueCommand("valve", command_name)
         
     # ------------------------------------------------------------------------------------
     # Check to see if protocol name is in the list of protocols
     # ------------------------------------------------------------------------------------                       
     def isValidProtocol(self, protocol_name):
-        try:
-            self.protocol_names.index(protocol_name)
+        if protocol_name in self.protocol_names:
             return True
-        except ValueError:
-            if self.verbose:
-                print(protocol_name + " is not a valid protocol")
-            return False
+        if self.verbose:
+            print(protocol_name + " is not a valid protocol")
+        return False
 
     # ------------------------------------------------------------------------------------
-    # Check to see if protocol name is in the list of protocols
+    # Check to see if a protocol is running
     # ------------------------------------------------------------------------------------                       
     def isRunningProtocol(self):
-        return self.status[0] >= 0
+        return self.engine.isRunningProtocol()
 
     # ------------------------------------------------------------------------------------
     # Load a protocol xml file
     # ------------------------------------------------------------------------------------                        
-    def loadProtocols(self, xml_file_path = ""):
+    def loadProtocols(self, xml_file_path = "", configuration = None):
         # Set Configuration XML (load if needed)
         if not xml_file_path:
             xml_file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Open File", "\home")[0]
@@ -273,7 +278,7 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.protocol_xml_path = xml_file_path
         
         # Parse XML
-        self.parseProtocolXML()
+        self.parseProtocolXML(configuration)
 
         # Update GUI
         self.updateGUI()
@@ -298,15 +303,23 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.protocol_xml_path = xml_file_path
         self.command_xml_path = xml_file_path
 
+        # Parse XML once and swap it into commands and protocols
+        configuration = loadConfiguration(xml_file_path, verbose = self.verbose)
+        if configuration is None:
+            return
+
         # Update valveCommands
         print('updating valve commands')
-        self.valveCommands.loadCommands(xml_file_path = self.command_xml_path)
+        self.valveCommands.loadCommands(xml_file_path = self.command_xml_path,
+                                        configuration = configuration)
 
         # Update pumpCommands
-        self.pumpCommands.loadCommands(xml_file_path = self.command_xml_path)
+        self.pumpCommands.loadCommands(xml_file_path = self.command_xml_path,
+                                       configuration = configuration)
+        self.engine.setCommands(configuration.valve_commands, configuration.pump_commands)
       
-        # Parse XML
-        self.parseProtocolXML()
+        # Update protocols
+        self.parseProtocolXML(configuration)
 
         # Update GUI
         self.updateGUI()
@@ -318,35 +331,21 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     # ------------------------------------------------------------------------------------
     # Parse loaded xml file: load protocols
     # ------------------------------------------------------------------------------------                                        
-    def parseProtocolXML(self):
-        try:
-            print("Parsing for protocols: " + self.protocol_xml_path)
-            self.xml_tree = elementTree.parse(self.protocol_xml_path)
-            self.kilroy_configuration = self.xml_tree.getroot()
-        except:
-            print("Valid xml file not loaded")
-            return
-
-        # Clear previous commands
-        self.protocol_names = []
-        self.protocol_commands = []
-        self.protocol_durations = []
-        self.num_protocols = 0
-        
-        # Load commands
-        for kilroy_protocols in self.kilroy_configuration.findall("kilroy_protocols"):
-            protocol_list = kilroy_protocols.findall("protocol")
-            for protocol in protocol_list:
-                self.protocol_names.append(protocol.get("name"))
-                new_protocol_commands = []
-                new_protocol_durations = []
-                for command in protocol: # Get all children
-                    new_protocol_durations.append(int(command.get("duration")))
-                    new_protocol_commands.append([command.tag,command.text]) # [Instrument Type, Command Name]
-                    if (not (command.tag == "pump")) and (not (command.tag == "valve")):
-                        print("Unknown command tag: " + command.tag)
-                self.protocol_commands.append(new_protocol_commands)
-                self.protocol_durations.append(new_protocol_durations)
+    def parseProtocolXML(self, configuration = None):
+        # Parse file if a configuration was not provided
+        if configuration is None:
+            configuration = loadConfiguration(self.protocol_xml_path, verbose = self.verbose)
+            if configuration is None:
+                return
+        self.configuration = configuration
+
+        # Load protocols
+        protocols = configuration.protocols
+        self.protocol_names = protocols.names
+        self.protocol_commands = protocols.commands # (Instrument Type, Command Name)
+        self.protocol_durations = protocols.durations
+        self.protocol_total_durations = protocols.total_durations
+        self.engine.setProtocols(protocols)
 
         # Record number of configs
         self.num_protocols = len(self.protocol_names)
@@ -368,133 +367,49 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     # ------------------------------------------------------------------------------------                                                
     def requiredTime(self, protocol_name):
         protocol_ID = self.protocol_names.index(protocol_name)
-        total_time = 0.0
-        for time in self.protocol_durations[protocol_ID]:
-            total_time += time
-
-        return total_time
+        return float(self.protocol_total_durations[protocol_ID])
         
     # ------------------------------------------------------------------------------------
-    # Initialize and start a protocol and issue first command
+    # Skip the rest of the current command
     # ------------------------------------------------------------------------------------
     def skipCommand(self):
-        self.protocol_timer.stop()
-        self.advanceProtocol()
+        self.engine.skipCommand()
 
     # ------------------------------------------------------------------------------------
-    # Initialize and start a protocol and issue first command
+    # Initialize and start the selected protocol
     # ------------------------------------------------------------------------------------
-    def startProtocol(self):
+    def startProtocol(self, message = None):
         protocol_ID = self.protocolListWidget.currentRow()
-        
-        # Get first command in protocol
-        command_data = self.protocol_commands[protocol_ID][0]
-        command_duration = self.protocol_durations[protocol_ID][0]
+        if protocol_ID >= 0:
+            self.engine.startProtocolByName(self.protocol_names[protocol_ID], message = message)
 
-        # Set protocol status: [protocol_ID, command_ID]
-        self.status = [protocol_ID, 0]
-        self.status_change_signal.emit() # emit status change signal
-        
-        if self.verbose:
-            print("Starting " + self.protocol_names[protocol_ID])
-
-        # Start elapsed time timer
-        self.elapsed_timer.start()
-        self.poll_elapsed_time_timer.start()
-
-        # Issue command signal
-        self.issueCommand(command_data, command_duration)
-
-        # Change enable status of GUI items
-        self.startProtocolButton.setEnabled(False)
-        self.skipCommandButton.setEnabled(True)
-        self.stopProtocolButton.setEnabled(True)
-        self.protocolListWidget.setEnabled(False)
-        self.protocolDetailsList.setCurrentRow(0)
-        self.valveCommands.setEnabled(False)
-        self.pumpCommands.setEnabled(False)
-        
     # ------------------------------------------------------------------------------------
     # Initialize and start a protocol specified by name
     # ------------------------------------------------------------------------------------
-    def startProtocolByName(self, protocol_name):
+    def startProtocolByName(self, protocol_name, message = None):
         if self.isValidProtocol(protocol_name):
-            if self.isRunningProtocol():
-                if self.verbose:
-                    print("Stopped In Progress: " + self.protocol_names[self.status[0]])
-                self.stopProtocol() # Abort protocol in progress
-
-            # Find protocol and set as active element 
-            protocol_ID = self.protocol_names.index(protocol_name)
-            self.protocolListWidget.setCurrentRow(protocol_ID)
-
-            # Run protocol
-            self.startProtocol()
+            self.engine.startProtocolByName(protocol_name, message = message)
 
     # ------------------------------------------------------------------------------------
     # Handle the local start button
     # ------------------------------------------------------------------------------------
     def startProtocolLocally(self):
-        # Run protocol
-        self.received_message = None # Remove existing messages
         self.startProtocol()
 
     # ------------------------------------------------------------------------------------
-    # Initialize and start a protocol specified by a TCP message
+    # Initialize and start a protocol specified by a TCP message: the message is
+    # returned with the completed protocol signal
     # ------------------------------------------------------------------------------------
-    def startProtocolRemotely(self, message, protocol_name):
-        #protocol_name = message.getData("name")
-        if self.isValidProtocol(protocol_name):
-            if self.isRunningProtocol():
-                if self.verbose:
-                    print("Stopped In Progress: " + self.protocol_names[self.status[0]])
-                self.stopProtocol() # Abort protocol in progress
-
-            # Find protocol and set as active element 
-            protocol_ID = self.protocol_names.index(protocol_name)
-            self.protocolListWidget.setCurrentRow(protocol_ID)
-
-            # Run protocol
-            self.received_message = message
-            self.startProtocol()
+    def startProtocolRemotely(self, message, protocol_name = None):
+        if protocol_name is None:
+            protocol_name = message.getData("name")
+        self.startProtocolByName(protocol_name, message = message)
             
     # ------------------------------------------------------------------------------------
-    # Stop a running protocol either on completion or early
+    # Stop a running protocol early
     # ------------------------------------------------------------------------------------               
     def stopProtocol(self):
-        # Get name of current protocol
-        if self.status[0] >= 0:
-            if self.verbose: print("Stopped Protocol")
-        
-        # Reset status and emit status change signal
-        self.status = [-1,-1]
-        self.status_change_signal.emit()
-        self.received_message = None
-        
-        # Stop timer
-        self.protocol_timer.stop()
-
-        # Re-enable GUI
-        self.startProtocolButton.setEnabled(True)
-        self.protocolListWidget.setEnabled(True)
-        self.skipCommandButton.setEnabled(False)
-        self.stopProtocolButton.setEnabled(False)
-        self.valveCommands.setEnabled(True)
-        self.pumpCommands.setEnabled(True)
-        
-        # Unselect all
-        self.protocolDetailsList.setCurrentRow(0)
-        try:
-            self.protocolDetailsList.item(0).setSelected(False)
-        except:
-            print('unselect all failed')
-    
-        # Stop timers
-        self.poll_elapsed_time_timer.stop()
-        self.elapsedTimeLabel.setText("Elapsed Time:")
-        
-        # transfer stop signal
-        self.completed_protocol_signal.emit(self.received_message)
+        self.engine.stopProtocol()
 
     # ------------------------------------------------------------------------------------
     # Display time elapsed since previous command was issued
@@ -548,6 +463,46 @@ class KilroyProtocols(QtWidgets.QMainWindow):
             self.protocolDetailsList.insertItem(ID, wid)
         self.totalDurationLabel.setText(f'Total Protocol Duration : {self.totalduration} s')
 
+    # ------------------------------------------------------------------------------------
+    # Update the GUI for a protocol status change: [protocol_ID, command_ID]
+    # ------------------------------------------------------------------------------------                                                        
+    def updateStatus(self, status):
+        if status[0] >= 0:
+            # Display the running protocol and start elapsed time timer
+            if not self.poll_elapsed_time_timer.isActive():
+                self.protocolListWidget.setCurrentRow(status[0])
+                self.elapsed_timer.start()
+                self.poll_elapsed_time_timer.start()
+
+            # Change enable status of GUI items
+            self.startProtocolButton.setEnabled(False)
+            self.skipCommandButton.setEnabled(True)
+            self.stopProtocolButton.setEnabled(True)
+            self.protocolListWidget.setEnabled(False)
+            self.valveCommands.setEnabled(False)
+            self.pumpCommands.setEnabled(False)
+        else:
+            # Re-enable GUI
+            self.startProtocolButton.setEnabled(True)
+            self.protocolListWidget.setEnabled(True)
+            self.skipCommandButton.setEnabled(False)
+            self.stopProtocolButton.setEnabled(False)
+            self.valveCommands.setEnabled(True)
+            self.pumpCommands.setEnabled(True)
+
+            # Unselect all
+            self.protocolDetailsList.setCurrentRow(0)
+            try:
+                self.protocolDetailsList.item(0).setSelected(False)
+            except:
+                print('unselect all failed')
+
+            # Stop timers
+            self.poll_elapsed_time_timer.stop()
+            self.elapsedTimeLabel.setText("Elapsed Time:")
+
+        self.status_change_signal.emit()
+
 
 # ----------------------------------------------------------------------------------------
 # Stand Alone Test Class
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A class to schedule the commands of a kilroy protocol against absolute deadlines.
+# Each command's deadline is computed from the protocol start time on a monotonic
+# clock, so time spent in GUI updates, blocking serial I/O or timer jitter delays a
+# single command but never accumulates over the course of a protocol (or over a chain
+# of protocols started back to back). The lateness of every issued command is recorded.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import time
+
+# ----------------------------------------------------------------------------------------
+# ProtocolScheduler Class Definition
+# ----------------------------------------------------------------------------------------
+class ProtocolScheduler(object):
+    def __init__(self,
+                 clock = time.monotonic,
+                 verbose = False):
+
+        # Initialize internal attributes
+        self.clock = clock
+        self.verbose = verbose
+        self.start_time = None
+        self.issue_times = []   # Scheduled time at which each command is issued
+        self.end_time = None    # Scheduled time at which the last command ends
+        self.lateness = []      # (command_ID, seconds late) for each issued command
+
+    # ------------------------------------------------------------------------------------
+    # Delay the end of the given command (and the rest of the protocol) to end_time if
+    # it is scheduled to end earlier, e.g. for a move that takes longer than the command.
+    # Returns the delay (s).
+    # ------------------------------------------------------------------------------------
+    def delay(self, command_ID, end_time):
+        offset = end_time - self.getDeadline(command_ID)
+        if offset <= 0:
+            return 0.0
+        for ID in range(command_ID + 1, len(self.issue_times)):
+            self.issue_times[ID] += offset
+        self.end_time += offset
+        return offset
+
+    # ------------------------------------------------------------------------------------
+    # Return the deadline at which the given command ends and the next one is issued
+    # ------------------------------------------------------------------------------------
+    def getDeadline(self, command_ID):
+        if command_ID + 1 < len(self.issue_times):
+            return self.issue_times[command_ID + 1]
+        return self.end_time
+
+    # ------------------------------------------------------------------------------------
+    # Return the scheduled end time of the protocol
+    # ------------------------------------------------------------------------------------
+    def getEndTime(self):
+        return self.end_time
+
+    # ------------------------------------------------------------------------------------
+    # Return the scheduled time at which the given command is issued
+    # ------------------------------------------------------------------------------------
+    def getIssueTime(self, command_ID):
+        return self.issue_times[command_ID]
+
+    # ------------------------------------------------------------------------------------
+    # Return recorded lateness: [(command_ID, seconds late), ...]
+    # ------------------------------------------------------------------------------------
+    def getLateness(self):
+        return self.lateness
+
+    # ------------------------------------------------------------------------------------
+    # Return the worst lateness (s) of the issued commands
+    # ------------------------------------------------------------------------------------
+    def getMaxLateness(self):
+        if not self.lateness:
+            return 0.0
+        return max(late for [command_ID, late] in self.lateness)
+
+    # ------------------------------------------------------------------------------------
+    # Return a one line summary of the command timing
+    # ------------------------------------------------------------------------------------
+    def getSummary(self):
+        if not self.lateness:
+            return "No commands issued"
+        mean_lateness = sum(late for [command_ID, late] in self.lateness)/len(self.lateness)
+        text = str(len(self.lateness)) + " commands issued, "
+        text += "mean lateness " + "%0.1f" % (1000.0*mean_lateness) + " ms, "
+        text += "max lateness " + "%0.1f" % (1000.0*self.getMaxLateness()) + " ms"
+        return text
+
+    # ------------------------------------------------------------------------------------
+    # Return the time (s) remaining until the given command ends (never negative)
+    # ------------------------------------------------------------------------------------
+    def getTimeRemaining(self, command_ID):
+        deadline = self.getDeadline(command_ID)
+        if deadline is None:
+            return 0.0
+        return max(0.0, deadline - self.clock())
+
+    # ------------------------------------------------------------------------------------
+    # Record the lateness of a command relative to its scheduled issue time
+    # ------------------------------------------------------------------------------------
+    def recordIssue(self, command_ID):
+        late = self.clock() - self.issue_times[command_ID]
+        self.lateness.append((command_ID, late))
+        if self.verbose and late > 0.1:
+            print("Command " + str(command_ID+1) + " issued " + "%0.1f" % (1000.0*late) + " ms late")
+        return late
+
+    # ------------------------------------------------------------------------------------
+    # Reschedule the remaining commands so that the given command is issued now (e.g.
+    # when a command is skipped) or at issue_time (e.g. when a command is resumed)
+    # ------------------------------------------------------------------------------------
+    def rebase(self, command_ID, issue_time = None):
+        if command_ID >= len(self.issue_times):
+            return
+        if issue_time is None:
+            issue_time = self.clock()
+        offset = issue_time - self.issue_times[command_ID]
+        for ID in range(command_ID, len(self.issue_times)):
+            self.issue_times[ID] += offset
+        self.end_time += offset
+
+    # ------------------------------------------------------------------------------------
+    # Compute absolute deadlines for a list of command durations (s). If start_time is
+    # provided (e.g. the scheduled end of the previous protocol) the schedule is anchored
+    # to it instead of the current time. Start times in the future are ignored.
+    # ------------------------------------------------------------------------------------
+    def start(self, durations, start_time = None):
+        now = self.clock()
+        if start_time is None or start_time > now:
+            start_time = now
+        self.start_time = start_time
+        self.issue_times = []
+        self.lateness = []
+
+        elapsed = 0.0
+        for duration in durations:
+            self.issue_times.append(start_time + elapsed)
+            elapsed += duration
+        self.end_time = start_time + elapsed
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    scheduler = ProtocolScheduler(verbose = True)
+    scheduler.start([0.2, 0.1, 0.3])
+    for command_ID in range(3):
+        scheduler.recordIssue(command_ID)
+        time.sleep(0.02) # Simulated blocking serial I/O does not delay later commands
+        time.sleep(scheduler.getTimeRemaining(command_ID))
+    print(scheduler.getSummary())
@@ -12,8 +12,8 @@
 # ----------------------------------------------------------------------------------------
 import sys
 import os
-import xml.etree.ElementTree as elementTree
 from PyQt5 import QtCore, QtGui, QtWidgets
+from kilroyConfiguration import loadConfiguration, Registry
 
 # ----------------------------------------------------------------------------------------
 # PumpCommands Class Definition
@@ -25,13 +25,14 @@ class PumpCommands(QtWidgets.QMainWindow):
     
     def __init__(self,
                  xml_file_path="default_config.xml",
+                 configuration = None,
                  verbose = False):
         super(PumpCommands, self).__init__()
 
         # Initialize internal attributes
         self.verbose = verbose
         self.file_name = xml_file_path
-        self.command_names = []
+        self.command_names = Registry()
         self.commands = []
         self.num_commands = 0
         self.num_pumps = 0
@@ -40,7 +41,8 @@ class PumpCommands(QtWidgets.QMainWindow):
         self.createGUI()
 
         # Load Configurations
-        self.loadCommands(xml_file_path = self.file_name)
+        self.loadCommands(xml_file_path = self.file_name,
+                          configuration = configuration)
 
     # ------------------------------------------------------------------------------------
     # Create display and control widgets
@@ -103,12 +105,11 @@ class PumpCommands(QtWidgets.QMainWindow):
     # Return a command indexed by its name
     # ------------------------------------------------------------------------------------        
     def getCommandByName(self, command_name):
-        try:
-            command_ID = self.command_names.index(command_name)
-            return self.commands[command_ID]
-        except:
+        command_ID = self.command_names.getID(command_name)
+        if command_ID < 0:
             print("Did not find " + command_name)
             return [-1]*self.num_valves # Return no change command
+        return self.commands[command_ID]
 
     # ------------------------------------------------------------------------------------
     # Return the names of the current defined commands
@@ -123,9 +124,10 @@ class PumpCommands(QtWidgets.QMainWindow):
         return self.num_commands
 
     # ------------------------------------------------------------------------------------
-    # Load and parse a XML file with defined commands
+    # Load and parse a XML file with defined commands: an already parsed
+    #   KilroyConfiguration can be provided to avoid parsing the file again
     # ------------------------------------------------------------------------------------
-    def loadCommands(self, xml_file_path = ""):
+    def loadCommands(self, xml_file_path = "", configuration = None):
         # Set Configuration XML (load if needed)
         if not xml_file_path:
             xml_file_path = QtGui.QFileDialog.getOpenFileName(self, "Open File", "\home")
@@ -135,7 +137,7 @@ class PumpCommands(QtWidgets.QMainWindow):
         self.file_name = xml_file_path
         
         # Parse XML
-        self.parseCommandXML()
+        self.parseCommandXML(configuration)
 
         # Update GUI
         self.updateGUI()
@@ -147,41 +149,18 @@ class PumpCommands(QtWidgets.QMainWindow):
     # ------------------------------------------------------------------------------------
     # Parse the command xml file
     # ------------------------------------------------------------------------------------        
-    def parseCommandXML(self):
-        # Try loading file
-        try:
-            print("Parsing for commands: " + self.file_name)
-            self.xml_tree = elementTree.parse(self.file_name)
-            self.kilroy_configuration = self.xml_tree.getroot()
-        except:
-            print("Valid xml file not loaded")
-            return
+    def parseCommandXML(self, configuration = None):
+        # Parse file if a configuration was not provided
+        if configuration is None:
+            configuration = loadConfiguration(self.file_name, verbose = self.verbose)
+            if configuration is None:
+                return
 
-        # Clear previous commands
-        self.command_names = []
-        self.commands = []
-        self.num_commands = 0
-
-        # Load number of valves
-        self.num_pumps = int(self.kilroy_configuration.get("num_pumps"))
-        if not (self.num_pumps>0):
-            print("Number of pumps not specified")
-        
         # Load commands
-        for pump_command in self.kilroy_configuration.findall("pump_commands"):
-            command_list = pump_command.findall("pump_cmd")
-            for command in command_list:
-                for pump_config in command.findall("pump_config"):
-                    speed = float(pump_config.get("speed"))
-                    direction = pump_config.get("direction")
-                    if speed < 0.00 or speed > 48.0:
-                        speed = 0.0
-                        direction = "Stopped" # Flag for stopped flow
-                    direction = {"Forward": "Forward", "Reverse": "Reverse"}.get(direction, "Stopped")
-                    
-                # Add command
-                self.commands.append([direction, speed])
-                self.command_names.append(command.get("name"))
+        pump_commands = configuration.pump_commands
+        self.command_names = pump_commands.names
+        self.commands = pump_commands.commands
+        self.num_pumps = pump_commands.num_pumps
 
         # Record number of configs
         self.num_commands = len(self.command_names)
@@ -203,7 +182,7 @@ class PumpCommands(QtWidgets.QMainWindow):
     # Update active command on GUI
     # ------------------------------------------------------------------------------------                
     def setActiveCommand(self, command_name):
-        command_ID = self.command_names.index(command_name)
+        command_ID = self.command_names.getID(command_name)
         self.commandListWidget.setCurrentRow(command_ID)
         self.updateCommandDisplay()
 
@@ -0,0 +1,7 @@
+# Kilroy modules are imported as in kilroy.py, relative to the fluidics directory
+import os
+import sys
+
+FLUIDICS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if FLUIDICS_PATH not in sys.path:
+    sys.path.insert(0, FLUIDICS_PATH)
@@ -0,0 +1,247 @@
+import json
+import os
+import threading
+import time
+
+from valves.autopicker_grbl import GRBL
+
+LAYOUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "valves", "XYZ_layout.json")
+
+
+class FakeGRBL(object):
+    """A serial port to grbl 1.1: lines are answered in order from its receive buffer,
+    moves complete at once and '?' is answered with a status report."""
+
+    def __init__(self, banner = False, state = "Idle", position = (0.0, 0.0, 0.0), offset = (0.0, 0.0, 0.0), settings = None):
+        self.condition = threading.Condition()
+        self.output = bytearray()
+        self.received = bytearray()
+        self.max_received = 0
+        self.lines = []
+        self.paused = False             # Leave the received lines in the receive buffer
+        self.alarm_on_move = False      # e.g. a limit switch is hit
+        self.is_open = True
+        self.timeout = None
+        self.state = state
+        self.position = list(position)  # MPos
+        self.offset = list(offset)      # WCO
+        self.settings = {22: 0.0, 110: 500.0, 111: 500.0, 112: 500.0, 120: 10.0, 121: 10.0, 122: 10.0}
+        self.settings.update(settings or {})
+        if banner:
+            self.output += b"\r\nGrbl 1.1h ['$' for help]\r\n"
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def write(self, data):
+        with self.condition:
+            for byte in data:
+                if byte == ord("?"):
+                    self.output += self.status().encode()
+                else:
+                    self.received.append(byte)
+            self.max_received = max(self.max_received, len(self.received))
+            self.condition.notify_all()
+        return len(data)
+
+    def readline(self):
+        with self.condition:
+            self.condition.wait_for(lambda: b"\n" in self.output or not self.is_open, self.timeout)
+            end = self.output.index(b"\n") + 1 if b"\n" in self.output else len(self.output)
+            data = bytes(self.output[:end])
+            del self.output[:end]
+            return data
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def status(self):
+        return "<%s|MPos:%.3f,%.3f,%.3f|FS:0,0|WCO:%.3f,%.3f,%.3f>\r\n" % tuple([self.state] + self.position + self.offset)
+
+    def run(self):
+        with self.condition:
+            while self.is_open:
+                if self.paused or b"\n" not in self.received:
+                    self.condition.wait(0.01)
+                    continue
+                end = self.received.index(b"\n") + 1
+                line = self.received[:end].decode().strip()
+                del self.received[:end]
+                self.lines.append(line)
+                self.output += self.execute(line).encode()
+                self.condition.notify_all()
+
+    def execute(self, line):
+        if line == "":
+            return "ok\r\n"
+        if line == "$H":
+            [self.state, self.position] = ["Idle", [0.0, 0.0, 0.0]]
+            return "ok\r\n"
+        if line == "$X":
+            self.state = "Idle"
+            return "[MSG:Caution: Unlocked]\r\nok\r\n"
+        if line == "$$":
+            return "".join("$%d=%.3f\r\n" % item for item in sorted(self.settings.items())) + "ok\r\n"
+        if line == "$#":
+            return "[G54:0.000,0.000,0.000]\r\n[G92:%.3f,%.3f,%.3f]\r\nok\r\n" % tuple(self.offset)
+        if self.state == "Alarm":
+            return "error:9\r\n"
+        words = dict((word[0], float(word[1:])) for word in line.split())
+        axes = [(axis_ID, words[axis]) for axis_ID, axis in enumerate("XYZ") if axis in words]
+        if words.get("G") == 92:
+            for axis_ID, value in axes:
+                self.offset[axis_ID] = self.position[axis_ID] - value
+        elif words.get("G") in (0, 1):
+            for axis_ID, value in axes:
+                self.position[axis_ID] = value + self.offset[axis_ID]
+            if self.alarm_on_move:
+                self.state = "Alarm"
+                return "ok\r\nALARM:1\r\n"
+        else:
+            return "error:20\r\n"
+        return "ok\r\n"
+
+
+def makeGRBL(port, **kwargs):
+    kwargs.setdefault("state_file", None)
+    return GRBL(com_port = "fake", config = LAYOUT, serial_port = port, **kwargs)
+
+
+def saveState(tmp_path, position):
+    state_file = str(tmp_path / "grbl_state.json")
+    with open(state_file, "w") as output_file:
+        json.dump({"com_port": "fake", "homed": True, "at_rest": True, "work_position": position,
+                   "machine_position": None, "work_offset": [0.0, 0.0, 0.0]}, output_file)
+    return state_file
+
+
+def test_ok_and_error_answer_their_lines(capsys):
+    port = FakeGRBL()
+    grbl = makeGRBL(port)
+    try:
+        for command in ["G00 X1 Y1", "G05", "G00 X2 Y2"]:
+            grbl.sendCommand(command)
+        assert grbl.flush() == "ok"
+        assert not grbl.pending_lines
+        assert "GRBL error:20 for: G05" in capsys.readouterr().out
+        assert port.lines[-3:] == ["G00 X1 Y1", "G05", "G00 X2 Y2"]
+    finally:
+        grbl.close()
+
+
+def test_lines_wait_for_room_in_the_receive_buffer():
+    port = FakeGRBL()
+    grbl = makeGRBL(port)
+    try:
+        port.paused = True
+        commands = ["G01 X%d.000 Y%d.000 F2000" % (i, i) for i in range(20)]
+        sender = threading.Thread(target = lambda: [grbl.sendCommand(command) for command in commands])
+        sender.start()
+        time.sleep(0.2)
+        assert sender.is_alive() # Blocked on a full receive buffer
+        assert grbl.rx_buffer_size - len(commands[0]) < port.max_received <= grbl.rx_buffer_size
+
+        port.resume()
+        sender.join(5.0)
+        grbl.flush()
+        assert port.lines[-len(commands):] == commands
+        assert port.max_received <= grbl.rx_buffer_size
+    finally:
+        grbl.close()
+
+
+def test_wait_records_the_position_of_a_transfer():
+    grbl = makeGRBL(FakeGRBL())
+    try:
+        grbl.set((10.0, 20.0, 0.0))
+        assert grbl.position == (0.0, 0.0, 0.0) # Not there yet
+        assert grbl.wait(timeout = 5)
+        assert grbl.position == (10.0, 20.0, -37.0)
+    finally:
+        grbl.close()
+
+
+def test_alarm_during_wait_keeps_the_last_position():
+    port = FakeGRBL()
+    grbl = makeGRBL(port)
+    try:
+        port.alarm_on_move = True
+        grbl.set((10.0, 20.0, 0.0))
+        assert not grbl.wait(timeout = 5)
+        assert grbl.position == (0.0, 0.0, 0.0)
+        assert grbl.target == [0.0, 0.0, 0.0]
+    finally:
+        grbl.close()
+
+
+def test_grbl_homed_with_homing_enabled_is_not_homed_again():
+    port = FakeGRBL(position = (30.0, 20.0, -2.0), offset = (10.0, 10.0, 5.0), settings = {22: 1})
+    grbl = makeGRBL(port)
+    try:
+        assert "$H" not in port.lines
+        assert grbl.position == (20.0, 10.0, -7.0)
+    finally:
+        grbl.close()
+
+
+def test_grbl_at_the_saved_position_is_not_homed_again(tmp_path):
+    port = FakeGRBL(position = (30.0, 20.0, -2.0), offset = (10.0, 10.0, 5.0))
+    grbl = makeGRBL(port, state_file = saveState(tmp_path, [20.0, 10.0, -7.0]))
+    try:
+        assert "$H" not in port.lines
+        assert grbl.position == (20.0, 10.0, -7.0)
+    finally:
+        grbl.close()
+
+
+def test_idle_grbl_without_a_homed_signal_is_homed(tmp_path):
+    for state_file in [None, saveState(tmp_path, [25.0, 15.0, -37.0])]: # No state, moved since
+        port = FakeGRBL(position = (30.0, 20.0, -2.0), offset = (10.0, 10.0, 5.0))
+        grbl = makeGRBL(port, state_file = state_file)
+        try:
+            assert port.lines[-2:] == ["$H", "G92 X0 Y0 Z0"]
+            assert grbl.position == (0.0, 0.0, 0.0)
+        finally:
+            grbl.close()
+
+
+def test_reset_is_homed_again(tmp_path):
+    port = FakeGRBL(banner = True, state = "Alarm")
+    grbl = makeGRBL(port, state_file = saveState(tmp_path, [25.0, 15.0, -37.0]))
+    try:
+        assert port.lines[-2:] == ["$H", "G92 X0 Y0 Z0"]
+        assert grbl.position == (0.0, 0.0, 0.0)
+    finally:
+        grbl.close()
+
+
+def test_reset_restores_the_saved_position_when_asked(tmp_path):
+    port = FakeGRBL(banner = True, state = "Alarm")
+    grbl = makeGRBL(port, state_file = saveState(tmp_path, [25.0, 15.0, -37.0]), restore_position = True)
+    try:
+        assert "$H" not in port.lines
+        assert port.lines[-2:] == ["$X", "G92 X25.0 Y15.0 Z-37.0"]
+        assert grbl.position == (25.0, 15.0, -37.0)
+    finally:
+        grbl.close()
+
+
+def test_transfer_time_is_estimated_from_the_settings():
+    port = FakeGRBL(settings = {110: 6000.0, 111: 3000.0, 120: 200.0, 121: 100.0})
+    grbl = makeGRBL(port)
+    try:
+        assert grbl.max_rates == [6000.0, 3000.0, 500.0]
+        assert grbl.accelerations == [200.0, 100.0, 10.0]
+        grbl.get_wells()
+        estimate = grbl.estimate_move(5, 0)
+        assert estimate > 0
+        assert grbl.move(5, 0)
+        assert grbl.program_time == estimate
+        assert grbl.estimate_move(5, 0) == 0.0 # Already there
+    finally:
+        grbl.close()
@@ -0,0 +1,36 @@
+import os
+
+import numpy
+
+from valves.autopicker import MockAutopicker
+from valves.cnc_path import max_distance_fix, max_distance_fix_loop, plate_tour
+
+FLUIDICS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_planner_splits_like_the_loop():
+    random = numpy.random.RandomState(0)
+    path = [[0.0, 0.0, 0.0]]
+    for i in range(50):
+        point = list(random.uniform(-100, 100, 3))
+        path.append([None if random.rand() < 0.3 else x for x in point])
+    for max_distance in [10, 50, 1000]:
+        planned = max_distance_fix(path, max_distance)
+        reference = max_distance_fix_loop(path, max_distance)
+        assert len(planned) == len(reference)
+        for p, q in zip(planned, reference):
+            assert all((a is None and b is None) or abs(a - b) < 1e-9 for a, b in zip(p, q))
+
+
+def test_plate_tour_visits_every_well(monkeypatch):
+    monkeypatch.chdir(FLUIDICS) # MockAutopicker loads ./valves/VWR_Plate_Lid.json
+    picker = MockAutopicker()
+    visited = []
+    monkeypatch.setattr(picker, "set", lambda position: visited.append(list(position)))
+    plate = picker.plates[0]
+    plate.tour()
+
+    wells = [list(plate.find_position(x, y)) for x, y in plate.locations()]
+    tour = plate_tour(wells, plate.height)
+    assert visited == max_distance_fix_loop([[0, 0, 0]] + tour)
+    assert [p for p in visited if p in wells] == wells
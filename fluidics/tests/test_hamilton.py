@@ -0,0 +1,101 @@
+import time
+
+from valves.hamilton import HamiltonMVP
+from valves.hamiltonSimulator import SimulatedMVPChain
+
+
+class RawMVPPort(object):
+    """A serial port to one 8 port Hamilton MVP at address a, answering with the device
+    bytes: ACK or data followed by a carriage return, or a lone NAK."""
+
+    def __init__(self):
+        self.timeout = None
+        self.output = b""
+        self.messages = []
+
+    @property
+    def in_waiting(self):
+        return len(self.output)
+
+    def read(self, size = 1):
+        [data, self.output] = [self.output[:size], self.output[size:]]
+        return data
+
+    def reset_input_buffer(self):
+        self.output = b""
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        for message in data.decode().split("\r")[:-1]:
+            self.messages.append(message)
+            self.output += {"1a": b"\x06\r",
+                            "aLXR": b"\x06\r",
+                            "aLQT": b"2\r",
+                            "aLQP": b"3\r",
+                            "aF": b"Y\r",
+                            "aG": b"N\r"}.get(message, b"\x15" if message.startswith("a") else b"")
+        return len(data)
+
+
+def makeChain(num_valves = 2, **kwargs):
+    return HamiltonMVP(serial_port = SimulatedMVPChain(num_valves = num_valves, **kwargs), topology_file = None)
+
+
+def test_status_polls_run_on_the_serial_worker():
+    hamilton = makeChain(move_time = 0.0)
+    try:
+        assert not hamilton.simulate
+        assert hamilton.changePort(1, 4)
+        for repeat in range(5): # Polls of a valve with a queued poll are skipped
+            for valve_ID in range(2):
+                hamilton.requestStatus(valve_ID)
+        deadline = time.time() + 5.0
+        while len(hamilton.status_cache) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert hamilton.getCachedStatus(0) == ("Port 1", False)
+        assert hamilton.getCachedStatus(1) == ("Port 5", False)
+    finally:
+        hamilton.close()
+
+
+def test_responses_are_framed_by_carriage_returns():
+    port = RawMVPPort()
+    hamilton = HamiltonMVP(serial_port = port, topology_file = None)
+    try:
+        assert hamilton.howManyValves() == 1
+        assert hamilton.valve_configs == ["8 ports"]
+        assert hamilton.inquireAndRespond(0, "LQP\r", {"3": "Port 3"}) == ("Port 3", True, "3\r")
+        assert hamilton.inquireAndRespond(0, "LXR\r")[:2] == ("Acknowledge", True)
+        assert hamilton.inquireAndRespond(0, "LP09R\r")[:2] == ("Negative Acknowledge", False)
+
+        # Complete responses set the probe deadline: the missing valve b is not waited for
+        assert hamilton.response_time is not None
+        assert hamilton.getProbeTimeout() < hamilton.probe_timeout
+    finally:
+        hamilton.close()
+
+
+def test_simulated_chain_answers_with_the_device_bytes():
+    chain = SimulatedMVPChain(num_valves = 1, move_time = 0.0)
+    assert chain.handleMessage("1a") == "\x06\r"
+    assert chain.handleMessage("aLQP") == "1\r"
+    assert chain.handleMessage("aLP09R") == "\x15"
+    assert chain.handleMessage("bLQP") is None
+
+
+def test_saved_chain_is_initialized(tmp_path):
+    topology_file = str(tmp_path / "hamilton_chain.json")
+    chain = SimulatedMVPChain(num_valves = 2, move_time = 0.0)
+    hamilton = HamiltonMVP(com_port = "sim", serial_port = chain, topology_file = topology_file)
+    assert hamilton.changePort(1, 4)
+    hamilton.close()
+
+    hamilton = HamiltonMVP(com_port = "sim", serial_port = chain, topology_file = topology_file)
+    try:
+        assert hamilton.howManyValves() == 2
+        assert chain.current_port == [0, 0] # LXR moves the valves to their first port
+        assert hamilton.current_port == [0, 0]
+    finally:
+        hamilton.close()
@@ -0,0 +1,72 @@
+import os
+
+from kilroyConfiguration import KilroyConfiguration
+
+CONFIGURATION = """<kilroy_configuration num_valves="1" num_pumps="1" cnc="True">
+  <valve_commands>
+    <valve_cmd name="Set Hyb {hyb}">
+      <parameters hyb="1-3" well="8-24:8" />
+      <parameters hyb="4" well="7" />
+      <valve_pos valve_ID="1" port_ID="2" />
+      <cnc_pos plate_ID="MultiWell" port_ID="{well}" />
+    </valve_cmd>
+  </valve_commands>
+  <pump_commands>
+    <pump_cmd name="Flow">
+      <pump_config speed="10.0" direction="Forward" />
+    </pump_cmd>
+  </pump_commands>
+  <kilroy_protocols>
+    <protocol name="Hybridize {hyb}">
+      <parameters hyb="1-4" />
+      <valve duration="{hyb}0">Set Hyb {hyb}</valve>
+      <pump duration="5">Flow</pump>
+    </protocol>
+    <protocol name="Rinse All">
+      <repeat hyb="1, 2">
+        <valve duration="1">Set Hyb {hyb}</valve>
+      </repeat>
+    </protocol>
+  </kilroy_protocols>
+</kilroy_configuration>
+"""
+
+
+def writeConfiguration(tmp_path, text = CONFIGURATION):
+    xml_file_path = tmp_path / "config.xml"
+    xml_file_path.write_text(text)
+    return str(xml_file_path)
+
+
+def test_templates_are_expanded(tmp_path):
+    configuration = KilroyConfiguration(writeConfiguration(tmp_path), use_cache = False)
+    valve_commands = configuration.valve_commands
+    assert list(valve_commands.names) == ["Set Hyb 1", "Set Hyb 2", "Set Hyb 3", "Set Hyb 4"]
+    assert valve_commands.commands[valve_commands.names.getID("Set Hyb 3")] == (1, ("MultiWell", 23))
+    assert valve_commands.commands[valve_commands.names.getID("Set Hyb 4")] == (1, ("MultiWell", 6))
+
+    protocols = configuration.protocols
+    protocol_ID = protocols.names.getID("Hybridize 2")
+    assert protocols.commands[protocol_ID] == (("valve", "Set Hyb 2"), ("pump", "Flow"))
+    assert protocols.durations[protocol_ID] == (20, 5)
+    assert protocols.total_durations[protocol_ID] == 25
+    protocol_ID = protocols.names.getID("Rinse All")
+    assert protocols.commands[protocol_ID] == (("valve", "Set Hyb 1"), ("valve", "Set Hyb 2"))
+
+
+def test_cache_is_used_until_the_file_changes(tmp_path):
+    xml_file_path = writeConfiguration(tmp_path)
+    parsed = KilroyConfiguration(xml_file_path)
+    assert not parsed.loaded_from_cache
+    assert os.path.isfile(xml_file_path + ".cache")
+
+    cached = KilroyConfiguration(xml_file_path)
+    assert cached.loaded_from_cache
+    assert list(cached.valve_commands.names) == list(parsed.valve_commands.names)
+    protocol_ID = cached.protocols.names.getID("Hybridize 4")
+    assert cached.protocols.durations[protocol_ID] == (40, 5)
+
+    writeConfiguration(tmp_path, CONFIGURATION.replace('duration="5"', 'duration="6"'))
+    changed = KilroyConfiguration(xml_file_path)
+    assert not changed.loaded_from_cache
+    assert changed.protocols.durations[protocol_ID] == (40, 6)
@@ -0,0 +1,177 @@
+import threading
+
+from kilroyCheckpoint import CheckpointJournal, addCheckpointHyperProtocol
+from kilroyConfiguration import HyperProtocolTable, ProtocolTable, Registry, getStepDuration, imagingStep, protocolStep, waitStep
+from kilroyEngine import KilroyEngine, VirtualClock
+
+
+def makeProtocols():
+    """Two protocols of [instrument, command name] commands and their durations (s)."""
+    commands = ((("valve", "Valve A"), ("pump", "Flow")), (("pump", "Stop"),))
+    durations = ((10.0, 20.0), (5.0,))
+    return ProtocolTable(Registry(["Hybridize", "Rinse"], "protocol"),
+                         commands,
+                         durations,
+                         tuple(sum(d) for d in durations))
+
+
+def makeEngine(**kwargs):
+    engine = KilroyEngine(clock = VirtualClock(), **kwargs)
+    engine.setProtocols(makeProtocols())
+    return engine
+
+
+def waitForEvent(engine, event_type):
+    """Return an Event set when the engine emits event_type."""
+    event_seen = threading.Event()
+    engine.addListener(lambda event: event_seen.set() if event.event_type == event_type else None)
+    return event_seen
+
+
+def test_failing_listener_does_not_stop_engine():
+    engine = makeEngine()
+    received = []
+
+    def failingListener(event):
+        raise RuntimeError("listener failed")
+
+    engine.addListener(failingListener)
+    engine.addListener(lambda event: received.append(event.event_type))
+    complete = waitForEvent(engine, "protocol complete")
+    engine.start()
+    try:
+        assert engine.startProtocolByName("Hybridize")
+        assert complete.wait(5)
+    finally:
+        engine.close()
+    assert received.count("command") == 2
+    assert "protocol complete" in received
+
+
+def checkpointAfter(engine, journal, seconds):
+    """The journaled checkpoint, as if kilroy stopped seconds after it was written."""
+    checkpoint = journal.loadCheckpoint()
+    checkpoint["time"] -= seconds
+    return checkpoint
+
+
+def test_resume_subtracts_elapsed_time(tmp_path):
+    journal = CheckpointJournal(file_path = str(tmp_path / "checkpoint.jsonl"))
+    engine = KilroyEngine()
+    engine.setProtocols(makeProtocols())
+    engine.setJournal(journal)
+    assert engine.startProtocolByName("Hybridize")
+    engine.skipCommand() # Command 2 (20 s) is journaled
+    checkpoint = checkpointAfter(engine, journal, 15.0)
+    assert checkpoint["command_ID"] == 1
+
+    resumed = KilroyEngine()
+    resumed.setProtocols(makeProtocols())
+    assert resumed.resume(checkpoint)
+    assert resumed.getStatus() == [0, 1]
+    assert 4.0 < resumed.getTimeRemaining() <= 5.0
+
+
+def makeHyperProtocols(steps):
+    """One hyperprotocol, "Run", of the given steps."""
+    protocols = makeProtocols()
+    return HyperProtocolTable(Registry(["Run"], "hyperprotocol"),
+                              (tuple(steps),),
+                              (tuple(getStepDuration(protocols, step) for step in steps),))
+
+
+def resumeHyperProtocol(tmp_path, steps, step_ID, seconds):
+    """Interrupt the hyperprotocol at step_ID and resume it seconds later."""
+    journal = CheckpointJournal(file_path = str(tmp_path / "checkpoint.jsonl"))
+    engine = KilroyEngine()
+    engine.setProtocols(makeProtocols())
+    engine.setHyperProtocols(makeHyperProtocols(steps))
+    engine.setJournal(journal)
+    engine.startHyperProtocolByName("Run")
+    while engine.getHyperStatus()[1] < step_ID:
+        engine.skipCommand()
+    assert engine.getHyperStatus() == [0, step_ID]
+    checkpoint = checkpointAfter(engine, journal, seconds)
+
+    resumed = KilroyEngine()
+    resumed.setProtocols(makeProtocols())
+    resumed.setHyperProtocols(addCheckpointHyperProtocol(resumed.hyperprotocols, checkpoint, resumed.protocols))
+    assert resumed.resume(checkpoint)
+    assert resumed.getHyperStatus() == [0, step_ID]
+    return resumed
+
+
+def test_resume_protocol_step(tmp_path):
+    resumed = resumeHyperProtocol(tmp_path, [protocolStep("Rinse"), protocolStep("Hybridize")], 1, 3.0)
+    assert resumed.getStatus() == [0, 0]
+    assert 6.0 < resumed.getTimeRemaining() <= 7.0
+
+
+def test_resume_wait_step(tmp_path):
+    resumed = resumeHyperProtocol(tmp_path, [protocolStep("Rinse"), waitStep(100), protocolStep("Rinse")], 1, 30.0)
+    assert resumed.isWaiting()
+    assert 69.0 < resumed.getTimeRemaining() <= 70.0
+
+
+def test_resume_imaging_step(tmp_path):
+    resumed = resumeHyperProtocol(tmp_path, [protocolStep("Rinse"), imagingStep(600, 100), protocolStep("Rinse")], 1, 30.0)
+    assert resumed.isWaiting()
+    assert 69.0 < resumed.getTimeRemaining() <= 70.0
+
+
+def test_protocol_named_like_a_wait_step_runs_as_a_protocol():
+    commands = ((("pump", "Stop"),),)
+    protocols = ProtocolTable(Registry(["Wait 5 s"], "protocol"), commands, ((2.0,),), (2.0,))
+    engine = KilroyEngine(clock = VirtualClock())
+    engine.setProtocols(protocols)
+    steps = [protocolStep("Wait 5 s")]
+    engine.setHyperProtocols(HyperProtocolTable(Registry(["Run"], "hyperprotocol"),
+                                                (tuple(steps),),
+                                                ((getStepDuration(protocols, steps[0]),),)))
+    engine.startHyperProtocolByName("Run")
+    assert not engine.isWaiting()
+    assert engine.getStatus() == [0, 0]
+
+
+def test_resume_keeps_the_journal_until_the_run_is_journaled(tmp_path):
+    journal = CheckpointJournal(file_path = str(tmp_path / "checkpoint.jsonl"))
+    engine = KilroyEngine()
+    engine.setProtocols(makeProtocols())
+    engine.setJournal(journal)
+    assert engine.startProtocolByName("Hybridize")
+    checkpoint = journal.loadCheckpoint()
+    with open(journal.file_path) as journal_file:
+        journaled = journal_file.read()
+
+    assert engine.resume(checkpoint) # Replaces the running protocol
+    with open(journal.file_path) as journal_file:
+        assert journal_file.read().startswith(journaled)
+
+
+def test_imaging_timeout_saves_no_time():
+    engine = makeEngine()
+    steps = [imagingStep(600, 100)]
+    engine.setHyperProtocols(makeHyperProtocols(steps))
+    engine.setHandshake(True)
+    imaging_events = []
+    engine.addListener(lambda event: imaging_events.append(event.data) if event.event_type == "imaging done" else None)
+    complete = waitForEvent(engine, "hyperprotocol complete")
+    engine.start()
+    try:
+        engine.startHyperProtocolByName("Run")
+        assert complete.wait(5)
+    finally:
+        engine.close()
+    assert imaging_events[0]["timed_out"]
+    assert imaging_events[0]["saved"] == 0.0
+
+
+def test_long_moves_delay_the_next_command():
+    engine = makeEngine()
+    engine.setDurationEstimator(lambda instrument, command: 25.0 if instrument == "valve" else 0.0)
+    durations = []
+    engine.addListener(lambda event: durations.append(event.data["duration"]) if event.event_type == "command" else None)
+    assert engine.startProtocolByName("Hybridize")
+    assert durations == [25.0]
+    assert 24.0 < engine.getTimeRemaining() <= 25.0
+    assert engine.getProtocolEndTime() - engine.scheduler.start_time == 45.0
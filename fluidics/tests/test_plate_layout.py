@@ -0,0 +1,35 @@
+import json
+from collections import namedtuple
+
+import numpy
+
+from valves.plate_layout import read_layout, well_coordinates, write_layout_cache
+
+CachedPlate = namedtuple("CachedPlate", ["name", "positions", "wells"])
+
+# Three corner wells of a flat plate: 9 mm pitch, z falls 1 mm per row
+POSITIONS = [[0, 0, [20.0, 20.0, -40.0]], [11, 0, [119.0, 20.0, -51.0]], [0, 7, [20.0, 83.0, -40.0]]]
+
+
+def test_well_coordinates_interpolate_every_well():
+    wells = well_coordinates(POSITIONS)[2]
+    assert wells.shape == (12, 8, 3)
+    assert numpy.allclose(wells[5, 3], [65.0, 47.0, -45.0])
+    assert numpy.isnan(wells[11, 7]).all() # Outside the recorded positions
+
+
+def test_cached_wells_are_used_until_the_plate_is_recalibrated(tmp_path):
+    path = str(tmp_path / "layout.json")
+    with open(path, "w") as layout_file:
+        json.dump([{"name": "A", "height": 0.0, "positions": POSITIONS}], layout_file)
+    assert "wells" not in read_layout(path)[0] # No cache yet
+
+    wells = well_coordinates(POSITIONS)[2]
+    write_layout_cache(path, [CachedPlate("A", POSITIONS, wells)])
+    config = read_layout(path)[0]
+    assert numpy.allclose(numpy.array(config["wells"], dtype = float), wells, equal_nan = True)
+
+    recalibrated = POSITIONS[:2] + [[0, 7, [20.0, 83.0, -41.0]]]
+    with open(path, "w") as layout_file:
+        json.dump([{"name": "A", "height": 0.0, "positions": recalibrated}], layout_file)
+    assert "wells" not in read_layout(path)[0]
@@ -0,0 +1,48 @@
+from protocolScheduler import ProtocolScheduler
+
+
+class FakeClock(object):
+    def __init__(self, now = 100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_deadlines_do_not_accumulate_lateness():
+    clock = FakeClock()
+    scheduler = ProtocolScheduler(clock = clock)
+    scheduler.start([10.0, 20.0, 5.0])
+    assert scheduler.issue_times == [100.0, 110.0, 130.0]
+    assert scheduler.getEndTime() == 135.0
+
+    clock.now = 112.0 # Command 2 is issued 2 s late
+    assert scheduler.recordIssue(1) == 2.0
+    assert scheduler.getTimeRemaining(1) == 18.0 # It still ends on time
+    assert scheduler.getMaxLateness() == 2.0
+
+
+def test_rebase_and_delay_move_the_rest_of_the_protocol():
+    clock = FakeClock()
+    scheduler = ProtocolScheduler(clock = clock)
+    scheduler.start([10.0, 20.0, 5.0])
+
+    clock.now = 104.0 # Command 1 is skipped
+    scheduler.rebase(1)
+    assert scheduler.issue_times == [100.0, 104.0, 124.0]
+    assert scheduler.getEndTime() == 129.0
+
+    assert scheduler.delay(1, 120.0) == 0.0 # Ends at 124 anyway
+    assert scheduler.delay(1, 130.0) == 6.0
+    assert scheduler.issue_times == [100.0, 104.0, 130.0]
+    assert scheduler.delay(2, 140.0) == 5.0 # The last command delays the end
+    assert scheduler.getEndTime() == 140.0
+
+
+def test_start_time_anchors_back_to_back_protocols():
+    clock = FakeClock()
+    scheduler = ProtocolScheduler(clock = clock)
+    scheduler.start([10.0], start_time = 95.0)
+    assert scheduler.getEndTime() == 105.0
+    scheduler.start([10.0], start_time = 150.0) # In the future: ignored
+    assert scheduler.getEndTime() == 110.0
@@ -0,0 +1,36 @@
+from kilroyConfiguration import KilroyConfiguration
+from valves.valveDevices import ValveDevices
+
+CONFIGURATION = """<kilroy_configuration num_valves="2" num_pumps="1">
+  <valve_commands>
+    <valve_cmd name="Buffer 7">
+      <valve_pos valve_ID="1" port_ID="7" />
+      <valve_pos valve_ID="2" port_ID="2" />
+    </valve_cmd>
+    <valve_cmd name="Buffer 1">
+      <valve_pos valve_ID="1" port_ID="1" />
+    </valve_cmd>
+  </valve_commands>
+</kilroy_configuration>
+"""
+
+
+def loadValveCommands(tmp_path):
+    xml_file_path = tmp_path / "config.xml"
+    xml_file_path.write_text(CONFIGURATION)
+    return KilroyConfiguration(str(xml_file_path), use_cache = False).valve_commands
+
+
+def test_protocol_valve_commands_move_simulated_valves(tmp_path):
+    valve_commands = loadValveCommands(tmp_path)
+    devices = ValveDevices(num_simulated_valves = 2, usb_cnc = None)
+    try:
+        devices.receiveCommand(valve_commands.commands[valve_commands.names.getID("Buffer 7")])
+        assert [devices.valve_chain.whereIsValve(valve_ID) for valve_ID in range(2)] == ["Port 7", "Port 2"]
+
+        # Port 7 to port 1 is shortest counter clockwise
+        devices.receiveCommand(valve_commands.commands[valve_commands.names.getID("Buffer 1")])
+        assert devices.valve_chain.whereIsValve(0) == "Port 1"
+        assert devices.valve_chain.move_travel[0] == 2
+    finally:
+        devices.close()
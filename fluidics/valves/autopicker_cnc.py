@@ -70,3 +70,4 @@ class CNC(MockAutopicker):
     def wait(self):
         while self.receive()["busy"]:
             pass
+        return True
@@ -1,5 +1,11 @@
+import collections
 import ctypes
+import json
+import math
+import os
+import re
 import serial 
+import threading
 import time
 from valves.cnc_talk import MockCNC
 #import cnc_talk
@@ -9,87 +15,482 @@ class GRBL(MockCNC):  # see cnc_talk.MockCNC
     def __init__(self,
                  com_port = "COM4",
                  config=r"./valves/XYZ_layout.json",
-                 parameters = False):
+                 parameters = False,
+                 serial_port = None,
+                 state_file = "grbl_state.json",
+                 restore_position = False):
 
         # Define attributes
         self.status = ("Initializing", False)
         self.com_port = com_port # COM port (see Device Manager)
+        self.state_file = state_file # last position and homing state, None to not save it
+        self.restore_position = restore_position # trust state_file after a reset (see wakeUp)
+        self.homed = False
         self.restore_config(config) #  plate configuration
         
         # Create serial port
-        self.serial = serial.Serial(port = self.com_port, baudrate = 115200) # GRBL operates at 115200 baud
+        if serial_port is None:
+            serial_port = serial.Serial(port = self.com_port, baudrate = 115200) # GRBL operates at 115200 baud
+        self.serial = serial_port
+
+        # Character-counting streaming: lines sent to grbl that it has not answered yet
+        # must fit in its serial receive buffer
+        self.rx_buffer_size = 127
+        self.pending_lines = collections.deque()
+        self.last_response = None
+
+        # Motion tracking: a reader thread handles every line grbl sends and asks for a
+        # real-time status report ('?') every status_interval seconds
+        self.status_interval = 0.1
+        self.wake_timeout = 2.5 # s, opening the port may reset the board
+        self.response_timeout = 60.0 # s, for grbl to take a line (e.g. behind a full planner)
+        self.position_tolerance = 0.01 # mm
+        self.machine_state = 'Unknown' # Idle, Run, Hold, Home, Alarm, ...
+        self.machine_position = None # MPos
+        self.work_offset = (0.0, 0.0, 0.0) # WCO, work position = MPos - WCO
+        self.status_reports = 0
+        self.messages = []
+        self.reader_error = None # why the reader thread stopped, e.g. the port was unplugged
+        self.responses = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.serial.timeout = self.status_interval
+        self.running = True
+        self.reader = threading.Thread(target = self.readResponses, name = "GRBL reader", daemon = True)
+        self.reader.start()
 
         # Define initial valve status
         self.xpos = 'X0'
         self.ypos = 'Y0'
         self.zpos = 'Z0'
         self.position = (self.xpos,self.ypos,self.zpos)
+        self.target = [0.0, 0.0, 0.0] # work position at the end of the lines sent
         self.feedspeed = 'F2000'
+
+        # Transfers between wells: retract to safe_z, rapid traverse, plunge to plunge_z at
+        # feedspeed. Their time is estimated from the max rates (mm/min, $110-$112) and
+        # accelerations (mm/s^2, $120-$122) of grbl's settings.
+        self.safe_z = 0.0
+        self.plunge_z = -37.0
+        self.max_rates = [500.0, 500.0, 500.0] # grbl defaults
+        self.accelerations = [10.0, 10.0, 10.0]
+        self.program_time = 0.0 # estimated time of the last program sent (s)
+        self.settings = {} # grbl's settings ($$), e.g. {22: 1.0} when homing is enabled
         # wake up grbl, homing and set the home position zero
         self.wakeUp()
 
-    # Wake up grbl
+    # Wake up grbl: wait for its startup banner or for the 'ok' of empty lines instead of a
+    # fixed sleep. Homing is skipped only when grbl did not reset, is Idle and shows that it
+    # was homed (see isHomed): its position and work offset (G92) are then still those of
+    # the last session. Otherwise grbl can not confirm where the needle is, so it is homed
+    # again, unless restore_position is set: the position saved at the end of the last
+    # session is then restored, if the needle was homed and at rest then. Only set it for
+    # machines that can not be moved while Kilroy is not running.
     def wakeUp(self):
-        self.sendCommand('\r\n\r\n')
-        time.sleep(10)   # Wait for grbl to initialize
-        self.serial.flushInput()  # Flush startup text in serial input
-        print('MESSAGE -- GRBL woke up.')
-        self.sendCommand('$H') # homing
-        self.sendCommand('G92 X0 Y0 Z0') # set current position 0
-        print('MESSAGE -- Homing is done. Ready to send commands.')
-        self.xpos = 'X0'
-        self.ypos = 'Y0'
-        self.zpos = 'Z0'
-        self.position = (0,0,0)
-        # may not need this
-        # self.current_position = (0,0,0)      
+        answered = self.handshake(self.wake_timeout)
+        if not answered:
+            print('MESSAGE -- No answer from GRBL on ' + str(self.com_port) + ' after ' + str(self.wake_timeout) + ' s')
+        state = self.waitForStatus(self.wake_timeout)
+        print('MESSAGE -- GRBL woke up (' + str(state) + ').')
+        if answered:
+            self.readSettings()
+        saved = self.loadState() if answered else None
+        position = None
+        if answered and not self.isStartupBanner() and state == 'Idle':
+            position = self.readWorkPosition()
+        if position is not None and self.isHomed(position, saved):
+            print('MESSAGE -- GRBL is already homed, at ' + str(position) + '. Ready to send commands.')
+            self.setWorkPosition(position)
+        elif self.restore_position and saved is not None and state in ('Idle', 'Alarm'):
+            if state == 'Alarm':
+                self.sendCommand('$X') # unlock, the position is known
+            position = saved['work_position']
+            self.sendCommand('G92 X' + str(position[0]) + ' Y' + str(position[1]) + ' Z' + str(position[2]))
+            self.flush()
+            if self.machine_position is not None:
+                self.work_offset = tuple(m - p for m, p in zip(self.machine_position, position))
+            print('MESSAGE -- Restored the GRBL position ' + str(position) + ' of the last session. Ready to send commands.')
+            self.setWorkPosition(position)
+        else:
+            if position is not None:
+                print('MESSAGE -- GRBL did not show that it was homed, homing.')
+            elif saved is not None:
+                print('MESSAGE -- GRBL reset since the last session, homing.')
+            self.sendCommand('$H') # homing
+            self.sendCommand('G92 X0 Y0 Z0') # set current position 0
+            print('MESSAGE -- Homing is done. Ready to send commands.')
+            self.setWorkPosition([0.0, 0.0, 0.0])
+            # may not need this
+            # self.current_position = (0,0,0)      
+        self.homed = True
+        self.saveState(at_rest = True)
+
+    # Whether grbl (Idle, not reset) was homed: with homing enabled ($22=1) grbl stays in
+    # alarm until it is homed, otherwise the needle must be where the last session left it
+    def isHomed(self, position, saved):
+        if self.settings.get(22) == 1:
+            return True
+        return saved is not None and all(abs(p - s) <= self.position_tolerance for p, s in zip(position, saved['work_position']))
+
+    # Whether the recorded work position is at x, y: within position_tolerance, as the
+    # positions read from grbl are rounded to microns
+    def isAtXY(self, x, y):
+        return all(abs(float(p) - float(q)) <= self.position_tolerance for p, q in zip(self.position[:2], (x, y)))
+
+    # Record the work position of the needle, e.g. after homing
+    def setWorkPosition(self, position):
+        self.xpos = 'X' + str(position[0])
+        self.ypos = 'Y' + str(position[1])
+        self.zpos = 'Z' + str(position[2])
+        self.position = tuple(position)
+        self.target = [float(p) for p in position]
+
+    # Load the state saved by the last session: None unless grbl was homed and at rest
+    def loadState(self):
+        if self.state_file is None or not os.path.isfile(self.state_file):
+            return None
+        try:
+            with open(self.state_file, 'r') as state_file:
+                state = json.load(state_file)
+            if state['com_port'] != str(self.com_port) or not state['homed'] or not state['at_rest']:
+                return None
+            state['work_position'] = [float(p) for p in state['work_position']]
+        except (IOError, ValueError, KeyError, TypeError) as exception:
+            print('Could not load GRBL state ' + self.state_file + ': ' + str(exception))
+            return None
+        return state
+
+    # Save the position and homing state for the next session. at_rest is False while a
+    # program runs: a session that ends then does not know where the needle stopped.
+    def saveState(self, at_rest):
+        if self.state_file is None:
+            return
+        state = {'com_port': str(self.com_port),
+                 'homed': self.homed,
+                 'at_rest': at_rest,
+                 'work_position': self.target,
+                 'machine_position': self.machine_position,
+                 'work_offset': self.work_offset}
+        try:
+            with open(self.state_file, 'w') as state_file:
+                json.dump(state, state_file, indent = 1)
+        except (IOError, OSError) as exception:
+            print('Could not save GRBL state ' + self.state_file + ': ' + str(exception))
+
+    # Send an empty line and wait for grbl to answer it, or for its startup banner when
+    # opening the port reset the board (the line is then lost in the bootloader). grbl
+    # answers every line end, so a single '\n' is sent and counted like a command line:
+    # its 'ok' can not be taken for the answer to a later command.
+    def handshake(self, timeout):
+        deadline = time.time() + timeout
+        with self.responses:
+            self.pending_lines.append('\n')
+            self.write(b'\n')
+            while self.pending_lines and not self.isStartupBanner():
+                self.checkReader()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.pending_lines.clear() # no answer, nothing to match
+                    return False
+                self.responses.wait(remaining)
+            self.pending_lines.clear() # lost if the board reset
+        return True
+
+    def isStartupBanner(self):
+        return any(message.startswith('Grbl ') for message in self.messages)
+
+    # Wait for the next status report, return the machine state
+    def waitForStatus(self, timeout):
+        deadline = time.time() + timeout
+        with self.responses:
+            reports = self.status_reports
+            while self.status_reports == reports and time.time() < deadline:
+                self.checkReader()
+                self.responses.wait(deadline - time.time())
+            return self.machine_state
+
+    # Work position from the machine position and the coordinate offsets ($#)
+    def readWorkPosition(self):
+        first_message = len(self.messages)
+        self.sendCommand('$#')
+        offset = [0.0, 0.0, 0.0]
+        for message in self.messages[first_message:]:
+            name, _, value = message.strip('[]').partition(':')
+            if name in ('G54', 'G92'):
+                offset = [o + float(v) for o, v in zip(offset, value.split(',')[:3])]
+        self.work_offset = tuple(offset)
+        self.waitForStatus(self.wake_timeout)
+        return [round(p, 3) for p in self.workPosition()]
+
+    # Max rates and accelerations from grbl's settings ($$)
+    def readSettings(self):
+        first_message = len(self.messages)
+        self.sendCommand('$$')
+        for message in self.messages[first_message:]:
+            match = re.match(r'\$(\d+)=([-\d.]+)', message)
+            if match is None:
+                continue
+            number, value = int(match.group(1)), float(match.group(2))
+            self.settings[number] = value
+            if 110 <= number <= 112:
+                self.max_rates[number - 110] = value
+            elif 120 <= number <= 122:
+                self.accelerations[number - 120] = value
 
     def moveXY(self,newx,newy):
         command = 'G01 '+newx+' '+newy+' '+self.feedspeed
         self.sendCommand(command)
         self.xpos = newx
         self.ypos = newy
+        self.target[0:2] = [float(newx[1:]), float(newy[1:])]
             # self.current_position = (self.current_position[0]+newx,slef.current_position[1]+newy,0)  # it looks like this has absolute position
 
     def needleUp(self):
         # command = 'G01 '+self.xpos+' '+self.ypos+' '+'Z0'+' '+self.feedspeed
         self.sendCommand('G01 Z0')
         self.zpos = 'Z0'
+        self.target[2] = 0.0
 
     def needleDown(self):
         self.sendCommand('G01 Z-37')
         self.zpos = 'Z-37'
+        self.target[2] = -37.0
 
-    def wait(self,waitingtime=1):
-        command = 'G04 P'+str(waitingtime)
-        self.sendCommand(command)
+    # Wait until grbl has executed every line sent, then record the target as the work
+    # position. Returns False on an alarm or after timeout seconds (the position is then
+    # not changed), raises if the connection to grbl was lost.
+    def wait(self, timeout = 60):
+        self.flush()
+        if not self.waitUntilIdle(timeout):
+            self.target = [float(p) for p in self.position] # the needle did not get there
+            return False
+        self.setWorkPosition(self.target)
+        self.saveState(at_rest = True)
         return True
 
-    # Stream g-code to grbl
+    # Wait for a status report asked for after the last 'ok' that shows Idle at the
+    # target (or Idle twice in a row, e.g. when the offset is not known)
+    def waitUntilIdle(self, timeout):
+        deadline = time.time() + timeout
+        with self.responses:
+            first_report = self.status_reports + 1
+            idle_reports = 0
+            while True:
+                reports = self.status_reports
+                if reports >= first_report:
+                    if self.machine_state == 'Idle':
+                        idle_reports += 1
+                        if self.atTarget() or idle_reports >= 2:
+                            break
+                    elif self.machine_state == 'Alarm':
+                        print('GRBL alarm while waiting for the move to ' + str(self.target))
+                        return False
+                    else:
+                        idle_reports = 0
+                while self.status_reports == reports:
+                    self.checkReader()
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        print('GRBL still ' + self.machine_state + ' after ' + str(timeout) + ' s')
+                        return False
+                    self.responses.wait(remaining)
+        return True
+
+    # Work position (MPos - WCO) of the last status report
+    def workPosition(self):
+        if self.machine_position is None:
+            return None
+        return [m - o for m, o in zip(self.machine_position, self.work_offset)]
+
+    def atTarget(self):
+        position = self.workPosition()
+        return position is not None and all(abs(p - t) <= self.position_tolerance for p, t in zip(position, self.target))
+
+    # Stream g-code to grbl: a line is sent as soon as it fits in grbl's receive buffer,
+    # without waiting for the 'ok' of the lines before it, so that grbl's planner stays
+    # full. System ('$') commands wait until grbl has answered every line and return
+    # their own response. Raises if grbl does not take the line within response_timeout.
     def sendCommand(self,command):
         line = command+'\n'
         print('Sending: ' + command)
-        self.serial.write(line.encode()) # Send g-code block to grbl
-        res = self.getResponse()
-        return res
+        is_system_command = command.startswith('$')
+        if is_system_command:
+            self.flush()
+        with self.responses:
+            deadline = time.time() + self.response_timeout
+            while self.pending_lines and self.bufferedCharacters() + len(line) > self.rx_buffer_size:
+                self.waitForResponse(deadline, 'room in its receive buffer')
+            self.checkReader()
+            self.pending_lines.append(line)
+            self.write(line.encode()) # Send g-code block to grbl
+        if is_system_command:
+            return self.flush()
+
+    # Number of characters sent to grbl that it has not answered yet
+    def bufferedCharacters(self):
+        return sum(len(line) for line in self.pending_lines)
+
+    # Wait for grbl to answer every line sent, return the last response
+    def flush(self):
+        with self.responses:
+            self.checkReader()
+            deadline = time.time() + self.response_timeout
+            while self.pending_lines:
+                self.waitForResponse(deadline, 'an answer to ' + self.pending_lines[0].strip())
+            return self.last_response
+
+    # Wait for the reader thread to handle a line until deadline (responses lock held).
+    # Raises if the deadline passed or the connection to grbl was lost.
+    def waitForResponse(self, deadline, waiting_for):
+        self.checkReader()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise serial.SerialTimeoutException('GRBL timed out waiting for ' + waiting_for)
+        self.responses.wait(remaining)
+        self.checkReader()
+
+    # Raise if the reader thread stopped: grbl's answers are not read any more
+    def checkReader(self):
+        if self.reader_error is not None:
+            raise serial.SerialException('GRBL connection lost: ' + str(self.reader_error))
+
+    # Write to grbl, shared by the commands and the status queries of the reader thread
+    def write(self, data):
+        with self.write_lock:
+            self.serial.write(data)
 
-    def getResponse(self):
-        grbl_out = self.serial.readline() # Wait for grbl response with carriage return
-        return grbl_out.strip().decode()
+    # Reader thread: handle every line grbl sends and ask for status reports
+    def readResponses(self):
+        partial = b''
+        next_status_time = time.time()
+        while self.running:
+            try:
+                if time.time() >= next_status_time:
+                    self.write(b'?') # real-time command, not counted in the receive buffer
+                    next_status_time = time.time() + self.status_interval
+                data = self.serial.readline()
+            except (serial.SerialException, OSError, TypeError) as exception:
+                if self.running: # wake the commands waiting for grbl, they raise
+                    print('GRBL reader stopped: ' + str(exception))
+                    with self.responses:
+                        self.reader_error = exception
+                        self.responses.notify_all()
+                return
+            if not data.endswith(b'\n'): # timeout in the middle of a line
+                partial += data
+                continue
+            self.handleResponse((partial + data).strip().decode())
+            partial = b''
+
+    # 'ok' and 'error' answer the oldest line sent, <...> are status reports
+    def handleResponse(self, grbl_out):
+        with self.responses:
+            if grbl_out.startswith('<'):
+                self.parseStatus(grbl_out)
+            elif grbl_out == 'ok' or grbl_out.startswith('error'):
+                line = self.pending_lines.popleft() if self.pending_lines else ''
+                if grbl_out != 'ok':
+                    print('GRBL ' + grbl_out + ' for: ' + line.strip())
+                self.last_response = grbl_out
+            elif grbl_out:
+                if not grbl_out.startswith('$'): # settings are only stored
+                    print('GRBL: ' + grbl_out) # e.g. alarms and messages
+                self.messages.append(grbl_out)
+            self.responses.notify_all()
+
+    # Status reports of grbl 1.1 (<Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:...>) and
+    # 0.9 (<Idle,MPos:0.000,0.000,0.000,WPos:0.000,0.000,0.000>)
+    def parseStatus(self, grbl_out):
+        fields = grbl_out.strip('<>').replace(',MPos:', '|MPos:').replace(',WPos:', '|WPos:').split('|')
+        self.machine_state = fields[0].split(':')[0] # e.g. Hold:0
+        values = {}
+        for field in fields[1:]:
+            name, _, value = field.partition(':')
+            if name in ('MPos', 'WPos', 'WCO'):
+                values[name] = tuple(float(v) for v in value.split(',')[:3])
+        if 'WCO' in values:
+            self.work_offset = values['WCO']
+        if 'MPos' in values:
+            self.machine_position = values['MPos']
+            if 'WPos' in values:
+                self.work_offset = tuple(m - w for m, w in zip(values['MPos'], values['WPos']))
+        elif 'WPos' in values:
+            self.machine_position = tuple(w + o for w, o in zip(values['WPos'], self.work_offset))
+        self.status_reports += 1
+
+    def close(self):
+        if self.reader_error is None:
+            self.wait()
+        self.running = False
+        self.reader.join(2 * self.status_interval + 1)
+        self.serial.close()
+
+    # grbl plans its own acceleration, so paths are not split (cnc_path.max_distance_fix):
+    # the needle goes straight to the last x, y given
+    def step_through(self, positions):
+        targets = [p for p in positions if p[0] is not None]
+        if targets:
+            self.set(targets[-1])
 
     def set(self, position = (0, 0, 0)):
         if position[0] is not None:
             print('setting position')
             print(position)
-            newX = 'X'+str(position[0])
-            newY = 'Y'+str(position[1])
-            if self.xpos == newX and self.ypos == newY:  # we only stop down anyway
+            if self.isAtXY(position[0], position[1]):  # we only stop down anyway
                 pass
                 # print('aready here')
-            else:
-                self.needleUp()  # if we remove this, it doesn't bounce
-                self.moveXY(newX,newY)
-                self.needleDown()
+            else: # the position is recorded once wait() sees the needle there
+                lines, self.target, self.program_time = self.transferProgram(position[0], position[1])
+                self.saveState(at_rest = False)
+                self.sendProgram(lines)
                 # self.position = position
         
-        # return position #  self.coords()  # it looks like this keeps track of absolute position  
\ No newline at end of file
+        # return position #  self.coords()  # it looks like this keeps track of absolute position
+
+    # Compile a transfer to a well into one program: retract to safe_z, rapid (G00)
+    # traverse, plunge at feedspeed. Returns the lines, the end position and the
+    # estimated time (s).
+    def transferProgram(self, x, y, start = None):
+        position = list(self.target if start is None else start)
+        x, y = round(float(x), 3), round(float(y), 3) # grbl works in microns
+        feed = float(self.feedspeed[1:])
+        moves = []
+        if position[2] != self.safe_z:
+            moves.append(('G00 Z' + str(self.safe_z), [position[0], position[1], self.safe_z], None))
+        moves.append(('G00 X' + str(x) + ' Y' + str(y), [x, y, self.safe_z], None))
+        moves.append(('G01 Z' + str(self.plunge_z) + ' ' + self.feedspeed, [x, y, self.plunge_z], feed))
+
+        lines = []
+        estimated_time = 0.0
+        for line, end, rate in moves:
+            lines.append(line)
+            estimated_time += self.moveTime(position, end, rate)
+            position = end
+        return lines, position, estimated_time
+
+    # Time (s) of a straight move that starts and ends at rest (trapezoidal velocity
+    # profile): rate is the feed (mm/min), None for a rapid, limited per axis as by grbl
+    def moveTime(self, start, end, rate = None):
+        delta = [e - s for s, e in zip(start, end)]
+        distance = math.sqrt(sum(d*d for d in delta))
+        if distance == 0:
+            return 0.0
+        unit = [abs(d)/distance for d in delta]
+        speed = min([max_rate/u for max_rate, u in zip(self.max_rates, unit) if u > 0] + ([rate] if rate else []))/60.0
+        acceleration = min(a/u for a, u in zip(self.accelerations, unit) if u > 0)
+        if distance >= speed*speed/acceleration: # reaches full speed
+            return distance/speed + speed/acceleration
+        return 2.0*math.sqrt(distance/acceleration)
+
+    # Stream the lines of a program back to back, grbl plans them as one motion
+    def sendProgram(self, lines):
+        for line in lines:
+            self.sendCommand(line)
+
+    # Estimated time (s) of moving the needle to a port from the current target, 0 if
+    # it is already there (see set)
+    def estimate_move(self, port, direction):
+        plate, well = self.find_well(port, direction)
+        position = plate.find_position(*map(int, well.split()[1:]))
+        if all(abs(t - p) <= self.position_tolerance for t, p in zip(self.target[:2], position[:2])):
+            return 0.0
+        return self.transferProgram(position[0], position[1])[2]
@@ -47,3 +47,4 @@ class XYZ(MockCNC):
 
     def wait(self):
         self.mm._Z4waitPc(ctypes.c_char_p(self.device))
+        return True
@@ -0,0 +1,132 @@
+import math
+import sys
+import time
+
+import numpy
+
+
+# Path planning for the robot needle, shared by MockCNC (cnc_talk) and MockAutopicker
+# (autopicker). A path is a list of (x, y, z) positions where None means "leave this
+# axis where it is"; segments longer than max_distance are split into equal steps.
+# plan_path splits a whole path in one pass, so a plate tour (every well in one path,
+# see plate_tour and Plate.tour) is planned at once instead of well by well.
+
+
+def calculate_distance(start, end):
+    dist = 0
+    if start[0] is not None and end[0] is not None:
+        dist += (start[0] - end[0])**2
+    if start[1] is not None and end[1] is not None:
+        dist += (start[1] - end[1])**2
+    if start[2] is not None and end[2] is not None:
+        dist += (start[2] - end[2])**2
+    return math.sqrt(dist)
+
+
+def plan_path(positions, max_distance=1000):
+    """Return the waypoints after positions[0] as an (n, 3) float array, NaN = None axis.
+
+    Each position is compared with the current position (the last given value of every
+    axis), ignoring None axes. Targets within max_distance are kept as given; longer
+    segments are split into equal steps that carry None axes at their current value.
+    """
+    points = numpy.array(positions, dtype=float).reshape(-1, 3)  # None becomes NaN
+    if len(points) < 2:
+        return numpy.empty((0, 3))
+
+    # Current position before each target: forward fill the given axis values
+    given = ~numpy.isnan(points)
+    last_given = numpy.maximum.accumulate(numpy.where(given, numpy.arange(len(points))[:, None], 0), axis=0)
+    current = points[last_given, numpy.arange(3)][:-1]
+    targets = points[1:]
+
+    # Segment lengths over the axes given at both ends, and the number of steps
+    delta = numpy.where(given[1:] & ~numpy.isnan(current), targets - current, 0.0)
+    distance = numpy.sqrt((delta**2).sum(axis=1))
+    parts = numpy.where(distance > max_distance, numpy.ceil(distance/max_distance), 1).astype(int)
+
+    # Steps of every segment in one pass: step k of n is current + delta*k/n
+    segment = numpy.repeat(numpy.arange(len(targets)), parts)
+    step = numpy.arange(len(segment)) - numpy.repeat(numpy.cumsum(parts) - parts, parts) + 1
+    waypoints = current[segment] + delta[segment] * (step/parts[segment])[:, None]
+
+    # Targets that are not split are kept as given (including None axes)
+    whole = (parts == 1)[segment]
+    waypoints[whole] = targets[segment[whole]]
+    return waypoints
+
+
+def to_positions(points):
+    """An (n, 3) array of points as a list of [x, y, z] lists with None for NaN."""
+    return [[None if x != x else x for x in p] for p in numpy.asarray(points).tolist()]  # NaN != NaN
+
+
+def max_distance_fix(positions, max_distance=1000):
+    """plan_path as a list of [x, y, z] lists with None for unchanged axes."""
+    return to_positions(plan_path(positions, max_distance))
+
+
+def max_distance_fix_loop(positions, max_distance=1000):
+    """Segment by segment version of max_distance_fix, the reference of the benchmark."""
+    out_positions = []
+    current_position = list(positions[0])
+
+    for end in positions[1:]:
+        d = calculate_distance(current_position, end)
+
+        if d > max_distance:
+            parts = int(math.ceil(d/max_distance))
+            delta = [x - y if x is not None and y is not None else 0 for x, y in zip(end, current_position)]
+            for p in range(parts):
+                out_positions.append([c + d * (p+1)/float(parts) for d, c in zip(delta, current_position)])
+        else:
+            out_positions.append(end)
+
+        if end[0] is not None:
+            current_position[0] = end[0]
+        if end[1] is not None:
+            current_position[1] = end[1]
+        if end[2] is not None:
+            current_position[2] = end[2]
+
+    return out_positions
+
+
+def plate_tour(wells, height):
+    """The path visiting wells ((n, 3) positions) in order, each as Plate.move does it:
+    up to height, over the well at height, into the well."""
+    wells = numpy.array(wells, dtype=float).reshape(-1, 3)
+    path = numpy.full((len(wells), 3, 3), numpy.nan)
+    path[:, :2, 2] = numpy.nan if height is None else height
+    path[:, 1, :2] = wells[:, :2]
+    path[:, 2] = wells
+    return to_positions(path.reshape(-1, 3))
+
+
+def benchmark(repeats=200, max_distance=10):
+    """Time planning a 96 well plate tour in one pass against the segment by segment loop."""
+    grid_x, grid_y = numpy.meshgrid(numpy.arange(12), numpy.arange(8), indexing="ij")
+    wells = numpy.stack([20.0 + 9.0*grid_x, 20.0 + 9.0*grid_y, numpy.full(grid_x.shape, -80.0)], axis=-1)
+    tour = [(0.0, 0.0, 0.0)] + plate_tour(wells, 0.0)
+
+    # Both versions plan the same path
+    for planned, reference in zip(max_distance_fix(tour, max_distance), max_distance_fix_loop(tour, max_distance)):
+        assert all((a is None and b is None) or abs(a - b) < 1e-9 for a, b in zip(planned, reference))
+
+    def run(function):
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            function()
+        return 1000.0*(time.perf_counter() - start_time)/repeats
+
+    points = numpy.array(tour, dtype=float)
+    loop_time = run(lambda: max_distance_fix_loop(tour, max_distance))
+    print("96 well tour, %d waypoints: loop %0.3f ms" % (len(plan_path(tour, max_distance)), loop_time))
+    for name, function in [("planner", lambda: max_distance_fix(tour, max_distance)),
+                           ("planner (array)", lambda: plan_path(points, max_distance))]:
+        planner_time = run(function)
+        print("%s %0.3f ms (%0.1fx)" % (name, planner_time, loop_time/planner_time))
+
+
+if __name__ == "__main__":
+    benchmark(*[int(argument) for argument in sys.argv[1:]])
@@ -4,11 +4,10 @@ import time
 import sys
 import numpy
 import json
-import math
-
-import matplotlib.tri
 
 from valves import cnc_commands
+from valves.cnc_path import max_distance_fix, plate_tour
+from valves.plate_layout import read_layout, well_coordinates, write_layout_cache
 
 
 
@@ -43,43 +42,6 @@ from valves import cnc_commands
 # >>> c.register_plate(p)
 # >>> c.write(
 
-
-
-def calculate_distance(start, end):
-    dist = 0
-    if start[0] is not None and end[0] is not None:
-        dist += (start[0] - end[0])**2
-    if start[1] is not None and end[1] is not None:
-        dist += (start[1] - end[1])**2
-    if start[2] is not None and end[2] is not None:
-        dist += (start[2] - end[2])**2
-    return math.sqrt(dist)
-
-def max_distance_fix(positions, max_distance=1000):
-    out_positions = []
-    current_position = list(positions[0])
-
-    for end in positions[1:]:
-        d = calculate_distance(current_position, end)
-
-        if d > max_distance:
-            parts = int(math.ceil(d/max_distance))
-            delta = [x - y if x is not None and y is not None else 0 for x, y in zip(end, current_position)]
-            for p in range(parts):
-                out_positions.append([c + d * (p+1)/float(parts) for d, c in zip(delta, current_position)])
-        else:
-            out_positions.append(end)
-
-        if end[0] is not None:
-            current_position[0] = end[0]
-        if end[1] is not None:
-            current_position[1] = end[1]
-        if end[2] is not None:
-            current_position[2] = end[2]
-
-    return out_positions
-
-
 class MockCNC(object):
     def __init__(self, plates=2, plate_shape=(12, 8),com_port=0):
         self.position = [0, 0, 0]
@@ -92,7 +54,7 @@ class MockCNC(object):
 
     def step_through(self, positions):
         position = list(self.coords())
-        for p in max_distance_fix([position] + positions):
+        for p in max_distance_fix([position] + list(positions)):
             self.set(p)
 
     def coords(self, add_offset=True):
@@ -103,17 +65,27 @@ class MockCNC(object):
         print("MockCNC setting position to", position)
         self.position = list(position)
 
-    def move(self, port, direction):
+    def find_well(self, port, direction):
+        """Return the plate and the (x, y) well of a port."""
         if isinstance(port, tuple):
             plate_name, port = port
             named_right = [p for p in self.plates if p.name == plate_name]
             plate = named_right[0]
         else:
             plate = self.plates[direction]
+        return plate, self.wells[port]
 
-        plate.move(*map(int, self.wells[port].split()[1:]))
-        self.wait()
-        self.status = ("%s %s" % (plate.name, self.wells[port]), False)
+    def move(self, port, direction):
+        """Move the needle to a port, return False if the move did not complete."""
+        plate, well = self.find_well(port, direction)
+        plate.move(*map(int, well.split()[1:]))
+        moved = self.wait()
+        self.status = ("%s %s" % (plate.name, well) if moved else "Unknown well", False)
+        return moved
+
+    def estimate_move(self, port, direction):
+        """Estimated time (s) of moving to a port, 0 if unknown."""
+        return 0.0
 
     def get_wells(self):
         self.wells = []
@@ -135,7 +107,7 @@ class MockCNC(object):
         pass
 
     def wait(self):
-        pass
+        return True
 
     def register_plate(self, plate):
         self.plates.append(plate)
@@ -143,10 +115,13 @@ class MockCNC(object):
     def write_config(self, path):
         with open(path, "w") as output_file:
             json.dump([p.save() for p in self.plates], output_file)
+        write_layout_cache(path, self.plates)
     
     def restore_config(self, path):
-        with open(path) as input_file:
-            self.plates = [Plate(self, plate) for plate in json.load(input_file)]
+        configs = read_layout(path)
+        self.plates = [Plate(self, plate) for plate in configs]
+        if any(p.wells is not None and "wells" not in config for p, config in zip(self.plates, configs)):
+            write_layout_cache(path, self.plates)
 
 
 class CNC(MockCNC):
@@ -219,11 +194,11 @@ class Plate(object):
         self.name = config["name"] if "name"  in config else ""
         self.height = config["height"] if "height" in config else None
         self.positions = config["positions"] if "positions" in config else []
-        if len(self.positions) > 2:
+        self.triangulation = None
+        self.interpolation = None
+        self.wells = numpy.array(config["wells"], dtype=float) if "wells" in config else None  # (rows, cols, 3) well coordinates
+        if self.wells is None and len(self.positions) > 2:
             self.freeze()
-        else:
-            self.triangulation = None
-            self.interpolation = None
 
     def set_cnc(self, cnc):
         self.cnc = cnc
@@ -231,6 +206,7 @@ class Plate(object):
     def record_well(self, x = 0, y = 0):
         """Record the position of a single well for interpolation."""
         self.positions.append((x, y, self.cnc.coords(add_offset=True)))
+        self.wells = None
 
     def record_height(self):
         """Go up to the current z height from now on when exiting wells."""
@@ -239,14 +215,7 @@ class Plate(object):
     def freeze(self):
         """This takes the x, y, and z positions and solves the linear equations for positioning."""
         if len(self.positions) > 2:
-            point = [p[:2] for p in self.positions]
-            point_x, point_y = zip(*point)
-
-            coords = [p[2] for p in self.positions]
-
-            self.triangulation = matplotlib.tri.Triangulation(point_x, point_y)
-            self.interpolation = [matplotlib.tri.LinearTriInterpolator(self.triangulation, coord) for coord in zip(*coords)]
-            #self.interpolation = [matplotlib.tri.CubicTriInterpolator(self.triangulation, coord) for coord in zip(*coords)]
+            self.triangulation, self.interpolation, self.wells = well_coordinates(self.positions)
         else:
             raise Exception("Can't freeze positions with two or fewer!")
         
@@ -254,8 +223,13 @@ class Plate(object):
         if len(self.positions) == 1:
             return numpy.array(self.positions[0][2])
         elif len(self.positions) > 2:
-            if self.interpolation is None:
-                print("Interpolator undefined, attempting to freeze positions matrix...")
+            if self.wells is None:
+                print("Well coordinates undefined, attempting to freeze positions matrix...")
+                self.freeze()
+            if isinstance(x, (int, numpy.integer)) and isinstance(y, (int, numpy.integer)) and \
+                    0 <= x < self.wells.shape[0] and 0 <= y < self.wells.shape[1] and not numpy.isnan(self.wells[x, y]).any():
+                return self.wells[x, y].copy()
+            if self.interpolation is None:  # not a well of the table, interpolate
                 self.freeze()
             return numpy.array([interp(x, y) for interp in self.interpolation])
         else:
@@ -263,8 +237,12 @@ class Plate(object):
             raise Exception( "Can't find position if there are exactly two!")
 
     def move(self, x=0, y=0):
-        target_position = self.find_position(x, y)
-        self.cnc.step_through([(None, None, self.height), (target_position[0], target_position[1], self.height), target_position])
+        self.cnc.step_through(plate_tour([self.find_position(x, y)], self.height))
+
+    def tour(self, locations=None):
+        """Visit wells (all of them by default) in order, on one path planned at once."""
+        wells = [self.find_position(x, y) for x, y in (locations or self.locations())]
+        self.cnc.step_through(plate_tour(wells, self.height))
 
     def home(self):
         """Home is above the first well."""
@@ -6,16 +6,33 @@
 # 12/17/13
 # jeffmoffitt@gmail.com
 #
+# Serial I/O runs on a SerialWorker thread: valve moves are queued ahead of status
+# polls, and the GUI reads status snapshots refreshed by requestStatus().
+#
+# Responses are read until their terminator (a carriage return, or a lone negative
+# acknowledge) or until the deadline of the command, so queries complete at device speed.
+# Chain discovery probes addresses with a deadline scaled to the observed response time,
+# and waits for movement follow the expected move time of the valve configuration.
+# The discovered chain is saved to topology_file and trusted on the next start if the
+# last valve still reports its configuration (the valves are still initialized);
+# resetChain() always rediscovers it.
+# getShortestDirection() gives the rotation with the least travel to a port, and the
+# travel and duration of moves are summarized on close.
+#
 # TODO: Simulated port should be in a different class
 # ----------------------------------------------------------------------------------------
 
 # ----------------------------------------------------------------------------------------
 # Import
 # ----------------------------------------------------------------------------------------
+import json
+import os
 import sys
+import threading
 import time
 
 from valves.valve import AbstractValve
+from valves.serialWorker import SerialWorker, COMMAND_PRIORITY, POLL_PRIORITY, QUERY_PRIORITY
 
 # ----------------------------------------------------------------------------------------
 # HamiltonMVP Class Definition
@@ -24,33 +41,53 @@ class HamiltonMVP(AbstractValve):
     def __init__(self,
                  com_port = "COM2",
                  num_simulated_valves = 0,
+                 serial_port = None,
+                 simulate = False,
+                 topology_file = "hamilton_chain.json",
                  verbose = False):
 
         # Define attributes
         self.com_port = com_port
+        self.topology_file = topology_file
         self.verbose = verbose
         self.num_simulated_valves = num_simulated_valves
 
         print("Initializing MVP on port", com_port)
 
-        # Determine simulation mode
-        self.simulate = True #(self.num_simulated_valves > 0 or (isinstance(com_port, int) and com_port < 0))
-        
+        # Determine simulation mode: simulated valves or a serial port
+        self.simulate = simulate or self.num_simulated_valves > 0 or (isinstance(com_port, int) and com_port < 0)
+        if serial_port is not None: # An open serial-like port, e.g. a SimulatedMVPChain
+            self.simulate = False
+
+        # Define read deadlines (s)
+        self.read_timeout = 0.01        # Timeout of a single serial read
+        self.response_timeout = 0.5     # Default deadline for a complete response
+        self.address_timeout = 2.0      # Deadline for the auto address response
+        self.probe_timeout = 0.1        # Deadline for a valve that may not exist
+        self.min_probe_timeout = 0.02   # Shortest probe deadline, once response times are known
+        self.response_time = None       # Time of the last complete response
+
         # Create serial port (if not in simulation mode)
         if not self.simulate:
-            import serial
-            self.serial = serial.Serial(port = self.com_port, 
-                                        baudrate = 9600, 
-                                        bytesize = serial.SEVENBITS, 
-                                        parity = serial.PARITY_ODD, 
-                                        stopbits = serial.STOPBITS_ONE, 
-                                        timeout = 0.1)
+            if serial_port is None:
+                import serial
+                serial_port = serial.Serial(port = self.com_port, 
+                                            baudrate = 9600, 
+                                            bytesize = serial.SEVENBITS, 
+                                            parity = serial.PARITY_ODD, 
+                                            stopbits = serial.STOPBITS_ONE, 
+                                            timeout = self.read_timeout)
+            self.serial = serial_port
+            self.serial.timeout = self.read_timeout
+            self.worker = SerialWorker(name = "Hamilton MVP " + str(self.com_port),
+                                       verbose = self.verbose)
+        else:
+            self.worker = None
         
         # Define important serial characters
         self.acknowledge = "\x06"
-        self.carriage_return = "\x13"
-        self.negative_acknowledge = "\x21"
-        self.read_length = 64
+        self.carriage_return = "\r"
+        self.negative_acknowledge = "\x15"
         self.char_offset = 97           # offset to convert int current_device
                                         # to ascii addresses (0=a, 1=b, ...)
 
@@ -61,10 +98,32 @@ class HamiltonMVP(AbstractValve):
         self.valve_configs = []
         self.max_ports_per_valve = []
         self.current_port = []
-
-        # Configure device
+        self.move_start_times = {}      # Valve ID: time of the last move or initialization
+        self.move_travel = {}           # Valve ID: ports rotated through in the last move
+        self.move_statistics = {"moves": 0,             # Number of moves
+                                "ports": 0,             # Ports rotated through
+                                "clockwise_ports": 0,   # Ports had all moves been clockwise
+                                "timed_moves": 0,       # Moves waited for
+                                "move_time": 0.0}       # Duration of the moves waited for (s)
+        self.status_cache = {}          # Valve ID: last polled status
+        self.pending_polls = set()      # Valve IDs with a queued status poll
+        self.poll_lock = threading.Lock() # Guards pending_polls (GUI and serial worker)
+
+        # Define movement model: expected move time (s) by configuration, as
+        # [start time, time per port rotated through]
+        self.move_times = {"8 ports": [0.2, 0.04],
+                           "6 ports": [0.2, 0.05],
+                           "4 ports": [0.2, 0.06],
+                           "3 ports": [0.2, 0.08],
+                           "2 ports @180": [0.2, 0.1],
+                           "2 ports @90": [0.2, 0.05]}
+        self.min_pause_time = 0.01      # First pause between movement polls (s)
+
+        # Configure device: use the saved chain if it is still there
         self.autoAddress()
-        self.autoDetectValves()
+        if not self.loadTopology():
+            if self.autoDetectValves():
+                self.saveTopology()
         
     # ------------------------------------------------------------------------------------
     # Define Device Addresses: Must be First Command Issued
@@ -74,8 +133,7 @@ class HamiltonMVP(AbstractValve):
             auto_address_cmd = "1a\r"
             if self.verbose:
                 print("Addressing Hamilton Valves")
-            x = self.write(auto_address_cmd)
-            response = self.read() # Clear buffer
+            response = self.exchange(auto_address_cmd, COMMAND_PRIORITY, self.address_timeout) # Clear buffer
         else:
             print("Simulating Hamilton MVP")
 
@@ -115,6 +173,7 @@ class HamiltonMVP(AbstractValve):
                     break
                 
             self.num_valves = len(self.valve_configs)
+            self.valve_names = self.valve_names[:self.num_valves] # Only the detected valves
 
             if self.num_valves == 0:
                 self.valve_names = "0"
@@ -151,36 +210,139 @@ class HamiltonMVP(AbstractValve):
             return False
         if not self.isValidPort(valve_ID, port_ID):
             return False
+        port_ID = self.getPortIndex(port_ID)
         
         if not self.simulate:
             # Compose message and increment port_ID (starts at 1)
             message = "LP" + str(direction) + str(port_ID+1) + "R\r"
 
-            response = self.inquireAndRespond(valve_ID, message)        
+            response = self.inquireAndRespond(valve_ID, message, priority = COMMAND_PRIORITY)
             if response[0] == "Negative Acknowledge":
                 print("Move failed: " + str(response))
 
             if response[1]: #Acknowledged move
+                self.recordMove(valve_ID, port_ID, direction)
                 self.current_port[valve_ID] = port_ID
 
             if wait_until_done:
-                self.waitUntilNotMoving()
+                self.waitUntilNotMoving(valve_ID)
                 
             return response[1]
         else: ## simulation code
-            self.current_port[valve_ID] = port_ID[-1]
+            self.recordMove(valve_ID, port_ID, direction)
+            self.current_port[valve_ID] = port_ID
             return True
 
+    # ------------------------------------------------------------------------------------
+    # Change Several Port Positions: all moves are issued before waiting, so the valves
+    # move concurrently. moves is a list of (valve_ID, port_ID, direction).
+    # ------------------------------------------------------------------------------------
+    def changePorts(self, moves, wait_until_done = False):
+        results = [self.changePort(valve_ID, port_ID, direction) for [valve_ID, port_ID, direction] in moves]
+
+        if wait_until_done and not self.simulate:
+            # The valves move together: once the first is done the others are nearly done
+            for valve_ID in set(valve_ID for [valve_ID, port_ID, direction] in moves):
+                self.waitUntilNotMoving(valve_ID)
+
+        return results
+
     # ------------------------------------------------------------------------------------
     # Close Serial Port
     # ------------------------------------------------------------------------------------ 
     def close(self):
+        if self.move_statistics["moves"] > 0:
+            print("Hamilton MVP moves: " + self.getMoveSummary())
         if not self.simulate:
+            self.worker.close()
             self.serial.close()
             if self.verbose: print("Closed hamilton valves")
         else: ## simulation code
             if self.verbose: print("Closed simulated hamilton valves")
      
+    # ------------------------------------------------------------------------------------
+    # Write a message and read the response on the serial worker
+    # ------------------------------------------------------------------------------------
+    def exchange(self, message, priority = QUERY_PRIORITY, timeout = None):
+        def writeAndRead():
+            if self.serial.in_waiting: # Discard late responses to earlier messages
+                self.serial.reset_input_buffer()
+            self.write(message)
+            return self.read(timeout)
+        return self.worker.call(writeAndRead, priority)
+
+    # ------------------------------------------------------------------------------------
+    # Return the last polled status of a valve (see requestStatus)
+    # ------------------------------------------------------------------------------------
+    def getCachedStatus(self, valve_ID):
+        if valve_ID not in self.status_cache:
+            return ("Unknown Port", False)
+        return self.status_cache[valve_ID]
+
+    # ------------------------------------------------------------------------------------
+    # Return the expected move time of a valve from its configuration
+    # ------------------------------------------------------------------------------------
+    def getExpectedMoveTime(self, valve_ID):
+        valve_config = self.valve_configs[valve_ID] if valve_ID < len(self.valve_configs) else "8 ports"
+        [start_time, port_time] = self.move_times.get(valve_config, self.move_times["8 ports"])
+        travel = self.move_travel.get(valve_ID, self.numPortsPerConfiguration(valve_config)//2)
+        return start_time + port_time * travel
+
+    # ------------------------------------------------------------------------------------
+    # Return a one line summary of the move statistics
+    # ------------------------------------------------------------------------------------
+    def getMoveSummary(self):
+        statistics = self.move_statistics
+        text = str(statistics["moves"]) + " moves, "
+        text += str(statistics["ports"]) + " ports rotated "
+        text += "(" + str(statistics["clockwise_ports"]) + " if all clockwise)"
+        if statistics["timed_moves"] > 0:
+            text += ", mean move time " + "%0.2f" % (statistics["move_time"]/statistics["timed_moves"]) + " s"
+        return text
+
+    # ------------------------------------------------------------------------------------
+    # Return the index of a port: protocol commands give the index, the valve widgets a
+    # tuple that ends with it
+    # ------------------------------------------------------------------------------------
+    def getPortIndex(self, port_ID):
+        if isinstance(port_ID, (tuple, list)):
+            return int(port_ID[-1])
+        return int(port_ID)
+
+    # ------------------------------------------------------------------------------------
+    # Return the deadline for probing an address: a few response times of the chain, so
+    # that discovery stops at the first missing address without a full timeout
+    # ------------------------------------------------------------------------------------
+    def getProbeTimeout(self):
+        if self.response_time is None:
+            return self.probe_timeout
+        return min(self.probe_timeout, max(self.min_probe_timeout, 4.0*self.response_time))
+
+    # ------------------------------------------------------------------------------------
+    # Return the rotation direction (0 = clockwise, 1 = counter clockwise) with the least
+    # travel from the current port of a valve to a port
+    # ------------------------------------------------------------------------------------
+    def getShortestDirection(self, valve_ID, port_ID):
+        [clockwise, counter_clockwise] = self.getTravel(valve_ID, port_ID)
+        return 0 if clockwise <= counter_clockwise else 1
+
+    # ------------------------------------------------------------------------------------
+    # Return the ports a valve rotates through to reach a port: [clockwise, counter
+    # clockwise]. Clockwise rotation increases the port number.
+    # ------------------------------------------------------------------------------------
+    def getTravel(self, valve_ID, port_ID):
+        num_ports = max(self.max_ports_per_valve[valve_ID], 1)
+        current_port = self.current_port[valve_ID]
+        port_ID = self.getPortIndex(port_ID)
+        return [(port_ID - current_port) % num_ports, (current_port - port_ID) % num_ports]
+
+    # ------------------------------------------------------------------------------------
+    # Return True for a complete response: acknowledge or data ended by a carriage return,
+    # or a lone negative acknowledge
+    # ------------------------------------------------------------------------------------
+    def isCompleteResponse(self, response):
+        return response.endswith(self.carriage_return) or response == self.negative_acknowledge
+
     # ------------------------------------------------------------------------------------
     # Initialize Port Position of Given Valve
     # ------------------------------------------------------------------------------------ 
@@ -189,7 +351,11 @@ class HamiltonMVP(AbstractValve):
             response = self.inquireAndRespond(valve_ID,
                                               message ="LXR\r",
                                               dictionary = {},
-                                              default = "")
+                                              default = "",
+                                              timeout = self.getProbeTimeout())
+            if response[1]:
+                self.move_start_times[valve_ID] = time.perf_counter()
+                self.move_travel.pop(valve_ID, None)
             if self.verbose:
                 if response[1]: print("Initialized Valve: " + str(valve_ID+1))
                 else: print("Did not find valve: " + str(valve_ID+1))
@@ -202,7 +368,7 @@ class HamiltonMVP(AbstractValve):
     #  This function returns a response tuple used by this class
     #     (dictionary entry, affirmative response?, raw response string)
     # ------------------------------------------------------------------------------------
-    def inquireAndRespond(self, valve_ID, message, dictionary = {}, default = "Unknown"):
+    def inquireAndRespond(self, valve_ID, message, dictionary = {}, default = "Unknown", priority = QUERY_PRIORITY, timeout = None):
 
         # Check if the valve_ID valve is initialized
         if not self.isValidValve(valve_ID):
@@ -212,8 +378,11 @@ class HamiltonMVP(AbstractValve):
         message = self.valve_names[valve_ID] + message
 
         # Write message and read response
-        self.write(message)
-        response = self.read()
+        response = self.exchange(message, priority, timeout)
+
+        # Check for a rejected message (no carriage return)
+        if response == self.negative_acknowledge:
+            return ("Negative Acknowledge", False, response)
         
         # Parse response into sent message and response
         repeated_message = response[:(response.find(self.carriage_return)-1)]
@@ -288,14 +457,15 @@ class HamiltonMVP(AbstractValve):
     # ------------------------------------------------------------------------------------
     # Poll Movement of Valve
     # ------------------------------------------------------------------------------------         
-    def isMovementFinished(self, valve_ID):
+    def isMovementFinished(self, valve_ID, priority = QUERY_PRIORITY):
         if not self.simulate:
             response = self.inquireAndRespond(valve_ID,
                                               message ="F\r",
                                               dictionary = {"*": False,
                                                             "N": False,
                                                             "Y": True},
-                                              default = "Unknown response")
+                                              default = "Unknown response",
+                                              priority = priority)
             return response[0]
         else: ## simulation code
             return ("Y", True, "Simulation")
@@ -320,7 +490,7 @@ class HamiltonMVP(AbstractValve):
     def isValidPort(self, valve_ID, port_ID):
         if not self.isValidValve(valve_ID):
             return False
-        elif not (port_ID[-1] < self.max_ports_per_valve[valve_ID]):
+        elif not (self.getPortIndex(port_ID) < self.max_ports_per_valve[valve_ID]):
             if self.verbose:
                 print(str(port_ID) + " is not a valid port on valve " + str(valve_ID))
             return False
@@ -338,6 +508,54 @@ class HamiltonMVP(AbstractValve):
         else:
             return True
         
+    # ------------------------------------------------------------------------------------
+    # Load the saved chain and verify it with one query: the last valve must report its
+    # saved configuration. The valves are not initialized, so their ports are queried.
+    # Returns True if the chain was restored.
+    # ------------------------------------------------------------------------------------
+    def loadTopology(self):
+        if self.simulate or self.topology_file is None or not os.path.isfile(self.topology_file):
+            return False
+        try:
+            with open(self.topology_file, "r") as topology_file:
+                topology = json.load(topology_file)
+            if topology["com_port"] != str(self.com_port) or not topology["valve_configs"]:
+                return False
+            self.valve_names = topology["valve_names"]
+            self.valve_configs = topology["valve_configs"]
+            self.max_ports_per_valve = topology["max_ports_per_valve"]
+        except (IOError, ValueError, KeyError, TypeError) as exception:
+            print("Could not load Hamilton MVP chain " + self.topology_file + ": " + str(exception))
+            return False
+
+        self.num_valves = len(self.valve_configs)
+        self.current_port = [0] * self.num_valves
+        chain_found = self.howIsValveConfigured(self.num_valves-1) == self.valve_configs[-1]
+
+        # Initialize the valves as autoDetectValves() does
+        for valve_ID in range(self.num_valves):
+            if chain_found:
+                chain_found = self.initializeValve(valve_ID)
+        if not chain_found:
+            print("Hamilton MVP chain has changed, detecting valves")
+            self.valve_names = []
+            self.num_valves = 0
+            self.valve_configs = []
+            self.max_ports_per_valve = []
+            self.current_port = []
+            return False
+        self.waitUntilNotMoving(self.num_valves-1)
+
+        for valve_ID in range(self.num_valves):
+            port = self.whereIsValve(valve_ID)
+            if port == "Unknown Port":
+                print("Could not read the port of Hamilton MVP valve " + str(valve_ID+1))
+            else:
+                self.current_port[valve_ID] = int(port.split()[-1]) - 1
+
+        print("Found " + str(self.num_valves) + " Hamilton MVP Valves (saved chain " + self.topology_file + ")")
+        return True
+
     # ------------------------------------------------------------------------------------
     # Convert Port Configuration String to Number of Ports
     # ------------------------------------------------------------------------------------  
@@ -350,14 +568,54 @@ class HamiltonMVP(AbstractValve):
                 "4 ports": 4}.get(configuration_string, 0)
     
     # ------------------------------------------------------------------------------------
-    # Read from Serial Port
+    # Read a Response from Serial Port: until its terminator or the deadline
     # ------------------------------------------------------------------------------------
-    def read(self):
-        response = self.serial.read(self.read_length).decode()
+    def read(self, timeout = None):
+        if timeout is None:
+            timeout = self.response_timeout
+        start_time = time.perf_counter()
+        deadline = start_time + timeout
+
+        response = ""
+        while not self.isCompleteResponse(response):
+            if time.perf_counter() > deadline: # e.g. no valve at this address
+                if self.verbose:
+                    print("Hamilton MVP response timed out after " + str(timeout) + " s: " + repr(response))
+                break
+            response += self.serial.read(max(1, self.serial.in_waiting)).decode()
+
+        # Only complete responses measure the chain (used by getProbeTimeout)
+        if self.isCompleteResponse(response):
+            self.response_time = time.perf_counter() - start_time
+
         if self.verbose:
             print("Received: " + str((response, "")))
         return response
 
+    # ------------------------------------------------------------------------------------
+    # Record the start, travel and statistics of a move
+    # ------------------------------------------------------------------------------------
+    def recordMove(self, valve_ID, port_ID, direction):
+        [clockwise, counter_clockwise] = self.getTravel(valve_ID, port_ID)
+        self.move_travel[valve_ID] = counter_clockwise if direction == 1 else clockwise
+        self.move_start_times[valve_ID] = time.perf_counter()
+        self.move_statistics["moves"] += 1
+        self.move_statistics["ports"] += self.move_travel[valve_ID]
+        self.move_statistics["clockwise_ports"] += clockwise
+
+    # ------------------------------------------------------------------------------------
+    # Queue a background status poll of a valve that refreshes its cached status
+    # ------------------------------------------------------------------------------------
+    def requestStatus(self, valve_ID):
+        if self.simulate:
+            self.status_cache[valve_ID] = self.getStatus(valve_ID)
+        else:
+            with self.poll_lock:
+                if valve_ID in self.pending_polls: # At most one queued poll per valve
+                    return
+                self.pending_polls.add(valve_ID)
+            self.worker.submit(lambda: self.updateStatusCache(valve_ID), POLL_PRIORITY)
+
     # ------------------------------------------------------------------------------------
     # Reset Chain: Readdress and redetect valves
     # ------------------------------------------------------------------------------------  
@@ -367,19 +625,57 @@ class HamiltonMVP(AbstractValve):
         self.num_valves = 0
         self.valve_configs = []
         self.max_ports_per_valve = []
+        self.current_port = []
 
         # Configure Device
         self.autoAddress()
-        self.autoDetectValves()
+        if self.autoDetectValves():
+            self.saveTopology()
     
+    # ------------------------------------------------------------------------------------
+    # Save the discovered chain for the next start
+    # ------------------------------------------------------------------------------------
+    def saveTopology(self):
+        if self.simulate or self.topology_file is None:
+            return
+        topology = {"com_port": str(self.com_port),
+                    "valve_names": self.valve_names,
+                    "valve_configs": self.valve_configs,
+                    "max_ports_per_valve": self.max_ports_per_valve}
+        try:
+            with open(self.topology_file, "w") as topology_file:
+                json.dump(topology, topology_file, indent = 1)
+        except (IOError, OSError) as exception:
+            print("Could not save Hamilton MVP chain " + self.topology_file + ": " + str(exception))
+
+    # ------------------------------------------------------------------------------------
+    # Poll the status of a valve into the status cache (serial worker)
+    # ------------------------------------------------------------------------------------
+    def updateStatusCache(self, valve_ID):
+        with self.poll_lock:
+            self.pending_polls.discard(valve_ID)
+        self.status_cache[valve_ID] = (self.whereIsValve(valve_ID, priority = POLL_PRIORITY),
+                                       not self.isMovementFinished(valve_ID, priority = POLL_PRIORITY))
+
     # ------------------------------------------------------------------------------------
     # Halt Hamilton Class Until Movement is Finished
     # ------------------------------------------------------------------------------------
     def waitUntilNotMoving(self, valve_ID, pause_time = 1):
-        doneMoving = False
-        while not doneMoving:
-            doneMoving = self.isMovementFinished(valve_ID)
-            time.sleep(pause_time)
+        # Sleep through the rest of the expected move, then poll with doubling pauses
+        move_start_time = self.move_start_times.pop(valve_ID, None)
+        move_end_time = (move_start_time or time.perf_counter()) + self.getExpectedMoveTime(valve_ID)
+        pause = self.min_pause_time
+        while not self.isMovementFinished(valve_ID):
+            remaining_time = move_end_time - time.perf_counter()
+            if remaining_time > pause:
+                time.sleep(remaining_time)
+            else:
+                time.sleep(pause)
+                pause = min(2*pause, pause_time)
+
+        if move_start_time is not None:
+            self.move_statistics["timed_moves"] += 1
+            self.move_statistics["move_time"] += time.perf_counter() - move_start_time
     
     # ------------------------------------------------------------------------------------
     # Poll Valve Configuration
@@ -393,7 +689,7 @@ class HamiltonMVP(AbstractValve):
     # ------------------------------------------------------------------------------------
     # Poll Valve Location
     # ------------------------------------------------------------------------------------    
-    def whereIsValve(self, valve_ID):
+    def whereIsValve(self, valve_ID, priority = QUERY_PRIORITY):
         if not self.simulate:
             response = self.inquireAndRespond(valve_ID,
                                           message ="LQP\r",
@@ -405,7 +701,8 @@ class HamiltonMVP(AbstractValve):
                                                         "6": "Port 6",
                                                         "7": "Port 7",
                                                         "8": "Port 8"},
-                                          default = "Unknown Port")
+                                          default = "Unknown Port",
+                                          priority = priority)
             return response[0]
         else: ## simulation code
             return {"1": "Port 1",
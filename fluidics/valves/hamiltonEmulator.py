@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# An emulator of a Hamilton MVP daisy chain on a pseudo-terminal (Linux/macOS). It speaks
+# the chain protocol used by HamiltonMVP (1a, LXR, LQT, LQP, LP0nR, F, G) with the
+# device model and framing of SimulatedMVPChain (an acknowledge or data followed by a
+# carriage return, or a lone negative acknowledge), so that the real serial driver
+# (pyserial, framing and parsing) can be run, benchmarked and regression tested without
+# hardware:
+#
+#     emulator = HamiltonMVPEmulator(num_valves = 2, move_time = 0.2, port_time = 0.05)
+#     hamilton = HamiltonMVP(serial_port = serial.Serial(emulator.port_name))
+#
+# Running this module serves an emulated chain until Ctrl-C, or with --test runs the
+# HamiltonMVP driver against one:
+#
+#     python -m valves.hamiltonEmulator [num_valves] [--test]
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import os
+import pty
+import select
+import sys
+import threading
+import time
+import tty
+from valves.hamiltonSimulator import SimulatedMVPChain
+
+# ----------------------------------------------------------------------------------------
+# HamiltonMVPEmulator Class Definition
+# ----------------------------------------------------------------------------------------
+class HamiltonMVPEmulator(object):
+    def __init__(self,
+                 num_valves = 1,
+                 configurations = None,
+                 latency = 0.002,
+                 move_time = 0.2,
+                 port_time = 0.0,
+                 verbose = False):
+
+        # Define attributes
+        self.verbose = verbose
+        self.chain = SimulatedMVPChain(num_valves = num_valves,
+                                       configurations = configurations,
+                                       latency = latency,
+                                       move_time = move_time,
+                                       port_time = port_time,
+                                       verbose = verbose)
+        self.num_messages = 0
+
+        # Create the pseudo-terminal: the driver opens port_name
+        [self.master, self.slave] = pty.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+
+        # Start serving
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = "Hamilton MVP emulator", daemon = True)
+        self.thread.start()
+
+    # ------------------------------------------------------------------------------------
+    # Stop serving and close the pseudo-terminal
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            os.close(self.master)
+            os.close(self.slave)
+
+    # ------------------------------------------------------------------------------------
+    # Serve messages: each response is written after the device latency
+    # ------------------------------------------------------------------------------------
+    def run(self):
+        message = ""
+        while self.running:
+            [readable, writable, errors] = select.select([self.master], [], [], 0.05)
+            if not readable:
+                continue
+            message += os.read(self.master, 1024).decode()
+            while "\r" in message:
+                [command, message] = message.split("\r", 1)
+                response = self.chain.handleMessage(command)
+                self.num_messages += 1
+                if self.verbose:
+                    print("Emulated MVP: " + repr(command) + " -> " + repr(response))
+                if response is not None:
+                    time.sleep(self.chain.latency)
+                    os.write(self.master, response.encode())
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    arguments = [argument for argument in sys.argv[1:] if argument != "--test"]
+    num_valves = int(arguments[0]) if arguments else 2
+    emulator = HamiltonMVPEmulator(num_valves = num_valves, move_time = 0.2, port_time = 0.05)
+
+    if "--test" in sys.argv:
+        import serial
+        import tempfile
+        from valves.hamilton import HamiltonMVP
+
+        # Save the discovered chain outside of the working directory
+        topology_file = os.path.join(tempfile.mkdtemp(), "hamilton_chain.json")
+
+        start_time = time.perf_counter()
+        # Pseudo-terminals have no line framing (and may reject 7 bit / odd parity)
+        hamilton = HamiltonMVP(com_port = emulator.port_name,
+                               serial_port = serial.Serial(port = emulator.port_name,
+                                                           baudrate = 9600),
+                               topology_file = topology_file)
+        print("Chain initialized in " + "%0.2f" % (time.perf_counter() - start_time) + " s")
+        assert hamilton.howManyValves() == num_valves
+
+        # Move through the same ports clockwise, then the shortest way
+        ports = [7, 5, 0, 6, 1, 7, 0]
+        for shortest in [False, True]:
+            start_time = time.perf_counter()
+            for port_ID in ports:
+                moves = [(valve_ID, (port_ID,), hamilton.getShortestDirection(valve_ID, (port_ID,)) if shortest else 0)
+                         for valve_ID in range(num_valves)]
+                assert all(hamilton.changePorts(moves, wait_until_done = True))
+                assert all(hamilton.whereIsValve(valve_ID) == "Port " + str(port_ID+1) for valve_ID in range(num_valves))
+            text = "Shortest rotation" if shortest else "Clockwise"
+            print(text + " moves: " + "%0.2f" % ((time.perf_counter() - start_time)/len(ports)) + " s per move")
+
+        hamilton.close()
+
+        # Restart on the saved chain: the valves are initialized to their first port
+        hamilton = HamiltonMVP(com_port = emulator.port_name,
+                               serial_port = serial.Serial(port = emulator.port_name,
+                                                           baudrate = 9600),
+                               topology_file = topology_file)
+        assert hamilton.valve_names == [chr(valve_ID + hamilton.char_offset) for valve_ID in range(num_valves)]
+        assert hamilton.current_port == [0] * num_valves
+        hamilton.close()
+        os.remove(topology_file)
+        os.rmdir(os.path.dirname(topology_file))
+        print(str(emulator.num_messages) + " messages served")
+    else:
+        print("Emulating " + str(num_valves) + " Hamilton MVP valves on " + emulator.port_name)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    emulator.close()
+
+#
+# The MIT License
+#
+# Copyright (c) 2013 Zhuang Lab, Harvard University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A simulated daisy chain of Hamilton MVP valves behind a serial-like port (write, read,
+# in_waiting, reset_input_buffer, timeout). Each response becomes readable after a short
+# device latency and valves report movement for a while after a move (a fixed time plus
+# a time per port of rotation in the requested direction), so that the serial code of
+# HamiltonMVP can be exercised and timed without hardware:
+#
+#     hamilton = HamiltonMVP(serial_port = SimulatedMVPChain(num_valves = 2))
+#
+# Running this module benchmarks the terminator-framed reads of HamiltonMVP against
+# fixed-length reads that wait for the serial timeout.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import threading
+import time
+
+# ----------------------------------------------------------------------------------------
+# SimulatedMVPChain Class Definition
+# ----------------------------------------------------------------------------------------
+class SimulatedMVPChain(object):
+    def __init__(self,
+                 num_valves = 1,
+                 configurations = None,
+                 latency = 0.002,
+                 move_time = 0.2,
+                 port_time = 0.0,
+                 verbose = False):
+
+        # Define attributes
+        self.num_valves = num_valves
+        self.configurations = configurations or ["8 ports"] * num_valves
+        self.latency = latency          # Time until a response is readable (s)
+        self.move_time = move_time      # Time a valve reports movement after a move (s)
+        self.port_time = port_time      # Additional movement time per port of rotation (s)
+        self.verbose = verbose
+        self.timeout = None             # Serial read timeout (s), set by the user of the port
+
+        # Define serial characters of the device: responses are an acknowledge or data
+        # followed by a carriage return, a rejected message is a lone negative acknowledge
+        self.acknowledge = "\x06"
+        self.carriage_return = "\r"
+        self.negative_acknowledge = "\x15"
+        self.char_offset = 97
+        self.configuration_codes = {"8 ports": "2", # LQT responses
+                                    "6 ports": "3",
+                                    "3 ports": "4",
+                                    "2 ports @180": "5",
+                                    "2 ports @90": "6",
+                                    "4 ports": "7"}
+
+        # Define valve state
+        self.current_port = [0] * num_valves
+        self.move_end_time = [0.0] * num_valves
+
+        # Define port buffers
+        self.condition = threading.Condition()
+        self.message = ""               # Partially written message
+        self.responses = []             # [time readable, response bytes]
+
+    # ------------------------------------------------------------------------------------
+    # Close the port
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        pass
+
+    # ------------------------------------------------------------------------------------
+    # Return the number of ports of a valve
+    # ------------------------------------------------------------------------------------
+    def getNumPorts(self, valve_ID):
+        return int(self.configurations[valve_ID].split()[0])
+
+    # ------------------------------------------------------------------------------------
+    # Return the number of ports a valve rotates through to reach a port: direction 0 is
+    # clockwise (increasing ports), 1 is counter clockwise
+    # ------------------------------------------------------------------------------------
+    def getTravel(self, valve_ID, port, direction):
+        num_ports = self.getNumPorts(valve_ID)
+        if direction == 1:
+            return (self.current_port[valve_ID] - port) % num_ports
+        return (port - self.current_port[valve_ID]) % num_ports
+
+    # ------------------------------------------------------------------------------------
+    # Return the device response to a message or None for no response
+    # ------------------------------------------------------------------------------------
+    def handleMessage(self, message):
+        if message == "1a": # Auto address
+            return self.acknowledge + self.carriage_return
+
+        valve_ID = ord(message[0]) - self.char_offset
+        command = message[1:]
+        if valve_ID < 0 or valve_ID >= self.num_valves: # No valve at this address
+            return None
+
+        now = time.perf_counter()
+        if command == "LXR": # Initialize
+            self.current_port[valve_ID] = 0
+            self.move_end_time[valve_ID] = now + self.move_time
+            return self.acknowledge + self.carriage_return
+        if command.startswith("LP") and command.endswith("R") and command[2:-1].isdigit():
+            port = int(command[3:-1]) - 1
+            if port < 0 or port >= self.getNumPorts(valve_ID):
+                return self.negative_acknowledge
+            travel = self.getTravel(valve_ID, port, int(command[2]))
+            self.current_port[valve_ID] = port
+            self.move_end_time[valve_ID] = now + self.move_time + self.port_time * travel
+            return self.acknowledge + self.carriage_return
+        if command == "LQP": # Port position
+            return str(self.current_port[valve_ID] + 1) + self.carriage_return
+        if command == "LQT": # Configuration
+            return self.configuration_codes[self.configurations[valve_ID]] + self.carriage_return
+        if command == "F": # Movement finished
+            return ("Y" if now >= self.move_end_time[valve_ID] else "N") + self.carriage_return
+        if command == "G": # Overload
+            return "N" + self.carriage_return
+        return self.negative_acknowledge
+
+    # ------------------------------------------------------------------------------------
+    # Return the number of readable bytes
+    # ------------------------------------------------------------------------------------
+    @property
+    def in_waiting(self):
+        with self.condition:
+            return len(self.readable())
+
+    # ------------------------------------------------------------------------------------
+    # Read up to size bytes: returns early only when size bytes are readable
+    # ------------------------------------------------------------------------------------
+    def read(self, size = 1):
+        with self.condition:
+            deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+            while True:
+                data = self.readable()
+                now = time.perf_counter()
+                if len(data) >= size or (deadline is not None and now >= deadline):
+                    break
+                next_time = min([ready for [ready, response] in self.responses if ready > now] or [deadline or now + 0.01])
+                if deadline is not None:
+                    next_time = min(next_time, deadline)
+                self.condition.wait(max(0.0, next_time - now))
+
+            data = data[:size]
+            self.removeReadable(len(data))
+            return data
+
+    # ------------------------------------------------------------------------------------
+    # Return the readable bytes
+    # ------------------------------------------------------------------------------------
+    def readable(self):
+        now = time.perf_counter()
+        return b"".join(response for [ready, response] in self.responses if ready <= now)
+
+    # ------------------------------------------------------------------------------------
+    # Remove read bytes from the response buffer
+    # ------------------------------------------------------------------------------------
+    def removeReadable(self, size):
+        while size > 0:
+            [ready, response] = self.responses[0]
+            if size >= len(response):
+                self.responses.pop(0)
+            else:
+                self.responses[0] = [ready, response[size:]]
+            size -= len(response)
+
+    # ------------------------------------------------------------------------------------
+    # Discard readable bytes
+    # ------------------------------------------------------------------------------------
+    def reset_input_buffer(self):
+        with self.condition:
+            self.removeReadable(len(self.readable()))
+
+    # ------------------------------------------------------------------------------------
+    # Write bytes: responses to complete messages become readable after the latency
+    # ------------------------------------------------------------------------------------
+    def write(self, data):
+        with self.condition:
+            self.message += data.decode()
+            while "\r" in self.message:
+                [message, self.message] = self.message.split("\r", 1)
+                response = self.handleMessage(message)
+                if self.verbose:
+                    print("Simulated MVP: " + repr(message) + " -> " + repr(response))
+                if response is not None:
+                    self.responses.append([time.perf_counter() + self.latency, response.encode()])
+            self.condition.notify_all()
+        return len(data)
+
+# ----------------------------------------------------------------------------------------
+# Return the mean time (s) of calling function repeats times
+# ----------------------------------------------------------------------------------------
+def timeCalls(function, repeats):
+    start_time = time.perf_counter()
+    for i in range(repeats):
+        function()
+    return (time.perf_counter() - start_time)/repeats
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class: benchmark framed reads against fixed-length reads
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    from valves.hamilton import HamiltonMVP
+
+    repeats = 20
+    hamilton = HamiltonMVP(serial_port = SimulatedMVPChain(num_valves = 2), topology_file = None)
+
+    # Fixed-length reads: ask for 64 bytes and wait for the 100 ms serial timeout
+    port = SimulatedMVPChain(num_valves = 2)
+    port.timeout = 0.1
+    def fixedQuery(message):
+        port.write(message.encode())
+        return port.read(64)
+
+    results = [["status query", lambda: fixedQuery("aLQP\r"), lambda: hamilton.whereIsValve(0)],
+               ["valve move", lambda: fixedQuery("aLP013R\r"), lambda: hamilton.changePort(0, (2,))]]
+    print("Mean time per exchange (" + str(repeats) + " repeats)")
+    for [name, fixed, framed] in results:
+        fixed_time = timeCalls(fixed, repeats)
+        framed_time = timeCalls(framed, repeats)
+        print("   " + name + ": fixed-length " + "%0.1f" % (1000.0*fixed_time) + " ms, " +
+              "framed " + "%0.1f" % (1000.0*framed_time) + " ms (" + "%0.0f" % (fixed_time/framed_time) + "x)")
+
+    hamilton.close()
+
+#
+# The MIT License
+#
+# Copyright (c) 2013 Zhuang Lab, Harvard University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
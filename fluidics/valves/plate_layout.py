@@ -0,0 +1,58 @@
+import json
+
+import numpy
+
+
+# Plate layouts (e.g. XYZ_layout.json) list the calibrated well positions of every plate.
+# A plate with three or more positions interpolates the coordinates of all of its wells
+# once (Plate.freeze) into a (rows, cols, 3) array. These arrays are kept in a cache next
+# to the layout (XYZ_layout.json.cache), so that loading a calibrated layout needs
+# neither the interpolation nor matplotlib, which is only imported to re-calibrate.
+
+
+def well_coordinates(positions, shape=(12, 8)):
+    """Interpolate the coordinates of every well from the recorded well positions.
+
+    Returns the triangulation, the per-axis interpolators and a (rows, cols, 3) array
+    (NaN for wells outside the recorded positions).
+    """
+    import matplotlib.tri  # heavy import, only needed to (re)calibrate a layout
+
+    point_x, point_y = zip(*[p[:2] for p in positions])
+    coords = [p[2] for p in positions]
+
+    triangulation = matplotlib.tri.Triangulation(point_x, point_y)
+    interpolation = [matplotlib.tri.LinearTriInterpolator(triangulation, coord) for coord in zip(*coords)]
+    #interpolation = [matplotlib.tri.CubicTriInterpolator(triangulation, coord) for coord in zip(*coords)]
+
+    grid_x, grid_y = numpy.meshgrid(numpy.arange(shape[0]), numpy.arange(shape[1]), indexing="ij")
+    wells = numpy.stack([numpy.ma.filled(interp(grid_x, grid_y).astype(float), numpy.nan) for interp in interpolation], axis=-1)
+    return triangulation, interpolation, wells
+
+
+def read_layout(path):
+    """Return the plate configurations of a layout, with the cached well coordinates."""
+    with open(path) as input_file:
+        configs = json.load(input_file)
+
+    try:
+        with open(path + ".cache") as cache_file:
+            cached = {json.dumps(entry["positions"]): entry["wells"] for entry in json.load(cache_file)}
+    except (IOError, ValueError, KeyError, TypeError):
+        cached = {}
+
+    for config in configs:
+        key = json.dumps(config.get("positions", []))
+        if key in cached:  # only if the plate was not re-calibrated since
+            config["wells"] = cached[key]
+    return configs
+
+
+def write_layout_cache(path, plates):
+    """Save the well coordinates of the plates next to their layout."""
+    cache = [{"name": p.name, "positions": p.positions, "wells": p.wells.tolist()} for p in plates if p.wells is not None]
+    try:
+        with open(path + ".cache", "w") as cache_file:
+            json.dump(cache, cache_file)
+    except (IOError, OSError) as exception:
+        print("Could not save plate layout cache " + path + ".cache: " + str(exception))
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A dedicated I/O thread for one serial port. Requests (functions that talk to the port)
+# are queued with a priority and executed one at a time in priority order, so that device
+# commands go ahead of queued status polls and no other thread blocks on serial I/O
+# longer than its own request. The latency of every request (time queued plus time
+# spent on the port) is recorded per request type.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import itertools
+import queue
+import threading
+import time
+
+# Request priorities: lower values are executed first
+COMMAND_PRIORITY = 0    # Device commands (e.g. valve moves)
+QUERY_PRIORITY = 1      # Queries whose answer a caller waits for
+POLL_PRIORITY = 2       # Background status polls
+STOP_PRIORITY = 3       # Stop the worker once all other requests are done
+
+PRIORITY_NAMES = {COMMAND_PRIORITY: "command",
+                  QUERY_PRIORITY: "query",
+                  POLL_PRIORITY: "poll"}
+
+# ----------------------------------------------------------------------------------------
+# SerialRequest Class Definition: a queued request and its result
+# ----------------------------------------------------------------------------------------
+class SerialRequest(object):
+    def __init__(self, function, priority):
+        self.function = function
+        self.priority = priority
+        self.submit_time = time.perf_counter()
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+    # ------------------------------------------------------------------------------------
+    # Execute the request (worker thread)
+    # ------------------------------------------------------------------------------------
+    def execute(self):
+        self.start_time = time.perf_counter()
+        try:
+            self.result = self.function()
+        except Exception as exception:
+            self.exception = exception
+        self.end_time = time.perf_counter()
+        self.done.set()
+
+    # ------------------------------------------------------------------------------------
+    # Wait for the result: exceptions raised by the request are raised here
+    # ------------------------------------------------------------------------------------
+    def wait(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise IOError("Serial request timed out after " + str(timeout) + " s")
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+# ----------------------------------------------------------------------------------------
+# SerialWorker Class Definition
+# ----------------------------------------------------------------------------------------
+class SerialWorker(object):
+    def __init__(self,
+                 name = "Serial",
+                 verbose = False):
+
+        # Initialize internal attributes
+        self.name = name
+        self.verbose = verbose
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count() # First in, first out within a priority
+        self.metrics_lock = threading.Lock()
+        self.metrics = {} # Priority: [count, total latency, max latency, total I/O time]
+
+        # Start the I/O thread
+        self.thread = threading.Thread(target = self.run, name = self.name, daemon = True)
+        self.thread.start()
+
+    # ------------------------------------------------------------------------------------
+    # Execute a function on the worker and wait for its result
+    # ------------------------------------------------------------------------------------
+    def call(self, function, priority = QUERY_PRIORITY, timeout = None):
+        if threading.current_thread() is self.thread: # Nested request, e.g. a poll that queries
+            return function()
+        return self.submit(function, priority).wait(timeout)
+
+    # ------------------------------------------------------------------------------------
+    # Stop the worker after the queued requests are done
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        if not self.thread.is_alive():
+            return
+        self.requests.put((STOP_PRIORITY, next(self.sequence), None))
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+        if self.verbose:
+            print(self.name + " latency: " + self.getSummary())
+
+    # ------------------------------------------------------------------------------------
+    # Return latency metrics by request type: {name: (count, mean latency, max latency,
+    # mean I/O time)} in seconds
+    # ------------------------------------------------------------------------------------
+    def getMetrics(self):
+        metrics = {}
+        with self.metrics_lock:
+            for priority, [count, total_latency, max_latency, total_io_time] in self.metrics.items():
+                metrics[PRIORITY_NAMES.get(priority, str(priority))] = (count,
+                                                                        total_latency/count,
+                                                                        max_latency,
+                                                                        total_io_time/count)
+        return metrics
+
+    # ------------------------------------------------------------------------------------
+    # Return a one line summary of the request latency
+    # ------------------------------------------------------------------------------------
+    def getSummary(self):
+        metrics = self.getMetrics()
+        if not metrics:
+            return "No requests"
+        text = []
+        for name in sorted(metrics):
+            [count, mean_latency, max_latency, mean_io_time] = metrics[name]
+            entry = str(count) + " " + name + "s, "
+            entry += "mean " + "%0.1f" % (1000.0*mean_latency) + " ms, "
+            entry += "max " + "%0.1f" % (1000.0*max_latency) + " ms, "
+            entry += "I/O " + "%0.1f" % (1000.0*mean_io_time) + " ms"
+            text.append(entry)
+        return "; ".join(text)
+
+    # ------------------------------------------------------------------------------------
+    # Record the latency of an executed request
+    # ------------------------------------------------------------------------------------
+    def recordLatency(self, request):
+        latency = request.end_time - request.submit_time
+        with self.metrics_lock:
+            [count, total_latency, max_latency, total_io_time] = self.metrics.get(request.priority, [0, 0.0, 0.0, 0.0])
+            self.metrics[request.priority] = [count + 1,
+                                              total_latency + latency,
+                                              max(max_latency, latency),
+                                              total_io_time + request.end_time - request.start_time]
+
+    # ------------------------------------------------------------------------------------
+    # Worker thread: execute requests in priority order
+    # ------------------------------------------------------------------------------------
+    def run(self):
+        while True:
+            [priority, sequence, request] = self.requests.get()
+            if request is None:
+                return
+            request.execute()
+            self.recordLatency(request)
+
+    # ------------------------------------------------------------------------------------
+    # Queue a function and return its SerialRequest without waiting
+    # ------------------------------------------------------------------------------------
+    def submit(self, function, priority = QUERY_PRIORITY):
+        request = SerialRequest(function, priority)
+        self.requests.put((priority, next(self.sequence), request))
+        return request
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    worker = SerialWorker(name = "Demo", verbose = True)
+
+    # Queue slow polls, then a command: the command is executed after the current poll
+    polls = [worker.submit(lambda: time.sleep(0.05), POLL_PRIORITY) for i in range(10)]
+    print("Command result: " + str(worker.call(lambda: "done", COMMAND_PRIORITY)))
+    for poll in polls:
+        poll.wait()
+    worker.close()
+
+#
+# The MIT License
+#
+# Copyright (c) 2013 Zhuang Lab, Harvard University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
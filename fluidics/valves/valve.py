@@ -40,3 +40,18 @@ class AbstractValve(ABC):
     @abstractmethod
     def getRotationDirections(self, valve_ID):
         pass
+
+    # Valves with background polling override these to avoid blocking the caller
+    def requestStatus(self, valve_ID):
+        pass
+
+    def getCachedStatus(self, valve_ID):
+        return self.getStatus(valve_ID)
+
+    # Rotation direction for moves that do not request one
+    def getShortestDirection(self, valve_ID, port_ID):
+        return 0
+
+    # Change several valves: moves is a list of (valve_ID, port_ID, direction)
+    def changePorts(self, moves):
+        return [self.changePort(valve_ID, port_ID, direction) for [valve_ID, port_ID, direction] in moves]
@@ -22,11 +22,7 @@
 import sys
 from PyQt5 import QtCore, QtGui, QtWidgets
 from valves.qtValveControl import QtValveControl
-from valves.hamilton import HamiltonMVP
-from valves.autopicker import MockAutopicker  # used for simulated robot needle
-from valves.autopicker_cnc import CNC         # use orig ebay-CNC system for robot needle 
-from valves.autopicker_xyz import XYZ       # use da Vinici miniMaker from XYZprinting for robot needle
-from valves.autopicker_grbl import GRBL     # use GRBL CNC system for robot needle 
+from valves.valveDevices import ValveDevices # valve chain and robot needle without widgets
 
 # ----------------------------------------------------------------------------------------
 # ValveChain Class Definition
@@ -56,45 +52,17 @@ class ValveChain(QtWidgets.QWidget):
 
         print('setting up valve chain')
 
-        # Create instance of Valve class
-        print(valve_type)
-        if valve_type == 'Simulated' or num_simulated_valves > 0:
-            print('simulating valves')
-            self.valve_chain = HamiltonMVP(com_port = 0,
-				   num_simulated_valves = num_simulated_valves,
-				   verbose = self.verbose)
-
-        elif valve_type == 'Hamilton':	
-            self.valve_chain = HamiltonMVP(com_port = self.com_port,
-                                           verbose = self.verbose)
-
-        elif valve_type == 'Titan':
-            self.valve_chain = TitanValve(com_port = self.com_port,
-                    verbose = self.verbose)
-        
-        elif valve_type == 'None':
-            print('no valves')
-            self.valve_chain = None
-        
-        if usb_cnc == None:
-            self.cnc = None
-        elif usb_cnc == 'GRBL':
-            self.cnc = GRBL(com_port = self.com_port)
-        elif usb_cnc == 'XYZ':
-            self.cnc = XYZ()
-            print('CNC is XYZ minimover')
-        elif usb_cnc == 'CNC':
-            self.cnc = CNC()
-        elif usb_cnc == 'simulated':
-            self.cnc = MockAutopicker()
-        else:
-            cnc_vendor_product = [int(i) for i in usb_cnc.split(",")]         # for backwards compatibility, worth updating this later
-
-            self.cnc = CNC(cnc_vendor_product[0], cnc_vendor_product[1])
-                    
+        # Create the valve chain and robot needle devices
+        self.devices = ValveDevices(com_port = self.com_port,
+                                    num_simulated_valves = num_simulated_valves,
+                                    usb_cnc = usb_cnc,
+                                    valve_type = valve_type,
+                                    verbose = self.verbose)
+        self.valve_chain = self.devices.valve_chain
+        self.cnc = self.devices.cnc
 
         # Create QtValveControl widgets for each valve in the chain
-        self.num_valves = self.valve_chain.howManyValves() if self.valve_chain is not None else 0
+        self.num_valves = self.devices.num_valves
         self.valve_names = []
         self.valve_widgets = []
         
@@ -113,31 +81,11 @@ class ValveChain(QtWidgets.QWidget):
     def changeValvePosition(self, valve_ID, port_ID = None):
         print("Valve", valve_ID, "and port", port_ID)
 
-        if valve_ID >= 0 and valve_ID < self.num_valves:
-            if port_ID == None:
-                port_ID = self.valve_widgets[valve_ID].getPortIndex()
-            rotation_direction = self.valve_widgets[valve_ID].getDesiredRotationIndex()
-        else:   # for CNC only
-            if port_ID == None:
-                port_ID = self.valve_widgets[-1].getPortIndex()
-            rotation_direction = self.valve_widgets[-1].getDesiredRotationIndex()
-
-        if self.verbose:
-            text_string = "Changing Valve " + str(valve_ID)
-            text_string += " Port " + str(port_ID)
-            text_string += " Direction " + str(rotation_direction)
-            print(text_string)
-        
-        if valve_ID >= 0 and valve_ID < self.num_valves:
-            if port_ID == None:
-                port_ID = self.valve_widgets[valve_ID].getPortIndex()
-            rotation_direction = self.valve_widgets[valve_ID].getDesiredRotationIndex()
+        if port_ID == None:
+            port_ID = self.getValveWidget(valve_ID).getPortIndex()
+        rotation_direction = self.getValveWidget(valve_ID).getDesiredRotationIndex()
 
-            self.valve_chain.changePort(valve_ID = valve_ID,
-                                    port_ID = port_ID,
-                                    direction = rotation_direction)
-        else:
-            self.cnc.move(port_ID, direction = rotation_direction)
+        self.devices.changeValvePosition(valve_ID, port_ID, rotation_direction)
 
         # Update valve display
         self.pollValveStatus()
@@ -146,11 +94,7 @@ class ValveChain(QtWidgets.QWidget):
     # Close class
     # ------------------------------------------------------------------------------------
     def close(self):
-        if self.verbose: print("Closing valve chain")
-        self.valve_chain.close()
-        if self.cnc is not None:
-            print("Closing USB CNC")
-            self.cnc.close()
+        self.devices.close()
 
     # ------------------------------------------------------------------------------------
     # Create the Qt widgets for display
@@ -206,42 +150,63 @@ class ValveChain(QtWidgets.QWidget):
         self.menu_names = ["Valve"]
         self.menu_items = [[self.valve_reset_action]]
 
+    # ------------------------------------------------------------------------------------
+    # Return the estimated time (s) of the moves of an external command
+    # ------------------------------------------------------------------------------------
+    def estimateCommand(self, command):
+        return self.devices.estimateCommand(command, self.getDirections(command))
+
+    # ------------------------------------------------------------------------------------
+    # Return the directions of an external command: the valves rotate the shortest way
+    # (None), the CNC goes to the plate selected in its widget
+    # ------------------------------------------------------------------------------------
+    def getDirections(self, command):
+        return [None if valve_ID < self.num_valves or not self.valve_widgets
+                else self.getValveWidget(valve_ID).getDesiredRotationIndex()
+                for valve_ID in range(len(command))]
+
+    # ------------------------------------------------------------------------------------
+    # Return the widget of a valve (valve IDs past the valve chain are the CNC)
+    # ------------------------------------------------------------------------------------
+    def getValveWidget(self, valve_ID):
+        if valve_ID >= 0 and valve_ID < self.num_valves:
+            return self.valve_widgets[valve_ID]
+        return self.valve_widgets[-1]
+
     # ------------------------------------------------------------------------------------
     # Determine number of valves
     # ------------------------------------------------------------------------------------
     def howManyValves(self):
-        return self.valve_chain.howManyValves + (self.cnc is not None)
+        return self.devices.howManyValves()
 
     # ------------------------------------------------------------------------------------
-    # Update valve status display with the current status each valve in the chain
+    # Update valve status display with the last polled status of each valve in the chain
+    # and queue the next polls (serial I/O does not block the GUI)
     # ------------------------------------------------------------------------------------
     def pollValveStatus(self):
         for valve_ID in range(self.num_valves):
-            self.valve_widgets[valve_ID].setStatus(self.valve_chain.getStatus(valve_ID))
+            self.valve_chain.requestStatus(valve_ID)
+            self.valve_widgets[valve_ID].setStatus(self.valve_chain.getCachedStatus(valve_ID))
         if self.cnc is not None:
             self.valve_widgets[-1].setStatus(self.cnc.get_status())
 
     # ------------------------------------------------------------------------------------
-    # Change port status based on external command
+    # Change port status based on external command: the valves are moved together (the
+    # shortest way) and the display is updated once
     # ------------------------------------------------------------------------------------          
     def receiveCommand(self, command):
-        for valve_ID, port_ID in enumerate(command):
-            # print('valve_ID')
-            # print(valve_ID)
-            # print('port_ID')
-            # print(port_ID)
-            skip = False
-            if type(port_ID) is not tuple:
-                if port_ID == -1:   # -1 is a flag for 'do not change port'
-                    skip = True
-            if not skip: 
-                self.changeValvePosition(valve_ID, port_ID)
+        if self.verbose:
+            print("Valve command", command)
+        self.devices.receiveCommand(command, self.getDirections(command))
+
+        # Update valve display
+        self.pollValveStatus()
 
     # ------------------------------------------------------------------------------------
     # Reinitialize the valve chain
     # ------------------------------------------------------------------------------------          
     def reinitializeChain(self):
-        self.valve_chain.resetChain()
+        self.devices.resetChain()
         #if self.cnc is not None:
         #    self.cnc.reset()
 
@@ -18,8 +18,8 @@
 # ----------------------------------------------------------------------------------------
 import sys
 import os
-import xml.etree.ElementTree as elementTree
 from PyQt5 import QtCore, QtGui, QtWidgets
+from kilroyConfiguration import loadConfiguration, Registry
 
 # ----------------------------------------------------------------------------------------
 # ValveCommands Class Definition
@@ -31,22 +31,25 @@ class ValveCommands(QtWidgets.QMainWindow):
     
     def __init__(self,
                  xml_file_path="default_config.xml",
+                 configuration = None,
                  verbose = False):
         super(ValveCommands, self).__init__()
 
         # Initialize internal attributes
         self.verbose = verbose
         self.file_name = xml_file_path
-        self.command_names = []
+        self.command_names = Registry()
         self.commands = []
         self.num_commands = 0
         self.num_valves = 0
+        self.cnc = False
         
         # Create GUI
         self.createGUI()
 
         # Load Configurations
-        self.loadCommands(xml_file_path = self.file_name)
+        self.loadCommands(xml_file_path = self.file_name,
+                          configuration = configuration)
 
     # ------------------------------------------------------------------------------------
     # Create display and control widgets
@@ -110,12 +113,11 @@ class ValveCommands(QtWidgets.QMainWindow):
     # Return a command indexed by its name
     # ------------------------------------------------------------------------------------        
     def getCommandByName(self, command_name):
-        try:
-            command_ID = self.command_names.index(command_name)
-            return self.commands[command_ID]
-        except:
+        command_ID = self.command_names.getID(command_name)
+        if command_ID < 0:
             print("Did not find " + command_name)
             return [-1]*self.num_valves # Return no change command
+        return self.commands[command_ID]
 
     # ------------------------------------------------------------------------------------
     # Return the names of the current defined commands
@@ -137,9 +139,10 @@ class ValveCommands(QtWidgets.QMainWindow):
         return self.default_num_valves
 
     # ------------------------------------------------------------------------------------
-    # Load and parse a XML file with defined commands
+    # Load and parse a XML file with defined commands: an already parsed
+    #   KilroyConfiguration can be provided to avoid parsing the file again
     # ------------------------------------------------------------------------------------
-    def loadCommands(self, xml_file_path = ""):
+    def loadCommands(self, xml_file_path = "", configuration = None):
         # Set Configuration XML (load if needed)
         if not xml_file_path:
             xml_file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Open File", "\home")[0]
@@ -149,7 +152,7 @@ class ValveCommands(QtWidgets.QMainWindow):
         self.file_name = xml_file_path
         
         # Parse XML
-        self.parseCommandXML()
+        self.parseCommandXML(configuration)
 
         # Update GUI
         self.updateGUI()
@@ -161,60 +164,19 @@ class ValveCommands(QtWidgets.QMainWindow):
     # ------------------------------------------------------------------------------------
     # Parse the command xml file
     # ------------------------------------------------------------------------------------        
-    def parseCommandXML(self):
-        print('called parsing valve commands')
-        # Try loading file
-        try:
-            print("Parsing for commands: " + self.file_name)
-            self.xml_tree = elementTree.parse(self.file_name)
-            self.kilroy_configuration = self.xml_tree.getroot()
-        except:
-            print("Valid xml file not loaded")
-            return
-
-        
-        # Clear previous commands
-        self.command_names = []
-        self.commands = []
-        self.num_commands = 0
-
-        # Load number of valves
-        self.num_valves = int(self.kilroy_configuration.get("num_valves"))
-        if not (self.num_valves>0):
-            print("Number of valves not specified")
-
-        self.cnc = bool(self.kilroy_configuration.get("cnc", False))
+    def parseCommandXML(self, configuration = None):
+        # Parse file if a configuration was not provided
+        if configuration is None:
+            configuration = loadConfiguration(self.file_name, verbose = self.verbose)
+            if configuration is None:
+                return
 
         # Load commands
-        print('parsing valve commands now')
-        for valve_command in self.kilroy_configuration.findall("valve_commands"):
-            # print(valve_command)
-            command_list = valve_command.findall("valve_cmd")
-            # print(command_list)
-            for command in command_list:
-                new_command = [-1]*(self.num_valves + self.cnc) # make copy to initialize config with default
-                for valve_pos in command.findall("valve_pos"):
-                    valve_ID = int(valve_pos.get("valve_ID")) - 1
-                    port_ID = int(valve_pos.get("port_ID")) - 1
-                    if valve_ID < self.num_valves:
-                        new_command[valve_ID] = port_ID
-                    else:
-                        print("Valve out of range on command: " + command.get("name"))
-
-                for cnc_pos in command.findall("cnc_pos"):
-                    valve_ID = self.num_valves
-                    port_ID = int(cnc_pos.get("port_ID")) - 1
-                    plate_ID = cnc_pos.get("plate_ID")
-                    new_command[valve_ID] = (plate_ID, port_ID)
-                    '''
-                    print("plate_ID")
-                    print(plate_ID)
-                    print("port_ID")
-                    print(port_ID)
-                    '''
-                # Add command
-                self.commands.append(new_command)
-                self.command_names.append(command.get("name"))
+        valve_commands = configuration.valve_commands
+        self.command_names = valve_commands.names
+        self.commands = valve_commands.commands
+        self.num_valves = valve_commands.num_valves
+        self.cnc = valve_commands.cnc
 
         # Record number of configs
         self.num_commands = len(self.command_names)
@@ -246,7 +208,7 @@ class ValveCommands(QtWidgets.QMainWindow):
     # Update active command on GUI
     # ------------------------------------------------------------------------------------                
     def setActiveCommand(self, command_name):
-        command_ID = self.command_names.index(command_name)
+        command_ID = self.command_names.getID(command_name)
         self.commandListWidget.setCurrentRow(command_ID)
         self.updateCommandDisplay()
 
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A class that owns the valve chain and robot needle (CNC) devices without any Qt
+# widgets. ValveChain composes it to display and control the devices in the GUI, and
+# kilroyHeadless uses it directly to dispatch protocol commands.
+#
+# The autopicker modules are imported only when the corresponding CNC is requested, so
+# that their serial/usb/plotting dependencies are not needed otherwise.
+#
+# The last position commanded to each valve and to the CNC is tracked, so that external
+# commands skip moves to the position a device is already in (e.g. repeated buffer
+# changes to the same port or well). The number of skipped moves is kept in saved_moves.
+# Valves rotate the shortest way to the port unless a command requests a direction.
+# estimateCommand() gives the time the CNC needs for the moves of a command, so that
+# the protocol engine can schedule the next command after them.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+from valves.hamilton import HamiltonMVP
+
+# ----------------------------------------------------------------------------------------
+# ValveDevices Class Definition
+# ----------------------------------------------------------------------------------------
+class ValveDevices(object):
+    def __init__(self,
+                 com_port = "COM2",
+                 num_simulated_valves = 0,
+                 usb_cnc = 'GRBL',
+                 valve_type = 'Simulated',
+                 verbose = False):
+
+        # Define local attributes
+        self.com_port = com_port
+        self.usb_cnc = usb_cnc
+        self.verbose = verbose
+        self.positions = {}             # Valve ID: last commanded position (see getPosition)
+        self.saved_moves = 0            # Number of skipped moves
+
+        # Create instance of Valve class
+        print(valve_type)
+        if valve_type == 'Simulated' or num_simulated_valves > 0:
+            print('simulating valves')
+            self.valve_chain = HamiltonMVP(com_port = 0,
+                                           num_simulated_valves = num_simulated_valves,
+                                           simulate = True,
+                                           verbose = self.verbose)
+
+        elif valve_type == 'Hamilton':
+            self.valve_chain = HamiltonMVP(com_port = self.com_port,
+                                           verbose = self.verbose)
+
+        elif valve_type == 'Titan':
+            self.valve_chain = TitanValve(com_port = self.com_port,
+                                          verbose = self.verbose)
+
+        elif valve_type == 'None':
+            print('no valves')
+            self.valve_chain = None
+
+        # Create instance of the robot needle
+        if usb_cnc == None:
+            self.cnc = None
+        elif usb_cnc == 'GRBL':
+            from valves.autopicker_grbl import GRBL     # use GRBL CNC system for robot needle
+            self.cnc = GRBL(com_port = self.com_port)
+        elif usb_cnc == 'XYZ':
+            from valves.autopicker_xyz import XYZ       # use da Vinici miniMaker from XYZprinting for robot needle
+            self.cnc = XYZ()
+            print('CNC is XYZ minimover')
+        elif usb_cnc == 'CNC':
+            from valves.autopicker_cnc import CNC       # use orig ebay-CNC system for robot needle
+            self.cnc = CNC()
+        elif usb_cnc == 'simulated':
+            from valves.autopicker import MockAutopicker  # used for simulated robot needle
+            self.cnc = MockAutopicker()
+        else:
+            from valves.autopicker_cnc import CNC
+            cnc_vendor_product = [int(i) for i in usb_cnc.split(",")]         # for backwards compatibility, worth updating this later
+
+            self.cnc = CNC(cnc_vendor_product[0], cnc_vendor_product[1])
+
+        # Build the list of wells that CNC ports refer to
+        if self.cnc is not None:
+            self.cnc.get_wells()
+
+        self.num_valves = self.valve_chain.howManyValves() if self.valve_chain is not None else 0
+
+    # ------------------------------------------------------------------------------------
+    # Change specified valve position: valve IDs past the valve chain address the CNC
+    # ------------------------------------------------------------------------------------
+    def changeValvePosition(self, valve_ID, port_ID, direction = 0):
+        if self.verbose:
+            text_string = "Changing Valve " + str(valve_ID)
+            text_string += " Port " + str(port_ID)
+            text_string += " Direction " + str(direction)
+            print(text_string)
+
+        if valve_ID >= 0 and valve_ID < self.num_valves:
+            moved = self.valve_chain.changePort(valve_ID = valve_ID,
+                                                port_ID = port_ID,
+                                                direction = direction)
+        elif self.cnc is not None:
+            moved = self.cnc.move(port_ID, direction = direction)
+        else:
+            print("Valve " + str(valve_ID) + " is not in the valve chain")
+            moved = False
+        self.updatePosition(valve_ID, port_ID, direction, moved)
+
+    # ------------------------------------------------------------------------------------
+    # Close devices
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        if self.verbose: print("Closing valve chain")
+        if self.saved_moves > 0:
+            print("Skipped " + str(self.saved_moves) + " moves to the current position")
+        if self.valve_chain is not None:
+            self.valve_chain.close()
+        if self.cnc is not None:
+            print("Closing USB CNC")
+            self.cnc.close()
+
+    # ------------------------------------------------------------------------------------
+    # Return the estimated time (s) of the moves of an external command: the CNC moves,
+    # which are made one after the other once the valves are moving
+    # ------------------------------------------------------------------------------------
+    def estimateCommand(self, command, directions = None):
+        if self.cnc is None:
+            return 0.0
+        [moves, skipped] = self.getMoves(command, directions)
+        return sum(self.cnc.estimate_move(port_ID, direction)
+                   for [valve_ID, port_ID, direction] in moves if valve_ID >= self.num_valves)
+
+    # ------------------------------------------------------------------------------------
+    # Return the moves of an external command, [(valve ID, port ID, direction), ...],
+    # and the IDs of the valves already in position
+    # ------------------------------------------------------------------------------------
+    def getMoves(self, command, directions = None):
+        moves = []
+        skipped = []
+        for valve_ID, port_ID in enumerate(command):
+            if type(port_ID) is not tuple and port_ID == -1: # -1 is a flag for 'do not change port'
+                continue
+            direction = directions[valve_ID] if directions is not None else None
+            if direction is None:
+                if valve_ID < self.num_valves:
+                    direction = self.valve_chain.getShortestDirection(valve_ID, port_ID)
+                else:
+                    direction = 0
+            if self.positions.get(valve_ID) == self.getPosition(valve_ID, port_ID, direction):
+                skipped.append(valve_ID)
+                continue
+            moves.append((valve_ID, port_ID, direction))
+        return [moves, skipped]
+
+    # ------------------------------------------------------------------------------------
+    # Return the position a move puts a device in: the port of a valve, or the well and
+    # plate (direction) of the CNC
+    # ------------------------------------------------------------------------------------
+    def getPosition(self, valve_ID, port_ID, direction = 0):
+        if valve_ID >= 0 and valve_ID < self.num_valves:
+            return port_ID
+        return (port_ID, direction)
+
+    # ------------------------------------------------------------------------------------
+    # Return the status of every valve followed by the status of the CNC
+    # ------------------------------------------------------------------------------------
+    def getStatus(self):
+        status = [self.valve_chain.getStatus(valve_ID) for valve_ID in range(self.num_valves)]
+        if self.cnc is not None:
+            status.append(self.cnc.get_status())
+        return status
+
+    # ------------------------------------------------------------------------------------
+    # Determine number of valves (including the CNC)
+    # ------------------------------------------------------------------------------------
+    def howManyValves(self):
+        return self.num_valves + (self.cnc is not None)
+
+    # ------------------------------------------------------------------------------------
+    # Change port status based on external command: one port per valve, -1 = no change.
+    # Directions (None = shortest rotation / first plate) are optional. Moves to the
+    # current position are skipped, the valve chain moves are issued together, then the
+    # CNC moves.
+    # ------------------------------------------------------------------------------------
+    def receiveCommand(self, command, directions = None):
+        [moves, skipped] = self.getMoves(command, directions)
+        for valve_ID in skipped:
+            if self.verbose:
+                print("Valve " + str(valve_ID) + " is already at " + str(command[valve_ID]))
+            self.saved_moves += 1
+
+        valve_moves = [move for move in moves if move[0] < self.num_valves]
+        if valve_moves:
+            if self.verbose:
+                print("Changing Valves " + ", ".join(str(move) for move in valve_moves))
+            results = self.valve_chain.changePorts(valve_moves)
+            for [valve_ID, port_ID, direction], moved in zip(valve_moves, results):
+                self.updatePosition(valve_ID, port_ID, direction, moved)
+        for [valve_ID, port_ID, direction] in moves:
+            if valve_ID >= self.num_valves:
+                self.changeValvePosition(valve_ID, port_ID, direction)
+
+    # ------------------------------------------------------------------------------------
+    # Reinitialize the valve chain
+    # ------------------------------------------------------------------------------------
+    def resetChain(self):
+        if self.valve_chain is not None:
+            self.valve_chain.resetChain()
+            for valve_ID in range(self.num_valves):
+                self.positions.pop(valve_ID, None)
+
+    # ------------------------------------------------------------------------------------
+    # Record the position of a device after a move: unknown if the move failed
+    # ------------------------------------------------------------------------------------
+    def updatePosition(self, valve_ID, port_ID, direction, moved):
+        if moved:
+            self.positions[valve_ID] = self.getPosition(valve_ID, port_ID, direction)
+        else:
+            self.positions.pop(valve_ID, None)
+
+#
+# The MIT License
+#
+# Copyright (c) 2013 Zhuang Lab, Harvard University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#